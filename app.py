@@ -1,31 +1,91 @@
 import os
+import atexit
 import base64
 import io
+import json
 import logging
 import time
+import asyncio
 import re # For parsing tags
 import math # For file size formatting
-from flask import Flask, request, jsonify, session, Response, stream_with_context
+import uuid
+import importlib.util
+import mimetypes
+import contextlib
+from datetime import datetime, timezone
+from flask import Flask, Request, request, jsonify, session, Response, stream_with_context, send_file, g
 from flask_cors import CORS
-from pyrogram import Client, enums
+from werkzeug.exceptions import ClientDisconnected
+from pyrogram import Client, enums, raw
 from pyrogram.errors import (
     SessionPasswordNeeded,
     PhoneCodeInvalid,
     PhoneCodeExpired,
     FloodWait,
     ApiIdInvalid,
-    AuthKeyUnregistered, # Important for session validation
+    FilePartMissing,
+    FileReferenceExpired,
+    FileReferenceInvalid,
+    FileReferenceEmpty,
 )
 from pyrogram.types import Message # For type hinting
 from dotenv import load_dotenv
+from client_pool import TelegramLoop, ClientPool, SESSION_INVALID_ERRORS
+from scheduler import TelegramScheduler, parse_rate_limits, in_lane, telegram_lane, INTERACTIVE, BACKGROUND
+from media_cache import MediaCache, ThumbnailCache
+from media_index import MediaIndex, MediaIndexSyncer
+from storage import Storage, parse_type_map, media_id, split_media_id, chat_of, SAVED_MESSAGES
+from message_cache import MessageCache
+from metrics import MetricsRegistry, Counter, Histogram
+from transfers import TransferRegistry
+from parallel_upload import ParallelUploader, UploadPartError, UPLOAD_PART_SIZE
+from resumable_upload import UploadSessionStore
+from batch_upload import BatchUploader, read_multipart
+from upload_dedup import UploadDeduplicator, HashingSpooledFile
+from parallel_download import ParallelDownloader
+from zip_stream import ZipStreamEntry, stream_zip
+from preview import PreviewGenerator, image_width
+from prefetch import Prefetcher, PrefetchJob
+from session_store import SCOPED_TOKEN_HEADER, TICKET_PARAM, ServerSideSessionInterface, create_backend
+from live_updates import EventBroker, UpdateListeners, ListenerLimitReached
 
 # Load environment variables from .env file
 load_dotenv(override=True)
 
 # --- Flask App Setup ---
-app = Flask(__name__)
+class TeleDriveRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        """Uploaded files are hashed and measured while the form is parsed, for upload deduplication."""
+        return HashingSpooledFile()
+
+class TeleDriveFlask(Flask):
+    request_class = TeleDriveRequest
+
+    def async_to_sync(self, func):
+        """
+        Runs async views on the shared Telegram loop instead of a fresh event loop per request, so views,
+        the client pool and Pyrogram all live on one long-lived loop. The WSGI thread just waits for the result.
+        """
+        return lambda *args, **kwargs: telegram_loop.run_sync(func(*args, **kwargs))
+
+app = TeleDriveFlask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'a-very-strong-and-random-secret-key-change-me')
 
+# --- Server-Side Sessions ---
+# The cookie only carries an opaque session id; the data (including the Telegram session string) stays on the server
+app.session_interface = ServerSideSessionInterface(
+    create_backend(
+        os.getenv('SESSION_STORE', 'sqlite'), # memory (this process only), sqlite (shared by processes on this host) or redis
+        os.getenv('SESSION_SQLITE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions.sqlite3')),
+        os.getenv('SESSION_REDIS_URL', 'redis://localhost:6379/0'), # Any Redis-compatible server
+    ),
+    lifetime=float(os.getenv('SESSION_LIFETIME', 30 * 24 * 3600)), # Seconds a session survives without being used
+    cache_items=int(os.getenv('SESSION_CACHE_ITEMS', 10000)), # Sessions kept decoded in this process
+    cache_ttl=float(os.getenv('SESSION_CACHE_TTL', 5)), # Seconds before a cached session is re-read from the store
+)
+# Let a fronting nginx/Apache serve cached files itself (X-Sendfile) instead of the Python process
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', 'False').lower() in ('true', '1', 't')
+
 # --- CORS Configuration ---
 CORS(app, supports_credentials=True, origins=["http://localhost:3000", "http://127.0.0.1:3000"])
 
@@ -45,49 +105,491 @@ else:
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Progress callback adapted for logging
-def logging_progress(current, total, *args):
-    percentage = (current / total) * 100 if total > 0 else 0
-    log_now = False
-    if not hasattr(logging_progress, 'last_logged_percentage_map'):
-        logging_progress.last_logged_percentage_map = {} # Use a map if multiple transfers occur
+# --- Telegram Request Scheduler ---
+# Every Telegram request goes through per-account token buckets, e.g. TELEGRAM_RATE_LIMITS="download=40/80,history=10"
+# (requests per second/burst). Flood waits are slept out and retried if short enough, else raised as before.
+telegram_scheduler = TelegramScheduler(
+    limits=parse_rate_limits(os.getenv('TELEGRAM_RATE_LIMITS', '')),
+    max_flood_sleep=float(os.getenv('FLOOD_WAIT_MAX_SLEEP', 60)), # Longest wait slept out for background work
+    interactive_flood_sleep=float(os.getenv('FLOOD_WAIT_INTERACTIVE_SLEEP', 10)), # ...and while a user waits on it
+)
+telegram_scheduler.install()
+
+# --- Pooled Telegram Clients ---
+# All Pyrogram work runs on one long-lived event loop so connected clients can be reused across requests.
+telegram_loop = TelegramLoop()
+client_pool = ClientPool(
+    telegram_loop, api_id, api_hash,
+    max_clients=int(os.getenv('CLIENT_POOL_MAX_CLIENTS', 64)),
+    idle_timeout=float(os.getenv('CLIENT_POOL_IDLE_TIMEOUT', 600)), # Seconds before an unused client is disconnected
+    health_check_interval=float(os.getenv('CLIENT_POOL_HEALTH_CHECK_INTERVAL', 60)),
+    acquire_timeout=float(os.getenv('CLIENT_POOL_ACQUIRE_TIMEOUT', 30)),
+    scheduler=telegram_scheduler,
+)
+
+# Chunks (1MB each) read ahead of a streaming HTTP client; bounds memory per active stream
+STREAM_PREFETCH_CHUNKS = int(os.getenv('STREAM_PREFETCH_CHUNKS', 2))
 
-    # Using args to get a unique identifier if available, else default to generic
-    transfer_id = args[0] if args else "default_transfer"
+# --- Metrics and Transfers ---
+# Served at /metrics in the Prometheus text format; if METRICS_TOKEN is set, scrapers must send it as a Bearer token
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+metrics_registry = MetricsRegistry()
+http_request_seconds = metrics_registry.register(Histogram(
+    'teledrive_http_request_seconds', 'Time until the response headers are ready, per route.', ['route', 'method', 'status']))
+http_request_bytes = metrics_registry.register(Counter(
+    'teledrive_http_request_bytes_total', 'Request body bytes received, per route.', ['route']))
+http_response_bytes = metrics_registry.register(Counter(
+    'teledrive_http_response_bytes_total', 'Response body bytes with a known length, per route.', ['route']))
+metrics_registry.register(telegram_scheduler.latency)
+metrics_registry.register(client_pool.connect_seconds)
+# Live uploads and downloads for /transfers; finished ones are kept for a while, stalled ones retired
+transfers = TransferRegistry(
+    max_finished=int(os.getenv('TRANSFERS_KEEP_FINISHED', 100)),
+    stale_after=float(os.getenv('TRANSFER_STALE_AFTER', 300)), # Seconds without progress before a transfer counts as stalled
+)
 
-    last_logged = logging_progress.last_logged_percentage_map.get(transfer_id, -10) # Start below 0
+# --- Parallel Downloads ---
+# Ranges at least this large are fetched with several concurrent GetFile requests instead of one
+DOWNLOAD_PARALLEL_THRESHOLD = int(os.getenv('DOWNLOAD_PARALLEL_THRESHOLD', 16 * 1024 * 1024))
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 4)) # Concurrent 1MB chunk requests; 1 disables parallel downloads
+DOWNLOAD_CONNECTIONS = int(os.getenv('DOWNLOAD_CONNECTIONS', DOWNLOAD_WORKERS)) # Media sessions the workers share
+DOWNLOAD_WINDOW_CHUNKS = int(os.getenv('DOWNLOAD_WINDOW_CHUNKS', 8)) # Reorder buffer size; bounds memory per download
 
-    if percentage >= last_logged + 10 or current == total or current == 0 : # Log at start, end, or every 10%
-        log_now = True
+# --- Parallel Uploads ---
+# Files at least this large are split into parts sent concurrently over several media connections
+UPLOAD_PARALLEL_THRESHOLD = int(os.getenv('UPLOAD_PARALLEL_THRESHOLD', 10 * 1024 * 1024))
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 8)) # Parts in flight at once; 0 disables parallel uploads
+UPLOAD_CONNECTIONS = int(os.getenv('UPLOAD_CONNECTIONS', 4)) # Media sessions the workers share
+UPLOAD_PART_RETRIES = int(os.getenv('UPLOAD_PART_RETRIES', 3))
 
-    if log_now:
-        logging.info(f"Transfer '{transfer_id}': {current}/{total} bytes ({percentage:.2f}%)")
-        logging_progress.last_logged_percentage_map[transfer_id] = percentage
-    
-    if current == total: # Reset for this specific transfer
-        if transfer_id in logging_progress.last_logged_percentage_map:
-            del logging_progress.last_logged_percentage_map[transfer_id]
+# Resumable uploads live in memory; an upload untouched for this long is forgotten
+upload_sessions = UploadSessionStore(ttl=float(os.getenv('RESUMABLE_UPLOAD_TTL', 86400)))
+RESUMABLE_UPLOAD_MAX_BYTES = 4000 * 1024 * 1024 # Telegram's limit for premium accounts
+
+# Batch uploads: files of one multipart request uploaded concurrently over one set of connections
+BATCH_UPLOAD_CONCURRENCY = int(os.getenv('BATCH_UPLOAD_CONCURRENCY', 4)) # Files uploading at once
+BATCH_UPLOAD_SPOOL_BYTES = int(os.getenv('BATCH_UPLOAD_SPOOL_BYTES', 4 * 1024 * 1024)) # Larger files spill to a temp file
+
+# Uploads whose bytes the user already has are re-sent by reference instead of uploaded again
+UPLOAD_DEDUP = os.getenv('UPLOAD_DEDUP', 'True').lower() in ('true', '1', 't')
+
+# --- On-Disk Media Cache ---
+# Set for cluster.py's workers, which share the cache directories: each file is downloaded by one of them
+# (claimed with a file lock) while the others follow, and the size budgets hold for the directory as a whole
+MEDIA_CACHE_SHARED = os.getenv('MEDIA_CACHE_SHARED', 'False').lower() in ('true', '1', 't')
+# Keyed by file_unique_id, which is stable for the same bytes across messages and sessions
+media_cache = MediaCache(
+    os.getenv('MEDIA_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media_cache')),
+    max_bytes=int(os.getenv('MEDIA_CACHE_MAX_BYTES', 2 * 1024**3)), # 0 disables the cache
+    max_file_bytes=int(os.getenv('MEDIA_CACHE_MAX_FILE_BYTES')) if os.getenv('MEDIA_CACHE_MAX_FILE_BYTES') else None,
+    shared=MEDIA_CACHE_SHARED,
+)
+# A request starting further than this past a fill's progress is streamed from Telegram directly
+MEDIA_CACHE_FOLLOW_WINDOW = 8 * 1024 * 1024
+
+# Thumbnails get their own budgets so large videos never push them out of the cache
+thumbnail_cache = ThumbnailCache(
+    MediaCache(os.getenv('THUMBNAIL_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thumbnail_cache')),
+               max_bytes=int(os.getenv('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024**2)), shared=MEDIA_CACHE_SHARED),
+    memory_max_bytes=int(os.getenv('THUMBNAIL_MEMORY_CACHE_MAX_BYTES', 64 * 1024**2)),
+)
+THUMBNAIL_CACHE_MAX_AGE = int(os.getenv('THUMBNAIL_CACHE_MAX_AGE', 86400)) # Browser cache lifetime in seconds
+THUMBNAIL_BATCH_MAX_IDS = 200 # messages.getMessages accepts up to 200 ids per call
+THUMBNAIL_BATCH_CONCURRENCY = int(os.getenv('THUMBNAIL_BATCH_CONCURRENCY', 8))
+
+# --- Preview Renditions ---
+# Smaller versions of images (WebP, needs Pillow) and videos (HLS, needs ffmpeg) for previewing on small screens
+preview_generator = PreviewGenerator(
+    MediaCache(os.getenv('PREVIEW_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'preview_cache')),
+               max_bytes=int(os.getenv('PREVIEW_CACHE_MAX_BYTES', 1024**3)), # 0 renders every request afresh
+               shared=MEDIA_CACHE_SHARED),
+    workers=int(os.getenv('PREVIEW_WORKERS', 2)), # Renders (ffmpeg processes or Pillow threads) at once
+    ffmpeg=os.getenv('PREVIEW_FFMPEG', 'ffmpeg'),
+    ffprobe=os.getenv('PREVIEW_FFPROBE', 'ffprobe'),
+    video_heights=[int(height) for height in os.getenv('PREVIEW_VIDEO_HEIGHTS', '360,720').split(',')],
+    segment_seconds=float(os.getenv('PREVIEW_SEGMENT_SECONDS', 6)),
+    timeout=float(os.getenv('PREVIEW_TIMEOUT', 120)), # Seconds one render may take
+)
+PREVIEW_IMAGE_MAX_SOURCE_BYTES = int(os.getenv('PREVIEW_IMAGE_MAX_SOURCE_BYTES', 64 * 1024 * 1024)) # Larger images aren't resized
+# Where ffmpeg fetches originals from: this server's own /stream_media, which it reads with Range requests.
+# A fixed loopback address; never taken from the request, whose Host header the client controls.
+PREVIEW_SOURCE_URL = os.getenv('PREVIEW_SOURCE_URL', f"http://127.0.0.1:{os.getenv('PORT', 5000)}").rstrip('/')
+atexit.register(preview_generator.close)
+
+# --- Message Cache ---
+# Resolved media messages per user, so media and thumbnail requests skip get_messages
+message_cache = MessageCache(
+    max_items=int(os.getenv('MESSAGE_CACHE_MAX_ITEMS', 10000)),
+    ttl=float(os.getenv('MESSAGE_CACHE_TTL', 1800)), # Seconds; file references go stale after a while
+)
+FILE_REFERENCE_ERRORS = (FileReferenceExpired, FileReferenceInvalid, FileReferenceEmpty)
+
+# --- Background Prefetch ---
+# After a listing, the thumbnails it showed (and optionally the start of the newest videos) are fetched into
+# the caches in the background lane, so the grid and the first seconds of playback come from disk
+PREFETCH_THUMBNAILS = os.getenv('PREFETCH_THUMBNAILS', 'True').lower() in ('true', '1', 't')
+PREFETCH_VIDEO_HEAD_BYTES = int(os.getenv('PREFETCH_VIDEO_HEAD_BYTES', 0)) # Bytes from the start of each video; 0 disables
+PREFETCH_RECENT_VIDEOS = int(os.getenv('PREFETCH_RECENT_VIDEOS', 3)) # Newest videos of the first page to fetch heads for
+prefetcher = Prefetcher(
+    workers=int(os.getenv('PREFETCH_WORKERS', 2)), # Prefetches running at once, across all users
+    budget_bytes=int(os.getenv('PREFETCH_USER_BUDGET_BYTES', 512 * 1024**2)), # Per user per window
+    budget_window=float(os.getenv('PREFETCH_BUDGET_WINDOW', 3600)), # Seconds
+)
+
+# --- Bulk Export ---
+EXPORT_CONCURRENCY = int(os.getenv('EXPORT_CONCURRENCY', 4)) # Files downloaded at once while building a ZIP
+EXPORT_BUFFER_CHUNKS = int(os.getenv('EXPORT_BUFFER_CHUNKS', 4)) # 1MB chunks buffered per file in flight
+EXPORT_MAX_FILES = int(os.getenv('EXPORT_MAX_FILES', 10000))
+
+@atexit.register
+def shutdown_client_pool():
+    try:
+        if telegram_loop.running:
+            telegram_loop.run_sync(update_listeners.close(), 10)
+    except Exception as e:
+        logging.warning(f"Error closing live update listeners: {e}")
+    try:
+        client_pool.shutdown()
+    except Exception as e:
+        logging.warning(f"Error closing pooled Telegram clients: {e}")
+    telegram_loop.stop()
 
+def telegram_api_configured() -> bool:
+    """Checks that the server has usable Telegram API credentials."""
+    if not api_id or not api_hash: # api_id is now int or None
+        logging.error("Cannot use Pyrogram Client: API ID or API Hash is missing or invalid.")
+        return False
+    return True
 
-def get_user_client():
+async def run_with_user_client(fn):
     """
-    Creates a Pyrogram client instance using the session string from the Flask session.
-    This function does NOT connect the client.
+    Runs ``await fn(client)`` with the current user's pooled, already-connected Pyrogram client.
+    The coroutine executes on the shared Telegram loop; do not disconnect the client inside it.
     """
-    session_string = session.get('telegram_session_string')
-    if not api_id or not api_hash: # api_id is now int or None
-        logging.error("Cannot create Pyrogram Client: API ID or API Hash is missing or invalid.")
-        return None
-    client = Client(name="user_session_in_memory", api_id=api_id, api_hash=api_hash, session_string=session_string, in_memory=True)
-    return client
+    return await client_pool.run(session.get('telegram_session_string'), fn)
+
+def start_transfer(kind: str, name: str, total: int = 0):
+    """Registers an upload or download by the current user in the /transfers registry."""
+    return transfers.start(kind, name, total, owner=client_pool.describe_key(session.get('telegram_session_string')))
+
+def generate_chunks(chunks, transfer=None):
+    """Helper function to pass chunks through to a streaming response, recording the transfer's progress."""
+    completed, error = False, None
+    try:
+        for chunk in chunks:
+            if transfer:
+                transfer.advance(len(chunk))
+            yield chunk
+        completed = True
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        if transfer:
+            transfer.finish(error or (None if completed else "Client went away."))
+
+async def agenerate_chunks(chunks, transfer=None):
+    """Async twin of generate_chunks, for response bodies iterated on the event loop by asgi.py."""
+    completed, error = False, None
+    try:
+        async for chunk in chunks:
+            if transfer:
+                transfer.advance(len(chunk))
+            yield chunk
+        completed = True
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        if transfer:
+            transfer.finish(error or (None if completed else "Client went away."))
+
+# Under asgi.py a view can hand the server an async body through the WSGI environ, which is then
+# streamed on the event loop instead of tying up a worker thread for the whole download
+ASYNC_BODY_ENVIRON_KEY = 'teledrive.async_body'
+
+def stream_response(stream, content_length=0, transfer_name=None, **response_kwargs) -> Response:
+    """A streaming Response over a PooledStream, iterated by a WSGI thread or directly on the ASGI loop."""
+    transfer = start_transfer('download', transfer_name, content_length) if transfer_name else None
+    response = Response(stream_with_context(generate_chunks(stream, transfer)), **response_kwargs)
+    response.call_on_close(stream.close) # Stop the download if the response is never fully consumed
+    request.environ[ASYNC_BODY_ENVIRON_KEY] = agenerate_chunks(stream, transfer) # Only one of the two is iterated
+    return response
+
+# --- HTTP Range Helpers ---
+TELEGRAM_CHUNK_SIZE = 1024 * 1024 # upload.GetFile works in 1MB chunks; stream_media offsets count these
+
+def resolve_byte_ranges(range_header, file_size: int) -> list[tuple[int, int]]:
+    """
+    Turns a parsed Range header into sorted, merged (start, stop) pairs with an exclusive stop.
+    Returns an empty list if no requested range overlaps the file (416).
+    """
+    resolved = []
+    for start, stop in range_header.ranges:
+        if start < 0: # Suffix range, e.g. "bytes=-500"
+            start, stop = max(file_size + start, 0), file_size
+        else:
+            stop = file_size if stop is None else min(stop, file_size)
+        if start < stop:
+            resolved.append((start, stop))
+    resolved.sort()
+
+    merged = [] # Coalesce overlapping/adjacent ranges so no byte is fetched twice
+    for start, stop in resolved:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def if_range_matches(etag: str = None, last_modified: datetime = None) -> bool:
+    """Evaluates If-Range: a Range header is only honoured if the representation hasn't changed."""
+    raw_if_range = request.headers.get('If-Range')
+    if not raw_if_range:
+        return True
+    if_range = request.if_range
+    if if_range.etag:
+        # Strong comparison only; a weak validator never matches
+        return bool(etag) and not raw_if_range.strip().startswith('W/') and if_range.etag == etag
+    if if_range.date and last_modified:
+        return int(if_range.date.timestamp()) == int(last_modified.timestamp())
+    return False
 
-def generate_chunks(buffer, chunk_size=1024*1024): # 1MB chunks for streaming
-    """Helper function to generate chunks from a file-like object for streaming."""
-    while True:
-        chunk = buffer.read(chunk_size)
-        if not chunk:
+async def iter_media_range(client, media, start: int, stop: int):
+    """Yields exactly bytes [start, stop) of a Telegram file, fetching only the chunks that cover them."""
+    first_chunk = start // TELEGRAM_CHUNK_SIZE
+    last_chunk = (stop - 1) // TELEGRAM_CHUNK_SIZE
+    position = first_chunk * TELEGRAM_CHUNK_SIZE
+    async for chunk in client.stream_media(media, offset=first_chunk, limit=last_chunk - first_chunk + 1):
+        chunk_start, position = position, position + len(chunk)
+        low, high = max(start - chunk_start, 0), min(stop - chunk_start, len(chunk))
+        if low < high:
+            yield chunk if (low, high) == (0, len(chunk)) else chunk[low:high]
+        if position >= stop:
             break
-        yield chunk
+
+def media_payload(message: Message):
+    """Returns the downloadable media object (Document, Video, Photo, ...) of a message."""
+    return message.document or message.video or message.audio or message.photo or \
+           message.voice or message.video_note or message.animation or message.sticker
+
+def iter_media_bytes(client, message: Message, start: int, stop: int):
+    """
+    Yields bytes [start, stop) of a message's media, over several connections when the range is large.
+    Bytes covered by a prefetched head (see prefetch_video_head) are read from the media cache instead.
+    """
+    if message.video and start < min(stop, PREFETCH_VIDEO_HEAD_BYTES) and media_head_key(media_payload(message)):
+        return iter_media_head(client, message, start, stop)
+    return iter_telegram_bytes(client, message, start, stop)
+
+def iter_telegram_bytes(client, message: Message, start: int, stop: int):
+    """Yields bytes [start, stop) of a message's media from Telegram, over several connections when the range is large."""
+    payload = media_payload(message)
+    if DOWNLOAD_WORKERS > 1 and stop - start >= DOWNLOAD_PARALLEL_THRESHOLD and getattr(payload, 'file_id', None):
+        downloader = ParallelDownloader(client, workers=DOWNLOAD_WORKERS, connections=DOWNLOAD_CONNECTIONS,
+                                        window=DOWNLOAD_WINDOW_CHUNKS)
+        return downloader.iter_range(payload.file_id, start, stop)
+    return iter_media_range(client, message, start, stop)
+
+async def iter_media_head(client, message: Message, start: int, stop: int):
+    """Yields bytes [start, stop) of a message's media: what the cached head holds from disk, the rest from Telegram."""
+    position = start
+    head_key = media_head_key(media_payload(message))
+    head_path = await asyncio.to_thread(lambda: media_cache.contains(head_key) and media_cache.lookup(head_key))
+    try:
+        head_file = await asyncio.to_thread(open, head_path, 'rb') if head_path else None
+    except FileNotFoundError: # Evicted since the lookup
+        head_file = None
+    if head_file is not None:
+        with head_file:
+            await asyncio.to_thread(head_file.seek, start)
+            while position < stop:
+                chunk = await asyncio.to_thread(head_file.read, min(TELEGRAM_CHUNK_SIZE, stop - position))
+                if not chunk:
+                    break
+                position += len(chunk)
+                yield chunk
+    if position < stop:
+        async for chunk in iter_telegram_bytes(client, message, position, stop):
+            yield chunk
+
+def multipart_part_header(start: int, stop: int, mime_type: str, file_size: int, boundary: str) -> bytes:
+    return (f"\r\n--{boundary}\r\nContent-Type: {mime_type}\r\n"
+            f"Content-Range: bytes {start}-{stop - 1}/{file_size}\r\n\r\n").encode('ascii')
+
+def multipart_closing(boundary: str) -> bytes:
+    return f"\r\n--{boundary}--\r\n".encode('ascii')
+
+async def iter_media_multipart(client, media, byte_ranges, mime_type: str, file_size: int, boundary: str):
+    """Yields a multipart/byteranges body for several ranges of one Telegram file."""
+    for start, stop in byte_ranges:
+        yield multipart_part_header(start, stop, mime_type, file_size, boundary)
+        async for chunk in iter_media_range(client, media, start, stop):
+            yield chunk
+    yield multipart_closing(boundary)
+
+def iter_fill_multipart(fill, byte_ranges, mime_type: str, file_size: int, boundary: str):
+    """Same as iter_media_multipart, but reading from a media cache fill in progress."""
+    for start, stop in byte_ranges:
+        yield multipart_part_header(start, stop, mime_type, file_size, boundary)
+        yield from fill.iter_range(start, stop)
+    yield multipart_closing(boundary)
+
+def multipart_byteranges_length(byte_ranges, mime_type: str, file_size: int, boundary: str) -> int:
+    """Exact Content-Length of the body produced by iter_media_multipart."""
+    total = len(multipart_closing(boundary))
+    for start, stop in byte_ranges:
+        total += len(multipart_part_header(start, stop, mime_type, file_size, boundary)) + (stop - start)
+    return total
+
+# --- Media Cache Helpers ---
+def pick_thumbnail_ref(message: Message):
+    """Returns the Thumbnail (or Photo) object to download as a message's preview, or None."""
+    # Determine the media payload that might contain thumbnails
+    media_payload = (message.video or message.document or message.audio or
+                     message.animation or message.voice or message.video_note or message.sticker)
+
+    if message.photo: # For photos, check .thumbs or use the photo itself
+        if message.photo.thumbs:
+            return message.photo.thumbs[-1] # Largest thumb from list
+        return message.photo # No explicit thumbs list, try photo object (Pyrogram might pick smallest size)
+    if media_payload and hasattr(media_payload, "thumbs") and media_payload.thumbs:
+        return media_payload.thumbs[-1] # Largest thumb from list
+    return None
+
+async def fetch_thumbnail_bytes(thumb_ref) -> bytes:
+    """Returns thumbnail bytes from the thumbnail cache, downloading them from Telegram on a miss."""
+    async def download():
+        thumb_buffer = await run_with_user_client(lambda client: client.download_media(thumb_ref, in_memory=True))
+        return thumb_buffer.getvalue()
+
+    thumb_key = getattr(thumb_ref, 'file_unique_id', None)
+    if not thumb_key:
+        return await download()
+    return await thumbnail_cache.get_or_fetch(thumb_key, download)
+
+def start_media_cache_fill(session_string: str, message: Message, cache_key: str, file_size: int):
+    """
+    Returns the single in-progress download of a file into the media cache, starting it if needed.
+    The download runs in the background and is cancelled once every reader has gone away.
+    """
+    fill, created = media_cache.get_or_create_fill(cache_key, file_size)
+    if created:
+        async def download(client):
+            nonlocal message
+            for attempt in range(2):
+                try:
+                    chunks = (iter_media_bytes(client, message, fill.written, file_size) if file_size > 0
+                              else client.stream_media(message))
+                    async for chunk in chunks:
+                        await asyncio.to_thread(fill.write, chunk)
+                    return
+                except FILE_REFERENCE_ERRORS:
+                    if attempt or not file_size: # Can only resume when we know where the file ends
+                        raise
+                    # The message came from the message cache and its file reference went stale
+                    message = await client.get_messages(chat_of(message), message_ids=message.id)
+
+        async def run_fill():
+            try:
+                await client_pool.run(session_string, download)
+            except BaseException as e:
+                fill.abort(e if isinstance(e, Exception) else None)
+                if not isinstance(e, Exception):
+                    raise
+                logging.warning(f"Media cache fill for {cache_key} failed: {e}")
+            else:
+                await asyncio.to_thread(fill.finish)
+                logging.info(f"Media cache: stored {cache_key} ({file_size} bytes).")
+
+        fill.on_abandoned = telegram_loop.submit(run_fill()).cancel
+    return fill
+
+def media_head_key(payload):
+    """Media cache key of the prefetched first bytes of a file, stored apart from the whole file."""
+    file_unique_id = getattr(payload, 'file_unique_id', None)
+    return f"{file_unique_id}-head" if file_unique_id else None
+
+def prefetch_thumbnail(session_string: str, thumb_ref):
+    """A PrefetchJob that downloads a thumbnail into the thumbnail cache, or None if it's already there."""
+    thumb_key = getattr(thumb_ref, 'file_unique_id', None)
+    if not thumb_key or thumbnail_cache.contains(thumb_key):
+        return None
+
+    async def download():
+        thumb_buffer = await client_pool.run(session_string,
+                                             lambda client: client.download_media(thumb_ref, in_memory=True))
+        return thumb_buffer.getvalue()
+
+    async def run():
+        if await asyncio.to_thread(thumbnail_cache.contains, thumb_key): # A browser asked for it while it was queued
+            return 0
+        return len(await thumbnail_cache.get_or_fetch(thumb_key, download))
+
+    return PrefetchJob(f"thumbnail:{thumb_key}", getattr(thumb_ref, 'file_size', None) or 0, run)
+
+def prefetch_video_head(session_string: str, message: Message):
+    """
+    A PrefetchJob that downloads the first PREFETCH_VIDEO_HEAD_BYTES of a video into the media cache, or
+    None if there's nothing to do. A head is its own cache entry, which iter_media_bytes reads before going
+    to Telegram for the rest; a video no larger than the head is cached whole under its usual key instead.
+    """
+    payload = media_payload(message)
+    file_unique_id = getattr(payload, 'file_unique_id', None)
+    file_size = getattr(payload, 'file_size', None) or 0
+    length = min(PREFETCH_VIDEO_HEAD_BYTES, file_size)
+    cache_key = file_unique_id if length == file_size else media_head_key(payload)
+    if not file_unique_id or not media_cache.can_cache(length) or \
+            media_cache.contains(file_unique_id) or media_cache.contains(cache_key):
+        return None
+
+    fill = None
+    async def download(client):
+        async for chunk in iter_media_range(client, message, 0, length):
+            await asyncio.to_thread(fill.write, chunk)
+
+    def claim():
+        if media_cache.contains(file_unique_id) or media_cache.active_fill(file_unique_id):
+            return None, False # Somebody started watching it in the meantime
+        return media_cache.get_or_create_fill(cache_key, length)
+
+    async def run():
+        nonlocal fill
+        fill, created = await asyncio.to_thread(claim)
+        if not created:
+            return 0
+        try:
+            await client_pool.run(session_string, download)
+        except BaseException as e:
+            fill.abort(e if isinstance(e, Exception) else None)
+            raise
+        await asyncio.to_thread(fill.finish)
+        return length
+
+    return PrefetchJob(f"media:{cache_key}", length, run)
+
+async def schedule_listing_prefetch(session_string: str, owner_id: int, messages: list[Message], first_page: bool):
+    """Queues prefetches for a listing the user just received, replacing whatever was queued for their last one."""
+    def make_jobs(): # Checking what's already cached touches the disk
+        jobs = []
+        if PREFETCH_THUMBNAILS:
+            jobs += [prefetch_thumbnail(session_string, thumb_ref) for thumb_ref in map(pick_thumbnail_ref, messages) if thumb_ref]
+        if first_page and PREFETCH_VIDEO_HEAD_BYTES > 0: # Only the newest videos are likely to be played right away
+            videos = [message for message in messages if message.video][:PREFETCH_RECENT_VIDEOS]
+            jobs += [prefetch_video_head(session_string, message) for message in videos]
+        return [job for job in jobs if job]
+    jobs = await asyncio.to_thread(make_jobs)
+    if jobs:
+        prefetcher.schedule(owner_id, jobs)
+
+def send_cached_media(path: str, mime_type: str, download_name: str, etag: str = None, last_modified: datetime = None,
+                      as_attachment: bool = False):
+    """
+    Serves a cached file. send_file hands the open file to the server's wsgi.file_wrapper (sendfile where
+    supported, or X-Sendfile when USE_X_SENDFILE is on) and handles Range/If-Range/If-None-Match itself.
+    """
+    return send_file(path, mimetype=mime_type, download_name=download_name, conditional=True,
+                     etag=etag or True, last_modified=last_modified, as_attachment=as_attachment)
 
 # --- Helper Functions for MediaItem Structure ---
 def get_backend_base_url():
@@ -135,6 +637,27 @@ def parse_tags_from_caption(caption_text: str = None) -> list[str]:
         return []
     return re.findall(r"#(\w+)", caption_text)
 
+def build_upload_caption(file_name: str, tags_input_str: str = "") -> str:
+    """Builds an upload caption: the file name followed by its unique, sorted #tags."""
+    # Prepare caption with tags: Start with filename, then add #tags
+    caption_elements = [file_name]
+    if tags_input_str: # e.g., "tag1, tag2, #tag3"
+        # Split by comma or space, then ensure each tag is #-prefixed and unique
+        raw_tags = re.split(r'[\s,]+', tags_input_str)
+        processed_tags = set() # Use set for uniqueness
+        for tag in raw_tags:
+            if not tag: continue
+            clean_tag = tag.lstrip('#') # Remove existing # if any
+            if clean_tag: # Ensure tag is not empty after stripping
+                processed_tags.add(f"#{clean_tag}")
+        if processed_tags:
+            caption_elements.extend(sorted(list(processed_tags))) # Add sorted tags
+
+    final_caption = "\n".join(caption_elements)
+    if len(final_caption) > 1024: # Telegram caption limit for media
+        final_caption = final_caption[:1021] + "..." # Truncate if too long
+    return final_caption
+
 def format_file_size(size_bytes: int) -> str:
     """Formats file size in bytes to a human-readable string (KB, MB, GB)."""
     if not isinstance(size_bytes, (int, float)) or size_bytes < 0:
@@ -147,9 +670,10 @@ def format_file_size(size_bytes: int) -> str:
     s = round(size_bytes / p, 2)
     return f"{s} {size_name[i]}"
 
-async def create_media_item_from_message(message: Message) -> dict:
+def describe_media_message(message: Message, shard: int = 0) -> dict:
     """
-    Converts a Pyrogram Message object into the frontend MediaItem structure.
+    Extracts the raw metadata of a media message (raw byte size, MIME type, file_unique_id, ...) in storage
+    chat ``shard``. This is what the media index stores; media_item_from_record() turns it into a MediaItem.
     """
     if not message or not message.media:
         return None
@@ -214,30 +738,503 @@ async def create_media_item_from_message(message: Message) -> dict:
     elif pyrogram_media_type_enum == enums.MessageMediaType.PHOTO: # Photos can act as their own thumbnails
         has_thumbnail = True
     
-    BACKEND_BASE_URL = get_backend_base_url()
-    item_url = f"{BACKEND_BASE_URL}/stream_media/{item_id}"
-    thumb_url = f"{BACKEND_BASE_URL}/stream_thumbnail/{item_id}" if has_thumbnail else None
-    
     # Ensure timestamp is in milliseconds
     timestamp_ms = int(message.date.timestamp() * 1000) if message.date else int(time.time() * 1000)
-    
-    parsed_tags = parse_tags_from_caption(message.caption)
-    formatted_size = format_file_size(file_size_bytes)
 
     return {
-        'id': item_id,
+        'shard': shard,
+        'message_id': message.id,
         'name': file_name,
         'type': frontend_type,
+        'mime_type': mime_type,
+        'size': file_size_bytes,
+        'timestamp': timestamp_ms,
+        'caption': message.caption or '',
+        'tags': parse_tags_from_caption(message.caption),
+        'file_unique_id': actual_media_payload.file_unique_id,
+        'has_thumbnail': has_thumbnail,
+    }
+
+def media_item_from_record(record: dict, base_url: str = None) -> dict:
+    """
+    Builds the frontend MediaItem structure from describe_media_message() output.
+    Pass ``base_url`` when calling outside a request context (e.g. on the Telegram loop).
+    """
+    item_id = str(media_id(record.get('shard', 0), record['message_id']))
+    frontend_type = record['type']
+    BACKEND_BASE_URL = base_url or get_backend_base_url()
+    item_url = f"{BACKEND_BASE_URL}/stream_media/{item_id}"
+    thumb_url = f"{BACKEND_BASE_URL}/stream_thumbnail/{item_id}" if record['has_thumbnail'] else None
+
+    media_item = {
+        'id': item_id,
+        'name': record['name'],
+        'type': frontend_type,
         'url': item_url,
         'thumbnailUrl': thumb_url,
-        'timestamp': timestamp_ms,
-        'tags': parsed_tags,
-        'size': formatted_size,
+        'timestamp': record['timestamp'],
+        'tags': record['tags'],
+        'size': format_file_size(record['size']),
         'dataAiHint': frontend_type # Default AI hint to the determined type
     }
+    # Lower-resolution rendition for PreviewDialog, when the server has the tools to make one
+    if frontend_type == 'image' and preview_generator.images_available:
+        media_item['previewUrl'] = f"{BACKEND_BASE_URL}/preview/{item_id}/image"
+    elif frontend_type == 'video' and preview_generator.video_available:
+        media_item['previewUrl'] = f"{BACKEND_BASE_URL}/preview/{item_id}/video.m3u8"
+    return media_item
+
+async def create_media_item_from_message(message: Message, base_url: str = None, shard: int = 0) -> dict:
+    """
+    Converts a Pyrogram Message object from storage chat ``shard`` into the frontend MediaItem structure.
+    Pass ``base_url`` when calling outside a request context (e.g. on the Telegram loop).
+    """
+    record = describe_media_message(message, shard)
+    return media_item_from_record(record, base_url) if record else None
+
+# --- Media Listing Helpers ---
+LISTING_DEFAULT_PAGE_SIZE = 100
+LISTING_MAX_PAGE_SIZE = 1000
+LISTING_PREFETCH_ITEMS = 200 # Items buffered ahead of a slow client; about two history requests' worth
+LISTING_SHARD_BUFFER = 100 # Messages read ahead per storage chat while merging them into one listing
+
+def parse_timestamp_ms(value: str = None):
+    """Parses a Unix timestamp in milliseconds (the format MediaItem.timestamp uses) into a UTC datetime."""
+    if value is None or value == '':
+        return None
+    return datetime.fromtimestamp(int(value) / 1000, timezone.utc)
+
+def parse_listing_cursor(value: str = None):
+    """
+    Parses an offset_id/since value into {shard: message id}, or None if it is missing. Users with storage
+    channels get comma-separated media ids, one per shard; a plain message id is a Saved Messages cursor.
+    """
+    if value is None or value == '':
+        return None
+    return dict(split_media_id(int(part)) for part in value.split(',') if part.strip())
+
+def format_listing_cursor(message_ids: dict, sharded: bool):
+    """Inverse of parse_listing_cursor(); a plain message id (or null) unless the user has storage channels."""
+    if not sharded:
+        return message_ids.get(0) or None
+    return ','.join(str(media_id(shard, message_id)) for shard, message_id in sorted(message_ids.items())) or None
+
+async def iter_saved_media_messages(client, chat_id, page_size: int, offset_id: int = 0, since_id: int = 0,
+                                    from_date: datetime = None, to_date: datetime = None):
+    """
+    Yields up to ``page_size`` media messages from one storage chat, newest first. Telegram history is
+    fetched lazily in batches of 100 and iteration stops as soon as the page is full or a bound is crossed.
+    """
+    found = 0
+    history_kwargs = {'offset_id': offset_id}
+    if to_date:
+        history_kwargs['offset_date'] = to_date
+    async for message in client.get_chat_history(chat_id, **history_kwargs):
+        if since_id and message.id <= since_id:
+            break
+        if from_date and message.date and message.date.timestamp() < from_date.timestamp():
+            break
+        if not message.media: # Process only messages with media
+            continue
+        yield message
+        found += 1
+        if found >= page_size:
+            break
+
+async def iter_storage_media_messages(client, chats: dict, page_size: int, offsets: dict, since: dict,
+                                      from_date: datetime = None, to_date: datetime = None):
+    """
+    Yields up to ``page_size`` (shard, message) pairs from the storage chats in ``offsets`` ({shard: offset_id},
+    0 meaning the newest), newest first. Each chat's history is read concurrently and merged by date.
+    """
+    def history(shard):
+        return iter_saved_media_messages(client, chats[shard], page_size, offsets[shard], since.get(shard, 0),
+                                         from_date, to_date)
+
+    if len(offsets) == 1: # Nothing to merge
+        shard = next(iter(offsets))
+        async for message in history(shard):
+            yield shard, message
+        return
+
+    queues = {shard: asyncio.Queue(LISTING_SHARD_BUFFER) for shard in offsets}
+    async def read(shard):
+        try:
+            async for message in history(shard):
+                await queues[shard].put(message)
+        except Exception as e:
+            await queues[shard].put(e)
+        else:
+            await queues[shard].put(None)
+
+    heads = {} # shard -> newest message not yet yielded
+    async def advance(shard):
+        item = await queues[shard].get()
+        if isinstance(item, Exception):
+            raise item
+        if item is None:
+            heads.pop(shard, None)
+        else:
+            heads[shard] = item
+
+    readers = [asyncio.create_task(read(shard)) for shard in queues]
+    try:
+        for shard in queues:
+            await advance(shard)
+        for _ in range(page_size):
+            if not heads:
+                break
+            shard = max(heads, key=lambda shard: (heads[shard].date.timestamp() if heads[shard].date else 0, shard,
+                                                  heads[shard].id))
+            yield shard, heads[shard]
+            await advance(shard)
+    finally:
+        for reader in readers:
+            reader.cancel()
+
+async def reconcile_listing(owner_id: int, listed_ids: dict, offsets: dict, to_date: datetime = None):
+    """
+    Drops index rows of messages a listing page passed over without finding them, i.e. deleted in Telegram.
+    Each shard's page covers its history from the oldest message listed up to where it started: just below
+    offset_id, or the newest message listed when it started at the top or at to_date.
+    """
+    for shard, message_ids in listed_ids.items():
+        high_id = offsets[shard] - 1 if offsets.get(shard) and not to_date else message_ids[0]
+        removed = await asyncio.to_thread(media_index.reconcile, owner_id, shard, message_ids[-1], high_id,
+                                          set(message_ids))
+        if removed:
+            logging.info(f"Media index: dropped {len(removed)} messages of owner {owner_id} deleted in Telegram.")
+            forget_removed_messages(owner_id, shard, removed)
+
+class ListingPage:
+    """
+    Iterates the (shard, message_id, record) triples of a listing while keeping the cursors for the next
+    request: pass next_offset_id back as offset_id to get the next page (null means there is none) and
+    latest_id back as since to poll for new items. An error cuts the page short instead of propagating,
+    since the response headers are gone by then; it is reported in the envelope.
+    """
+
+    def __init__(self, listing_stream, page_size: int, offsets: dict, since: dict, sharded: bool = False):
+        self.listing_stream = listing_stream
+        self.page_size = page_size
+        self.sharded = sharded
+        self.count = 0
+        self.error = None
+        self.last_ids, self.latest_ids = dict(offsets), dict(since) # Per shard: where the next page starts, newest id seen
+
+    def __iter__(self):
+        try:
+            for shard, message_id, record in self.listing_stream:
+                yield record
+                self.count += 1
+                self.last_ids[shard] = message_id
+                self.latest_ids[shard] = max(self.latest_ids.get(shard, 0), message_id)
+        except Exception as e:
+            logging.error(f"Error while streaming media listing: {e}", exc_info=True)
+            self.error = 'Listing was interrupted; resume from next_offset_id.'
+
+    def envelope(self) -> dict:
+        """The cursors (and error, if any) that follow the items."""
+        more = self.count >= self.page_size or (self.error and self.count)
+        envelope = {
+            'next_offset_id': format_listing_cursor(self.last_ids, self.sharded) if more else None,
+            'latest_id': format_listing_cursor(self.latest_ids, self.sharded),
+        }
+        if self.error:
+            envelope['error'] = self.error
+        return envelope
+
+def generate_json_listing(page: ListingPage, base_url: str, paginated: bool = True):
+    """MediaItems as one JSON document, written while they arrive; paginated ones in an envelope with the cursors."""
+    yield '{"items":[' if paginated else '['
+    for record in page:
+        yield (',' if page.count else '') + json.dumps(media_item_from_record(record, base_url), separators=(',', ':'))
+    if paginated:
+        yield '],' + json.dumps(page.envelope(), separators=(',', ':'))[1:]
+    else:
+        yield ']'
+
+def generate_ndjson_listing(page: ListingPage, base_url: str):
+    """One MediaItem per line as they arrive, then a last line with the cursors."""
+    for record in page:
+        yield json.dumps(media_item_from_record(record, base_url), separators=(',', ':')) + '\n'
+    yield json.dumps(page.envelope(), separators=(',', ':')) + '\n'
+
+# Compact listings: one array per field instead of an object per item, raw byte sizes, numeric ids, and
+# relative URL templates sent once instead of two or three absolute URLs per item
+LISTING_COLUMNS = {
+    'id': lambda record: media_id(record.get('shard', 0), record['message_id']),
+    'name': lambda record: record['name'],
+    'type': lambda record: record['type'],
+    'size': lambda record: record['size'], # Bytes
+    'timestamp': lambda record: record['timestamp'],
+    'tags': lambda record: record['tags'],
+    'hasThumbnail': lambda record: record['has_thumbnail'],
+}
+
+def columnar_listing(page: ListingPage) -> dict:
+    columns = {name: [] for name in LISTING_COLUMNS}
+    for record in page:
+        for name, value in LISTING_COLUMNS.items():
+            columns[name].append(value(record))
+    urls = {'media': '/stream_media/{id}', 'thumbnail': '/stream_thumbnail/{id}'} # Relative to the backend
+    if preview_generator.images_available:
+        urls['imagePreview'] = '/preview/{id}/image'
+    if preview_generator.video_available:
+        urls['videoPreview'] = '/preview/{id}/video.m3u8'
+    return {'columns': columns, 'urls': urls, **page.envelope()}
+
+def generate_columnar_listing(page: ListingPage):
+    yield json.dumps(columnar_listing(page), separators=(',', ':'))
+
+def generate_msgpack_listing(page: ListingPage):
+    import msgpack # Optional dependency; checked before the format is accepted
+    yield msgpack.packb(columnar_listing(page))
+
+LISTING_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'columnar': 'application/json',
+    'msgpack': 'application/msgpack',
+}
+MSGPACK_AVAILABLE = importlib.util.find_spec('msgpack') is not None
+
+# --- Media Index ---
+# Server-side SQLite index of every media message, searched by /search without touching Telegram
+media_index = MediaIndex(os.getenv('MEDIA_INDEX_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media_index.sqlite3')))
+
+def forget_removed_messages(owner_id: int, shard: int, message_ids: list):
+    """After their index rows are gone: drops deleted messages from the message cache and tells open /events streams."""
+    for message_id in message_ids:
+        message_cache.invalidate(owner_id, message_id, shard)
+    event_broker.publish(owner_id, 'deleted', {'ids': [str(media_id(shard, message_id)) for message_id in message_ids]})
+
+media_index_syncer = MediaIndexSyncer(
+    media_index, describe_media_message, on_removed=forget_removed_messages,
+    validate_size=int(os.getenv('MEDIA_INDEX_VALIDATE_SIZE', 1000)), # Indexed messages re-checked per chat and sync
+)
+
+# --- Storage Shards ---
+# New uploads can be spread across private channels instead of piling up in Saved Messages (shard 0),
+# so each chat's history stays short; listings and index syncs read the chats concurrently
+storage = Storage(
+    media_index,
+    channels=int(os.getenv('STORAGE_CHANNELS', 0)), # Private channels per user; 0 keeps everything in Saved Messages
+    placement=os.getenv('STORAGE_PLACEMENT', 'hash'), # hash (of the file name), type or date
+    type_map=parse_type_map(os.getenv('STORAGE_TYPE_MAP', '')), # For placement=type, e.g. "video=1,image=2,*=3"
+    title=os.getenv('STORAGE_CHANNEL_TITLE', 'TeleDrive Storage'), # Channels are named "<title> <shard>"
+)
+upload_deduplicator = UploadDeduplicator(media_index, storage) if UPLOAD_DEDUP else None
+MEDIA_INDEX_SYNC_INTERVAL = float(os.getenv('MEDIA_INDEX_SYNC_INTERVAL', 60)) # Seconds between incremental syncs
+
+async def get_owner_id() -> int:
+    """Returns the current user's Telegram user id, looking it up once per session."""
+    owner_id = session.get('telegram_user_id')
+    if owner_id is None:
+        owner_id = await run_with_user_client(lambda client: client.storage.user_id())
+        session['telegram_user_id'] = owner_id
+    await storage.load(owner_id) # Views call storage.chats()/shard_of() right after, on the loop
+    return owner_id
+
+async def schedule_index_sync(session_string: str, owner_id: int, force: bool = False) -> bool:
+    """Starts a background sync of the user's index unless one is running or it synced recently."""
+    if not force:
+        state = await asyncio.to_thread(media_index.get_sync_state, owner_id)
+        if time.time() - state['synced_at'] < MEDIA_INDEX_SYNC_INTERVAL:
+            return False
+    if not media_index_syncer.claim(owner_id):
+        return False
+
+    async def sync():
+        try:
+            with telegram_lane(BACKGROUND): # Never competes with a user's streams for the rate limit
+                async def run_sync(client):
+                    await media_index_syncer.run_sync(client, owner_id, await storage.attach(client, owner_id))
+                await client_pool.run(session_string, run_sync)
+        except Exception as e:
+            logging.error(f"Media index sync for owner {owner_id} failed: {e}", exc_info=True)
+        finally:
+            media_index_syncer.release(owner_id)
+
+    telegram_loop.submit(sync())
+    return True
+
+def upload_shard(file_name: str) -> int:
+    """The storage shard a new upload of ``file_name`` goes to."""
+    return storage.place(file_name, to_frontend_file_type(mime_type_str=mimetypes.guess_type(file_name)[0]))
+
+async def get_saved_message(message_id: int, refresh: bool = False) -> Message:
+    """Returns a message by media id (see storage.media_id), from the message cache unless ``refresh`` is set."""
+    owner_id = await get_owner_id()
+    shard, chat_message_id = split_media_id(message_id)
+    if not refresh:
+        message = message_cache.get(owner_id, chat_message_id, shard)
+        if message is not None:
+            return message
+    chat_id = storage.chats(owner_id).get(shard)
+    if chat_id is None: # Not one of this user's shards
+        return None
+    async def fetch(client):
+        await storage.attach(client, owner_id)
+        return await client.get_messages(chat_id, message_ids=chat_message_id)
+    message = await run_with_user_client(fetch)
+    if message:
+        message_cache.put(owner_id, [message], shard) # Drops the entry instead if the message lost its media
+    else:
+        message_cache.invalidate(owner_id, chat_message_id, shard)
+    return message
+
+def get_cached_messages(owner_id: int, message_ids: list[int]) -> tuple:
+    """Looks media ids up in the message cache: returns ``({media id: Message}, {shard: [missing message ids]})``."""
+    chats = storage.chats(owner_id)
+    by_shard = {}
+    for message_id in message_ids:
+        shard, chat_message_id = split_media_id(message_id)
+        if shard in chats: # Ids of shards the user doesn't have can't resolve to anything
+            by_shard.setdefault(shard, []).append(chat_message_id)
+    found, missing = {}, {}
+    for shard, chat_message_ids in by_shard.items():
+        cached, missing_ids = message_cache.get_many(owner_id, chat_message_ids, shard)
+        found.update({media_id(shard, chat_message_id): message for chat_message_id, message in cached.items()})
+        if missing_ids:
+            missing[shard] = missing_ids
+    return found, missing
+
+async def fetch_storage_messages(client, owner_id: int, missing: dict) -> dict:
+    """Fetches {shard: [message ids]} from each storage chat concurrently and caches them; returns {media id: Message}."""
+    chats = await storage.attach(client, owner_id)
+    shards = list(missing)
+    results = await asyncio.gather(*(client.get_messages(chats[shard], message_ids=missing[shard]) for shard in shards))
+    found = {}
+    for shard, fetched in zip(shards, results):
+        message_cache.put(owner_id, fetched, shard)
+        found.update({media_id(shard, message.id): message for message in fetched if message})
+    return found
+
+async def get_saved_messages(message_ids: list[int]) -> dict:
+    """Resolves many media ids at once, fetching only the ones missing from the message cache; returns {media id: Message}."""
+    owner_id = await get_owner_id()
+    found, missing = get_cached_messages(owner_id, message_ids)
+    if missing:
+        found.update(await run_with_user_client(lambda client: fetch_storage_messages(client, owner_id, missing)))
+    return found
+
+# --- Live Updates ---
+# Browsers subscribe to /events (Server-Sent Events) instead of re-polling the listing. While a user has a
+# subscriber, a Telegram client of theirs receives updates and keeps the media index and message cache current.
+LIVE_UPDATES = os.getenv('LIVE_UPDATES', 'True').lower() in ('true', '1', 't')
+LIVE_UPDATES_KEEPALIVE = float(os.getenv('LIVE_UPDATES_KEEPALIVE', 15)) # Seconds between SSE comments on a quiet stream
+event_broker = EventBroker(
+    replay_events=int(os.getenv('LIVE_UPDATES_REPLAY_EVENTS', 100)), # Per user, for reconnects with Last-Event-ID
+)
+
+def storage_shard_of(owner_id: int, message) -> int:
+    """The storage shard an updated message is in, or None if it belongs to some other chat."""
+    chat_id = message.chat.id if message.chat else None
+    if chat_id is None or chat_id == owner_id: # Saved Messages; deletions in private chats carry no chat
+        return 0
+    return storage.shard_of(owner_id, message) or None
+
+async def publish_message_update(owner_id: int, message: Message, edited: bool):
+    shard = storage_shard_of(owner_id, message)
+    if shard is None:
+        return
+    record = describe_media_message(message, shard)
+    if record is None:
+        if edited: # The edit removed the media
+            await publish_deleted_messages(owner_id, [message])
+        return
+    message_cache.put(owner_id, [message], shard)
+    await asyncio.to_thread(media_index.upsert, owner_id, [record])
+    event_broker.publish(owner_id, 'updated' if edited else 'created', record)
+
+async def publish_deleted_messages(owner_id: int, messages: list):
+    by_shard = {}
+    for message in messages:
+        shard = storage_shard_of(owner_id, message)
+        if shard is not None:
+            by_shard.setdefault(shard, []).append(message.id)
+    for shard, message_ids in by_shard.items():
+        await asyncio.to_thread(media_index.delete, owner_id, message_ids, shard)
+        forget_removed_messages(owner_id, shard, message_ids)
+
+update_listeners = UpdateListeners(
+    api_id, api_hash, on_message=publish_message_update, on_deleted=publish_deleted_messages,
+    idle_timeout=float(os.getenv('LIVE_UPDATES_IDLE_TIMEOUT', 60)), # Seconds a listener outlives its last subscriber
+    max_listeners=int(os.getenv('LIVE_UPDATES_MAX_LISTENERS', 256)), # Users receiving updates at once
+    scheduler=telegram_scheduler, describe_key=client_pool.describe_key,
+)
+
+def format_server_sent_event(event_id: str, event: str, data, base_url: str) -> str:
+    if event in ('created', 'updated'):
+        data = media_item_from_record(data, base_url)
+    lines = [f"id: {event_id}"] if event_id else []
+    return '\n'.join(lines + [f"event: {event}", f"data: {json.dumps(data, separators=(',', ':'))}"]) + '\n\n'
+
+def begin_drain():
+    """
+    Called when this process is asked to stop (cluster.py's workers, on SIGTERM). Event streams never end on
+    their own, so they are finished and browsers reconnect to the replacement; downloads in flight carry on.
+    """
+    event_broker.close_all()
+
+# --- Bulk Export Helpers ---
+EXPORT_RESOLVE_BATCH = 200 # Message ids per get_messages call
+
+async def iter_cached_file(path: str):
+    """Reads a media cache file in 1MB chunks without blocking the event loop."""
+    with await asyncio.to_thread(open, path, 'rb') as f:
+        while chunk := await asyncio.to_thread(f.read, TELEGRAM_CHUNK_SIZE):
+            yield chunk
+
+async def iter_export_file(client, owner_id: int, message: Message, file_size: int):
+    """Yields a message's whole file, from the media cache when possible; refetches a stale file reference once."""
+    cached_path = await asyncio.to_thread(media_cache.lookup, getattr(media_payload(message), 'file_unique_id', None))
+    if cached_path:
+        async for chunk in iter_cached_file(cached_path):
+            yield chunk
+        return
+    sent = 0
+    for attempt in range(2):
+        try:
+            chunks = iter_media_bytes(client, message, 0, file_size) if file_size > 0 else client.stream_media(message)
+            async for chunk in chunks:
+                sent += len(chunk)
+                yield chunk
+            return
+        except FILE_REFERENCE_ERRORS:
+            if sent or attempt:
+                raise
+            message = await client.get_messages(chat_of(message), message_ids=message.id)
+            message_cache.put(owner_id, [message], storage.shard_of(owner_id, message))
+
+async def iter_export_entries(client, owner_id: int, message_ids: list[int]):
+    """Resolves media ids a batch at a time (from the message cache where possible) and yields a ZipStreamEntry per file."""
+    for batch_start in range(0, len(message_ids), EXPORT_RESOLVE_BATCH):
+        batch = message_ids[batch_start:batch_start + EXPORT_RESOLVE_BATCH]
+        found, missing = get_cached_messages(owner_id, batch)
+        if missing:
+            found.update(await fetch_storage_messages(client, owner_id, missing))
+        for message_id in batch:
+            message = found.get(message_id)
+            record = describe_media_message(message) if message else None
+            if record is None: # Deleted, or no longer has media
+                continue
+            yield ZipStreamEntry(record['name'], record['size'], message.date,
+                                 lambda message=message, size=record['size']: iter_export_file(client, owner_id, message, size))
 
 # --- Authentication Routes ---
+def auth_client(name: str, phone_number: str) -> Client:
+    """
+    A throwaway in-memory client for one sign-in step. It's rate-limited as its phone number's account,
+    so people signing in at the same time don't share (and wait on) one auth bucket.
+    """
+    client = Client(name=name, api_id=api_id, api_hash=api_hash, in_memory=True)
+    telegram_scheduler.register(client, f"phone {ClientPool.describe_key(phone_number)}")
+    return client
+
 @app.route('/send_code_request', methods=['POST'])
+@in_lane(INTERACTIVE) # Short flood waits are waited out; longer ones still return 429
 async def send_code_request():
     if not api_id or not api_hash:
         return jsonify({'error': 'Server not configured for Telegram API.'}), 500
@@ -248,7 +1245,7 @@ async def send_code_request():
     if not phone_number or not phone_number.replace('+', '').isdigit():
         return jsonify({'error': 'A valid phone number is required'}), 400
     
-    temp_client = Client(name="temp_auth_client", api_id=api_id, api_hash=api_hash, in_memory=True)
+    temp_client = auth_client("temp_auth_client", phone_number)
     try:
         await temp_client.connect()
         sent_code = await temp_client.send_code(phone_number)
@@ -270,6 +1267,7 @@ async def send_code_request():
             await temp_client.disconnect()
 
 @app.route('/sign_in', methods=['POST'])
+@in_lane(INTERACTIVE)
 async def sign_in():
     if not api_id or not api_hash:
         return jsonify({'error': 'Server not configured for Telegram API.'}), 500
@@ -287,13 +1285,15 @@ async def sign_in():
     phone_number = session['phone_number']
     phone_code_hash = session['phone_code_hash']
     
-    client_for_signin = Client(name="signin_client", api_id=api_id, api_hash=api_hash, in_memory=True)
+    client_for_signin = auth_client("signin_client", phone_number)
     try:
         await client_for_signin.connect()
         await client_for_signin.sign_in(phone_number, phone_code_hash, code)
 
+        app.session_interface.regenerate(session) # A fresh session id for the signed-in session
         session['telegram_session_string'] = await client_for_signin.export_session_string()
         session['telegram_authenticated'] = True # Mark as authenticated
+        session['telegram_user_id'] = await client_for_signin.storage.user_id() # Keys the media index
 
         session.pop('phone_number', None)
         session.pop('phone_code_hash', None)
@@ -317,16 +1317,18 @@ async def is_authenticated():
     if not session.get('telegram_session_string'):
         return jsonify({'authenticated': False, 'message': 'No session string found.'})
 
-    client = get_user_client()
-    if client is None: # Handles case where api_id/hash might be missing after startup
+    if not telegram_api_configured(): # Handles case where api_id/hash might be missing after startup
         return jsonify({'authenticated': False, 'error': 'Server Telegram API not configured.'}), 500
-    
+
+    async def check_authorized(client):
+        # The pool health-checks the connection; a stored user id means the session completed sign-in
+        return bool(await client.storage.user_id())
+
     try:
-        await client.connect()
-        is_auth = client.is_authorized
+        is_auth = await run_with_user_client(check_authorized)
         session['telegram_authenticated'] = is_auth # Update session flag
         return jsonify({'authenticated': is_auth})
-    except AuthKeyUnregistered:
+    except SESSION_INVALID_ERRORS:
         logging.warning("Auth key unregistered. Clearing session.")
         session.clear()
         return jsonify({'authenticated': False, 'error': 'Session is invalid. Please log in again.'})
@@ -334,27 +1336,30 @@ async def is_authenticated():
         logging.error(f"Error checking authentication status: {e}", exc_info=True)
         session['telegram_authenticated'] = False # Assume not authenticated on error
         return jsonify({'authenticated': False, 'error': 'Could not verify session with Telegram.'}), 500
-    finally:
-        if client and client.is_connected:
-            await client.disconnect()
 
 @app.route('/logout', methods=['POST'])
 async def logout():
-    client = get_user_client()
-    if client:
-        try:
-            await client.connect()
-            if client.is_authorized: # Only attempt logout if authorized
-                await client.log_out()
+    session_string = session.get('telegram_session_string')
+    if session_string and telegram_api_configured():
+        async def log_out(client):
+            if await client.storage.user_id(): # Only attempt logout if authorized
+                # Raw LogOut: Client.log_out() would also try to stop() a client that was never started
+                await client.invoke(raw.functions.auth.LogOut())
                 logging.info("User logged out from Telegram via Pyrogram.")
-        except AuthKeyUnregistered:
+
+        try:
+            await run_with_user_client(log_out)
+        except SESSION_INVALID_ERRORS:
             logging.info("Auth key was already unregistered during logout. Session was likely invalid.")
         except Exception as e:
             logging.error(f"Error during Pyrogram logout: {e}", exc_info=True)
             # Proceed to clear local session anyway
         finally:
-            if client.is_connected:
-                await client.disconnect()
+            await client_pool.discard(session_string)
+    if session.get('telegram_user_id') is not None:
+        prefetcher.cancel(session['telegram_user_id'])
+        await update_listeners.stop(session['telegram_user_id'])
+        event_broker.forget(session['telegram_user_id'])
     
     session.clear() # Clear local Flask session
     return jsonify({'message': 'Logged out successfully.'})
@@ -372,48 +1377,105 @@ async def get_saved_messages_media():
         else:
             return jsonify({'error': 'User not authenticated.'}), 401
 
-    client = get_user_client()
-    if client is None:
+    if not telegram_api_configured():
         return jsonify({'error': 'Server Telegram API not configured.'}), 500
-            
-    media_items_list = []
+
+    # Cursor parameters; without any of them the response stays a plain JSON array (first page)
     try:
-        await client.connect()
-        # Fetching history from "me" (Saved Messages)
-        async for message in client.get_chat_history("me", limit=100): # Adjust limit as needed
-            if message.media: # Process only messages with media
+        page_size = min(int(request.args.get('limit', LISTING_DEFAULT_PAGE_SIZE)), LISTING_MAX_PAGE_SIZE)
+        offset_ids = parse_listing_cursor(request.args.get('offset_id')) # Only messages older than these ids
+        since_ids = parse_listing_cursor(request.args.get('since')) or {} # Only messages newer than these ids
+        from_date = parse_timestamp_ms(request.args.get('from_date')) # Unix ms, inclusive
+        to_date = parse_timestamp_ms(request.args.get('to_date')) # Unix ms, exclusive
+    except ValueError:
+        return jsonify({'error': 'limit, offset_id, since, from_date and to_date must be integers.'}), 400
+    if page_size <= 0:
+        return jsonify({'error': 'limit must be positive.'}), 400
+    paginated = any(name in request.args for name in ('limit', 'offset_id', 'since', 'from_date', 'to_date'))
+    listing_format = request.args.get('format', 'json') # json, or ndjson, columnar or msgpack (always paginated)
+    if listing_format not in LISTING_FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(LISTING_FORMATS)}."}), 400
+    if listing_format == 'msgpack' and not MSGPACK_AVAILABLE:
+        return jsonify({'error': 'format=msgpack needs the msgpack package on the server.'}), 400
+
+    base_url = get_backend_base_url()
+    async def fetch_media_items(client):
+        listed_records, listed_messages = [], []
+        listed_ids = {} # shard -> ids of the media messages read, newest first and without gaps
+        try:
+            chats = await storage.attach(client, owner_id)
+            async for shard, message in iter_storage_media_messages(client, chats, page_size, offsets, since_ids,
+                                                                    from_date, to_date):
+                listed_ids.setdefault(shard, []).append(message.id)
                 try:
-                    media_item = await create_media_item_from_message(message)
-                    if media_item:
-                        media_items_list.append(media_item)
+                    record = describe_media_message(message, shard)
+                    if record:
+                        listed_records.append(record)
+                        listed_messages.append(message)
+                        message_cache.put(owner_id, [message], shard) # The stream routes will want it shortly
+                        yield shard, message.id, record
                 except Exception as e_media:
                     logging.error(f"Error processing message {message.id} into media item: {e_media}", exc_info=True)
-        
-        return jsonify(media_items_list)
-    except AuthKeyUnregistered:
+            # Only once the whole page went out; a listing the client abandoned isn't worth warming up for
+            await schedule_listing_prefetch(session_string, owner_id, listed_messages, first_page=offset_ids is None)
+        finally:
+            # Whatever we just listed is fresh; keep the index in step
+            await asyncio.to_thread(media_index.upsert, owner_id, listed_records)
+            await reconcile_listing(owner_id, listed_ids, offsets, to_date)
+
+    try:
+        owner_id = await get_owner_id()
+        session_string = session.get('telegram_session_string')
+        shards = storage.chats(owner_id)
+        # Every shard from its newest message, or where the cursor left each one; shards missing from it are done
+        offsets = {shard: 0 for shard in shards} if offset_ids is None else \
+                  {shard: message_id for shard, message_id in offset_ids.items() if shard in shards}
+        if not offsets:
+            offsets = {0: 0} if offset_ids is None else {}
+        listing_stream = await client_pool.open_stream(session_string, fetch_media_items,
+                                                       prefetch=LISTING_PREFETCH_ITEMS)
+        await listing_stream.prime() # Surface auth errors before the 200 goes out
+        page = ListingPage(listing_stream, page_size, offsets, since_ids, sharded=len(shards) > 1)
+        if listing_format == 'ndjson':
+            body = generate_ndjson_listing(page, base_url)
+        elif listing_format == 'columnar':
+            body = generate_columnar_listing(page)
+        elif listing_format == 'msgpack':
+            body = generate_msgpack_listing(page)
+        else:
+            body = generate_json_listing(page, base_url, paginated)
+        response = Response(stream_with_context(body), mimetype=LISTING_FORMATS[listing_format])
+        response.call_on_close(listing_stream.close)
+        return response
+    except SESSION_INVALID_ERRORS:
         logging.warning("Auth key unregistered while fetching media. Clearing session.")
         session.clear()
         return jsonify({'error': 'Session is invalid. Please log in again.'}), 401
     except Exception as e:
         logging.error(f"Error fetching saved messages media: {e}", exc_info=True)
         return jsonify({'error': 'An unexpected error occurred while fetching media.'}), 500
-    finally:
-        if client and client.is_connected:
-            await client.disconnect()
 
 @app.route('/stream_media/<int:message_id>', methods=['GET'])
+@in_lane(INTERACTIVE)
 async def stream_media(message_id):
+    return await serve_media(message_id)
+
+@app.route('/download_media/<int:message_id>', methods=['GET'])
+@in_lane(INTERACTIVE)
+async def download_media(message_id):
+    """Like /stream_media, but as an attachment download for saving (large) files locally."""
+    return await serve_media(message_id, as_attachment=True)
+
+async def serve_media(message_id: int, as_attachment: bool = False, refreshed: bool = False):
     if not session.get('telegram_authenticated'):
          return jsonify({'error': 'User not authenticated'}), 401
 
-    client = get_user_client()
-    if client is None:
+    if not telegram_api_configured():
         return jsonify({'error': 'Server Telegram API not configured.'}), 500
 
     try:
-        await client.connect()
-        # Fetch the specific message by ID from "me" (Saved Messages)
-        message = await client.get_messages("me", message_ids=message_id)
+        # Fetch the specific message by media ID from its storage chat, usually from the message cache
+        message = await get_saved_message(message_id, refresh=refreshed)
         
         if not message or not message.media:
             return jsonify({'error': 'Media not found or message has no media.'}), 404
@@ -423,8 +1485,7 @@ async def stream_media(message_id):
         mime_type = 'application/octet-stream' # Default
         suggested_filename = f"media_{message_id}"
 
-        payload = message.document or message.video or message.audio or message.photo or \
-                  message.voice or message.video_note or message.animation or message.sticker
+        payload = media_payload(message)
         
         if payload:
             if hasattr(payload, 'file_size') and payload.file_size:
@@ -437,87 +1498,498 @@ async def stream_media(message_id):
                 suggested_filename = f"photo_{message.id}.jpg"
 
 
-        # Use BytesIO as an in-memory buffer for downloading
-        media_buffer = io.BytesIO()
-        # Pyrogram's download_media can write to a file-like object
-        # Pass the message object itself; Pyrogram handles which part to download (e.g. largest photo)
-        await client.download_media(message, file_name=media_buffer, progress=logging_progress, progress_args=(f"msg_{message_id}",))
-        media_buffer.seek(0) # Rewind buffer to the beginning for reading
+        # Validators for conditional range requests: file_unique_id never changes for the same bytes
+        etag = getattr(payload, 'file_unique_id', None)
+        message_date = message.edit_date or message.date
+        last_modified = datetime.fromtimestamp(message_date.timestamp(), timezone.utc) if message_date else None
+
+        # Cache lookups stat files (and rescan the directory in shared mode), so keep them off the loop
+        cached_path = await asyncio.to_thread(media_cache.lookup, etag)
+        if cached_path: # Served from local disk; send_file takes care of Range and conditional headers
+            return await asyncio.to_thread(send_cached_media, cached_path, mime_type, suggested_filename,
+                                           etag, last_modified, as_attachment)
 
-        response = Response(stream_with_context(generate_chunks(media_buffer)), mimetype=mime_type)
+        # Work out which bytes to send: the whole file, one range (206) or several (206 multipart/byteranges)
+        byte_ranges = None
+        if file_size > 0 and request.range and request.range.units == 'bytes' and if_range_matches(etag, last_modified):
+            byte_ranges = resolve_byte_ranges(request.range, file_size)
+            if not byte_ranges:
+                response = jsonify({'error': 'Requested range not satisfiable.'})
+                response.status_code = 416
+                response.headers['Content-Range'] = f"bytes */{file_size}"
+                return response
+
+        # Uncached but cacheable: follow the one shared download into the cache unless the requested
+        # bytes are far ahead of it (e.g. seeking into a video), in which case fetch them directly
+        session_string = session.get('telegram_session_string')
+        fill = None
+        first_byte = byte_ranges[0][0] if byte_ranges else 0
+        if request.method != 'HEAD' and media_cache.can_cache(file_size):
+            def find_fill(): # Shared caches look for other processes' fills on disk
+                fill = media_cache.active_fill(etag)
+                if fill is None and first_byte < MEDIA_CACHE_FOLLOW_WINDOW:
+                    fill = start_media_cache_fill(session_string, message, etag, file_size)
+                return fill
+            fill = await asyncio.to_thread(find_fill)
+            if fill is not None and first_byte > fill.written + MEDIA_CACHE_FOLLOW_WINDOW:
+                fill = None
+
+        boundary = None
+        if byte_ranges is None or byte_ranges == [(0, file_size)]:
+            status, content_length, response_mimetype = 200, file_size, mime_type
+            make_chunks = lambda client: (iter_media_bytes(client, message, 0, file_size) if file_size > 0
+                                          else client.stream_media(message))
+            fill_chunks = lambda: fill.iter_range(0, file_size)
+        elif len(byte_ranges) == 1:
+            start, stop = byte_ranges[0]
+            status, content_length, response_mimetype = 206, stop - start, mime_type
+            make_chunks = lambda client: iter_media_bytes(client, message, start, stop)
+            fill_chunks = lambda: fill.iter_range(start, stop)
+        else:
+            boundary = uuid.uuid4().hex
+            status, response_mimetype = 206, f"multipart/byteranges; boundary={boundary}"
+            content_length = multipart_byteranges_length(byte_ranges, mime_type, file_size, boundary)
+            make_chunks = lambda client: iter_media_multipart(client, message, byte_ranges, mime_type, file_size, boundary)
+            fill_chunks = lambda: iter_fill_multipart(fill, byte_ranges, mime_type, file_size, boundary)
+
+        if request.method == 'HEAD': # Headers only; don't start a Telegram download
+            response = Response(status=status, mimetype=response_mimetype)
+        elif fill is not None:
+            response = Response(stream_with_context(generate_chunks(fill_chunks(), start_transfer('download', f"msg_{message_id}", content_length))),
+                                status=status, mimetype=response_mimetype)
+        else:
+            # Pipe Pyrogram's 1MB chunks straight into the response instead of buffering the whole file.
+            # Pass the message object itself; Pyrogram handles which part to download (e.g. largest photo)
+            media_stream = await client_pool.open_stream(session_string, make_chunks, prefetch=STREAM_PREFETCH_CHUNKS)
+            await media_stream.prime() # Surface Telegram errors before headers are sent
+
+            response = stream_response(media_stream, content_length, f"msg_{message_id}",
+                                       status=status, mimetype=response_mimetype)
+        if content_length > 0:
+            response.headers['Content-Length'] = str(content_length)
         if file_size > 0:
-            response.headers['Content-Length'] = str(file_size)
+            response.headers['Accept-Ranges'] = 'bytes'
+        if status == 206 and boundary is None:
+            response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{file_size}"
+        if etag:
+            response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified
         
         # Content-Disposition to suggest filename
+        disposition = 'attachment' if as_attachment else 'inline'
         try:
             suggested_filename.encode('ascii') # Check if ASCII-safe
-            response.headers['Content-Disposition'] = f'inline; filename="{suggested_filename}"'
+            response.headers['Content-Disposition'] = f'{disposition}; filename="{suggested_filename}"'
         except UnicodeEncodeError: # Handle non-ASCII filenames
             encoded_name = base64.urlsafe_b64encode(suggested_filename.encode('utf-8')).decode('ascii')
-            response.headers['Content-Disposition'] = f"inline; filename*=UTF-8''{encoded_name}"
+            response.headers['Content-Disposition'] = f"{disposition}; filename*=UTF-8''{encoded_name}"
             
         return response
-    except AuthKeyUnregistered:
+    except SESSION_INVALID_ERRORS:
         logging.warning(f"Auth key unregistered while streaming media {message_id}. Clearing session.")
         session.clear()
         return jsonify({'error': 'Session is invalid. Please log in again.'}), 401
+    except FILE_REFERENCE_ERRORS as e:
+        if not refreshed: # The cached message's file reference went stale; refetch it and try once more
+            logging.info(f"File reference for message {message_id} expired ({e}); refetching the message.")
+            return await serve_media(message_id, as_attachment, refreshed=True)
+        logging.error(f"Error streaming media for message ID {message_id}: {e}", exc_info=True)
+        return jsonify({'error': 'An unexpected error occurred during streaming.'}), 500
+    except FloodWait as e: # Longer than the interactive lane waits out; don't hold the request for it
+        logging.warning(f"Flood wait while streaming media {message_id}: {e.value}s.")
+        return jsonify({'error': f'Too many requests. Try again in {e.value} seconds.'}), 429
     except Exception as e:
         logging.error(f"Error streaming media for message ID {message_id}: {e}", exc_info=True)
         return jsonify({'error': 'An unexpected error occurred during streaming.'}), 500
-    finally:
-        if client and client.is_connected:
-            await client.disconnect()
 
 @app.route('/stream_thumbnail/<int:message_id>', methods=['GET'])
-async def stream_thumbnail(message_id):
+@in_lane(BACKGROUND)
+async def stream_thumbnail(message_id, refreshed=False):
     if not session.get('telegram_authenticated'):
         return jsonify({'error': 'User not authenticated'}), 401
         
-    client = get_user_client()
-    if client is None:
+    if not telegram_api_configured():
         return jsonify({'error': 'Server Telegram API not configured.'}), 500
         
     try:
-        await client.connect()
-        message = await client.get_messages("me", message_ids=message_id)
+        message = await get_saved_message(message_id, refresh=refreshed)
         
         if not message or not message.media:
             return jsonify({'error': 'Media not found for this message ID.'}), 404
 
-        thumb_to_download_ref = None # This will hold the actual thumbnail object or Photo object
-
-        # Determine the media payload that might contain thumbnails
-        media_payload = (message.video or message.document or message.audio or
-                         message.animation or message.voice or message.video_note or message.sticker)
-
-        if message.photo: # For photos, check .thumbs or use the photo itself
-            if message.photo.thumbs:
-                thumb_to_download_ref = message.photo.thumbs[-1] # Largest thumb from list
-            else: # No explicit thumbs list, try photo object (Pyrogram might pick smallest size)
-                thumb_to_download_ref = message.photo
-        elif media_payload and hasattr(media_payload, "thumbs") and media_payload.thumbs:
-            thumb_to_download_ref = media_payload.thumbs[-1] # Largest thumb from list
-        
+        thumb_to_download_ref = pick_thumbnail_ref(message) # Thumbnail object or Photo object
         if not thumb_to_download_ref:
             logging.info(f"No suitable thumbnail found for message {message_id}, media type {message.media}")
             return jsonify({'error': 'Thumbnail not available for this media type.'}), 404
 
-        thumb_buffer = io.BytesIO()
-        # Download the specific thumbnail reference (which is a Thumbnail or Photo object)
-        await client.download_media(thumb_to_download_ref, file_name=thumb_buffer)
-        thumb_buffer.seek(0)
-            
-        return Response(thumb_buffer.getvalue(), mimetype='image/jpeg') # Telegram thumbs are typically JPEG
-    except AuthKeyUnregistered:
+        thumb_data = await fetch_thumbnail_bytes(thumb_to_download_ref)
+        response = Response(thumb_data, mimetype='image/jpeg') # Telegram thumbs are typically JPEG
+        thumb_key = getattr(thumb_to_download_ref, 'file_unique_id', None)
+        if thumb_key: # Same bytes for as long as the thumbnail's file_unique_id stays the same
+            response.set_etag(thumb_key)
+            response.headers['Cache-Control'] = f"private, max-age={THUMBNAIL_CACHE_MAX_AGE}"
+        return response.make_conditional(request) # 304 when the browser already has this ETag
+    except SESSION_INVALID_ERRORS:
         logging.warning(f"Auth key unregistered while streaming thumbnail {message_id}. Clearing session.")
         session.clear()
         return jsonify({'error': 'Session is invalid. Please log in again.'}), 401
+    except FILE_REFERENCE_ERRORS as e:
+        if not refreshed: # Stale file reference from the message cache; refetch and retry once
+            return await stream_thumbnail(message_id, refreshed=True)
+        logging.error(f"Error streaming thumbnail for message ID {message_id}: {e}", exc_info=True)
+        return jsonify({'error': 'An unexpected error occurred during thumbnail streaming.'}), 500
     except Exception as e:
         logging.error(f"Error streaming thumbnail for message ID {message_id}: {e}", exc_info=True)
         return jsonify({'error': 'An unexpected error occurred during thumbnail streaming.'}), 500
-    finally:
-        if client and client.is_connected:
-            await client.disconnect()
+
+@app.route('/stream_thumbnails', methods=['GET'])
+@in_lane(BACKGROUND)
+async def stream_thumbnails():
+    """
+    Returns many thumbnails in one multipart/mixed response, e.g. /stream_thumbnails?ids=12,13,14.
+    Each part carries Content-ID: <message_id> and the thumbnail's ETag; ids without a thumbnail are
+    listed in the X-Missing-Thumbnails header.
+    """
+    if not session.get('telegram_authenticated'):
+        return jsonify({'error': 'User not authenticated'}), 401
+
+    if not telegram_api_configured():
+        return jsonify({'error': 'Server Telegram API not configured.'}), 500
+
+    try:
+        message_ids = list(dict.fromkeys(int(part) for part in request.args.get('ids', '').split(',') if part.strip()))
+    except ValueError:
+        return jsonify({'error': 'ids must be a comma-separated list of message IDs.'}), 400
+    if not message_ids:
+        return jsonify({'error': 'No message IDs provided.'}), 400
+    if len(message_ids) > THUMBNAIL_BATCH_MAX_IDS:
+        return jsonify({'error': f'At most {THUMBNAIL_BATCH_MAX_IDS} IDs per request.'}), 400
+
+    try:
+        # The message cache usually has them all; the rest are resolved in one round trip
+        messages = await get_saved_messages(message_ids)
+        thumb_refs = {message_id: pick_thumbnail_ref(message) for message_id, message in messages.items() if message.media}
+
+        semaphore = asyncio.Semaphore(THUMBNAIL_BATCH_CONCURRENCY)
+        async def fetch(message_id, thumb_ref):
+            async with semaphore:
+                try:
+                    try:
+                        return message_id, thumb_ref, await fetch_thumbnail_bytes(thumb_ref)
+                    except FILE_REFERENCE_ERRORS: # Stale file reference from the message cache
+                        message = await get_saved_message(message_id, refresh=True)
+                        thumb_ref = pick_thumbnail_ref(message) if message and message.media else None
+                        if not thumb_ref:
+                            return message_id, None, None
+                        return message_id, thumb_ref, await fetch_thumbnail_bytes(thumb_ref)
+                except SESSION_INVALID_ERRORS:
+                    raise
+                except Exception as e:
+                    logging.warning(f"Batch thumbnail for message {message_id} failed: {e}")
+                    return message_id, thumb_ref, None
+
+        results = await asyncio.gather(*(fetch(message_id, thumb_ref) for message_id, thumb_ref in thumb_refs.items() if thumb_ref))
+        thumbnails = {message_id: (thumb_ref, data) for message_id, thumb_ref, data in results if data is not None}
+
+        boundary = uuid.uuid4().hex
+        body = io.BytesIO()
+        for message_id in message_ids:
+            if message_id not in thumbnails:
+                continue
+            thumb_ref, data = thumbnails[message_id]
+            body.write(f"--{boundary}\r\nContent-Type: image/jpeg\r\nContent-ID: <{message_id}>\r\n".encode('ascii'))
+            if getattr(thumb_ref, 'file_unique_id', None):
+                body.write(f'ETag: "{thumb_ref.file_unique_id}"\r\n'.encode('ascii'))
+            body.write(f"Content-Length: {len(data)}\r\n\r\n".encode('ascii'))
+            body.write(data)
+            body.write(b"\r\n")
+        body.write(f"--{boundary}--\r\n".encode('ascii'))
+
+        response = Response(body.getvalue(), content_type=f"multipart/mixed; boundary={boundary}")
+        missing = [str(message_id) for message_id in message_ids if message_id not in thumbnails]
+        if missing:
+            response.headers['X-Missing-Thumbnails'] = ','.join(missing)
+        response.headers['Cache-Control'] = f"private, max-age={THUMBNAIL_CACHE_MAX_AGE}"
+        return response
+    except SESSION_INVALID_ERRORS:
+        logging.warning("Auth key unregistered while streaming thumbnails. Clearing session.")
+        session.clear()
+        return jsonify({'error': 'Session is invalid. Please log in again.'}), 401
+    except Exception as e:
+        logging.error(f"Error streaming thumbnail batch: {e}", exc_info=True)
+        return jsonify({'error': 'An unexpected error occurred during thumbnail streaming.'}), 500
+
+@app.route('/search', methods=['GET'])
+async def search_media():
+    """
+    Searches the local media index, e.g. /search?q=holiday&tag=beach&type=image&min_size=1048576.
+    Never calls Telegram on the request path; an incremental sync is started in the background when due.
+    """
+    if not session.get('telegram_authenticated'):
+        return jsonify({'error': 'User not authenticated'}), 401
+
+    if not telegram_api_configured():
+        return jsonify({'error': 'Server Telegram API not configured.'}), 500
+
+    try:
+        limit = min(int(request.args.get('limit', LISTING_DEFAULT_PAGE_SIZE)), LISTING_MAX_PAGE_SIZE)
+        offset = int(request.args.get('offset', 0))
+        min_size = int(request.args['min_size']) if request.args.get('min_size') else None
+        max_size = int(request.args['max_size']) if request.args.get('max_size') else None
+    except ValueError:
+        return jsonify({'error': 'limit, offset, min_size and max_size must be integers.'}), 400
+    if limit <= 0 or offset < 0:
+        return jsonify({'error': 'limit must be positive and offset non-negative.'}), 400
+
+    try:
+        owner_id = await get_owner_id()
+        await schedule_index_sync(session.get('telegram_session_string'), owner_id)
+
+        started = time.perf_counter()
+        records = await asyncio.to_thread(
+            media_index.search, owner_id,
+            query=request.args.get('q', '').strip() or None, # Substring of the file name
+            prefix=request.args.get('prefix', '').strip() or None, # File name prefix
+            tags=[tag for value in request.args.getlist('tag') for tag in re.split(r'[\s,]+', value) if tag],
+            media_type=request.args.get('type') or None, # image, video, audio, document, archive, other
+            min_size=min_size, max_size=max_size, # Raw bytes
+            limit=limit, offset=offset,
+        )
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        backfilled = await asyncio.to_thread(lambda: all(media_index.get_sync_state(owner_id, shard)['backfill_complete']
+                                                         for shard in storage.chats(owner_id)))
+        base_url = get_backend_base_url()
+        return jsonify({
+            'items': [media_item_from_record(record, base_url) for record in records],
+            'next_offset': offset + limit if len(records) == limit else None,
+            'indexing': media_index_syncer.is_running(owner_id) or not backfilled,
+            'query_ms': round(elapsed_ms, 2),
+        })
+    except SESSION_INVALID_ERRORS:
+        logging.warning("Auth key unregistered while searching media. Clearing session.")
+        session.clear()
+        return jsonify({'error': 'Session is invalid. Please log in again.'}), 401
+    except Exception as e:
+        logging.error(f"Error searching media: {e}", exc_info=True)
+        return jsonify({'error': 'An unexpected error occurred while searching media.'}), 500
+
+@app.route('/export', methods=['GET', 'POST'])
+async def export_media():
+    """
+    Streams a ZIP of selected media, e.g. /export?ids=12,15,20 or /export?tag=beach&type=image&from_date=...
+    Filters are resolved against the media index (like /search). Files are fetched a few at a time and
+    written straight into the archive, so memory stays flat however many files are exported.
+    """
+    if not session.get('telegram_authenticated'):
+        return jsonify({'error': 'User not authenticated'}), 401
+
+    if not telegram_api_configured():
+        return jsonify({'error': 'Server Telegram API not configured.'}), 500
+
+    data = request.get_json(silent=True) or {} # POST with a JSON body, or the same fields as query parameters
+
+    def values(name, json_name=None) -> list[str]:
+        given = data.get(json_name or name)
+        if given is None:
+            return [part for value in request.values.getlist(name) for part in re.split(r'[\s,]+', value) if part]
+        return [str(part) for part in (given if isinstance(given, list) else re.split(r'[\s,]+', str(given))) if part]
+
+    def value(name):
+        return data.get(name, request.values.get(name)) or None
+
+    try:
+        message_ids = [int(message_id) for message_id in values('ids')]
+        min_timestamp = int(value('from_date')) if value('from_date') else None # Unix ms, inclusive
+        max_timestamp = int(value('to_date')) if value('to_date') else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'ids, from_date and to_date must be integers.'}), 400
+    tags, media_type, query = values('tag', 'tags'), value('type'), value('q')
+    if not message_ids and not (tags or media_type or query or min_timestamp or max_timestamp):
+        return jsonify({'error': 'Pass ids or at least one filter (tag, type, q, from_date, to_date).'}), 400
+
+    try:
+        owner_id = await get_owner_id()
+        if not message_ids:
+            await schedule_index_sync(session.get('telegram_session_string'), owner_id)
+            records = await asyncio.to_thread(
+                media_index.search, owner_id, query=query, tags=tags, media_type=media_type,
+                min_timestamp=min_timestamp, max_timestamp=max_timestamp, limit=EXPORT_MAX_FILES + 1)
+            message_ids = [media_id(record['shard'], record['message_id']) for record in records]
+        message_ids = list(dict.fromkeys(message_ids)) # Drop duplicates, keep order
+        if len(message_ids) > EXPORT_MAX_FILES:
+            return jsonify({'error': f"Too many files; an export holds at most {EXPORT_MAX_FILES}."}), 400
+        if not message_ids:
+            return jsonify({'error': 'No media matched.'}), 404
+
+        make_archive = lambda client: stream_zip(iter_export_entries(client, owner_id, message_ids),
+                                                 concurrency=EXPORT_CONCURRENCY, buffer_chunks=EXPORT_BUFFER_CHUNKS)
+        archive_stream = await client_pool.open_stream(session.get('telegram_session_string'), make_archive,
+                                                       prefetch=STREAM_PREFETCH_CHUNKS)
+        await archive_stream.prime() # Surface session errors before headers are sent
+
+        logging.info(f"Exporting {len(message_ids)} files as a ZIP for owner {owner_id}.")
+        response = stream_response(archive_stream, mimetype='application/zip')
+        response.headers['Content-Disposition'] = f'attachment; filename="teledrive-export-{time.strftime("%Y%m%d-%H%M%S")}.zip"'
+        response.headers['X-Export-Files'] = str(len(message_ids))
+        return response
+    except SESSION_INVALID_ERRORS:
+        logging.warning("Auth key unregistered while exporting media. Clearing session.")
+        session.clear()
+        return jsonify({'error': 'Session is invalid. Please log in again.'}), 401
+    except Exception as e:
+        logging.error(f"Error exporting media: {e}", exc_info=True)
+        return jsonify({'error': 'An unexpected error occurred while exporting media.'}), 500
+
+# --- Preview Endpoints ---
+def preview_source(message_id: int):
+    """
+    A function returning the URL from which ffmpeg reads a message's original (/stream_media) and the header
+    that admits it as the current user: a token for that path alone, issued when the render starts and
+    valid for PREVIEW_TIMEOUT seconds.
+    """
+    path, sid = f"/stream_media/{message_id}", session.sid
+    def source() -> tuple:
+        token = app.session_interface.scoped_token(app, sid, path, preview_generator.timeout)
+        return f"{PREVIEW_SOURCE_URL}{path}", f"{SCOPED_TOKEN_HEADER}: {token}"
+    return source
+
+def probe_source(message_id: int):
+    """
+    Like preview_source, for ffprobe, which takes no headers from stdin: a function returning a context
+    manager that yields the /stream_media URL with a ticket for that path alone in its query string. The
+    ticket is issued when the probe starts and revoked when it ends, so the command line (visible in ps)
+    holds nothing that still works.
+    """
+    path, sid = f"/stream_media/{message_id}", session.sid
+    @contextlib.contextmanager
+    def source():
+        ticket = app.session_interface.issue_ticket(sid, path, preview_generator.timeout)
+        try:
+            yield f"{PREVIEW_SOURCE_URL}{path}?{TICKET_PARAM}={ticket}"
+        finally:
+            app.session_interface.revoke_ticket(ticket)
+    return source
+
+def preview_response(data: bytes, mimetype: str, etag: str) -> Response:
+    response = Response(data, mimetype=mimetype)
+    response.set_etag(etag) # Renditions are keyed by file_unique_id, so they never change
+    response.headers['Cache-Control'] = f"private, max-age={THUMBNAIL_CACHE_MAX_AGE}"
+    return response.make_conditional(request)
+
+def preview_error(e: Exception, what: str, message_id: int):
+    if isinstance(e, SESSION_INVALID_ERRORS):
+        logging.warning(f"Auth key unregistered while rendering {what} for message {message_id}. Clearing session.")
+        session.clear()
+        return jsonify({'error': 'Session is invalid. Please log in again.'}), 401
+    logging.error(f"Error rendering {what} for message ID {message_id}: {e}", exc_info=True)
+    return jsonify({'error': f'An unexpected error occurred while rendering the {what}.'}), 500
+
+async def get_preview_video(message_id: int):
+    """Returns (file_unique_id, duration, width, height) of a video message, or None if it isn't one."""
+    message = await get_saved_message(message_id)
+    payload = media_payload(message) if message and message.media else None
+    if not payload or not (getattr(payload, 'mime_type', None) or '').startswith('video/'):
+        return None
+    duration, width, height = (getattr(payload, 'duration', None), getattr(payload, 'width', None),
+                               getattr(payload, 'height', None))
+    if not duration: # Videos sent as documents don't carry their dimensions; ask ffprobe, once per file
+        probed = await asyncio.to_thread(media_index.get_video_probe, payload.file_unique_id)
+        if probed is None:
+            probed = await preview_generator.probe(probe_source(message_id))
+            await asyncio.to_thread(media_index.save_video_probe, payload.file_unique_id, *probed)
+        duration, width, height = probed
+    return (payload.file_unique_id, duration, width, height) if duration else None
+
+@app.route('/preview/<int:message_id>/image', methods=['GET'])
+@in_lane(INTERACTIVE)
+async def preview_image(message_id, refreshed=False):
+    """A WebP copy of an image, at most ?width= pixels wide (rounded up to 640, 1280 or 1920; default 1280)."""
+    if not session.get('telegram_authenticated'):
+        return jsonify({'error': 'User not authenticated'}), 401
+    if not preview_generator.images_available:
+        return jsonify({'error': 'Image previews need Pillow installed on the server.'}), 501
+    try:
+        width = image_width(int(request.args.get('width', 1280)))
+    except ValueError:
+        return jsonify({'error': 'width must be an integer.'}), 400
+
+    try:
+        message = await get_saved_message(message_id, refresh=refreshed)
+        payload = media_payload(message) if message and message.media else None
+        mime_type = 'image/jpeg' if message and message.photo else (getattr(payload, 'mime_type', None) or '')
+        if not payload or not mime_type.startswith('image/'):
+            return jsonify({'error': 'No image preview for this message.'}), 404
+        if (payload.file_size or 0) > PREVIEW_IMAGE_MAX_SOURCE_BYTES:
+            return jsonify({'error': 'Image is too large to preview; open the original instead.'}), 413
+
+        async def load_source():
+            cached_path = await asyncio.to_thread(media_cache.lookup, payload.file_unique_id)
+            if cached_path:
+                return cached_path
+            image_buffer = await run_with_user_client(lambda client: client.download_media(message, in_memory=True))
+            return image_buffer.getvalue()
+
+        data = await preview_generator.image(payload.file_unique_id, width, load_source)
+        return preview_response(data, 'image/webp', f"{payload.file_unique_id}-w{width}")
+    except FILE_REFERENCE_ERRORS as e:
+        if not refreshed: # Stale file reference from the message cache; refetch and retry once
+            return await preview_image(message_id, refreshed=True)
+        return preview_error(e, 'image preview', message_id)
+    except Exception as e:
+        return preview_error(e, 'image preview', message_id)
+
+@app.route('/preview/<int:message_id>/video.m3u8', methods=['GET'])
+@in_lane(INTERACTIVE)
+async def preview_video(message_id):
+    """HLS master playlist listing the video's renditions (PREVIEW_VIDEO_HEIGHTS, never above the original)."""
+    if not session.get('telegram_authenticated'):
+        return jsonify({'error': 'User not authenticated'}), 401
+    if not preview_generator.video_available:
+        return jsonify({'error': 'Video previews need ffmpeg installed on the server.'}), 501
+    try:
+        video = await get_preview_video(message_id)
+        if not video:
+            return jsonify({'error': 'No video preview for this message.'}), 404
+        _, _, width, height = video
+        return Response(preview_generator.master_playlist(width, height), mimetype='application/vnd.apple.mpegurl')
+    except Exception as e:
+        return preview_error(e, 'video playlist', message_id)
+
+@app.route('/preview/<int:message_id>/video/<int:height>.m3u8', methods=['GET'])
+@in_lane(INTERACTIVE)
+async def preview_video_playlist(message_id, height):
+    """HLS playlist of one rendition. Its segments are transcoded when first requested."""
+    if not session.get('telegram_authenticated'):
+        return jsonify({'error': 'User not authenticated'}), 401
+    if not preview_generator.video_available:
+        return jsonify({'error': 'Video previews need ffmpeg installed on the server.'}), 501
+    try:
+        video = await get_preview_video(message_id)
+        if not video or height not in preview_generator.renditions(video[3]):
+            return jsonify({'error': 'No such video preview for this message.'}), 404
+        return Response(preview_generator.media_playlist(height, video[1]), mimetype='application/vnd.apple.mpegurl')
+    except Exception as e:
+        return preview_error(e, 'video playlist', message_id)
+
+@app.route('/preview/<int:message_id>/video/<int:height>/<int:segment>.ts', methods=['GET'])
+@in_lane(INTERACTIVE)
+async def preview_video_segment(message_id, height, segment):
+    if not session.get('telegram_authenticated'):
+        return jsonify({'error': 'User not authenticated'}), 401
+    if not preview_generator.video_available:
+        return jsonify({'error': 'Video previews need ffmpeg installed on the server.'}), 501
+    try:
+        video = await get_preview_video(message_id)
+        if (not video or height not in preview_generator.renditions(video[3])
+                or segment >= preview_generator.segment_count(video[1])):
+            return jsonify({'error': 'No such video segment.'}), 404
+        key, duration = video[0], video[1]
+        data = await preview_generator.segment(key, height, segment, preview_source(message_id), duration)
+        return preview_response(data, 'video/mp2t', f"{key}-v{height}-{segment}")
+    except Exception as e:
+        return preview_error(e, 'video segment', message_id)
 
 # --- File Upload Endpoint ---
 @app.route('/upload_file', methods=['POST'])
@@ -531,20 +2003,19 @@ async def upload_file():
         else:
             return jsonify({'error': 'User not authenticated.', "success": False}), 401
 
-    if 'file' not in request.files:
+    # Parsing a large multipart body is blocking I/O; keep it off the shared event loop
+    files = await asyncio.to_thread(lambda: request.files)
+    if 'file' not in files:
         return jsonify({'error': 'No file part in the request.', "success": False}), 400
     
-    file_storage = request.files['file'] # This is a FileStorage object
+    file_storage = files['file'] # This is a FileStorage object
     if file_storage.filename == '':
         return jsonify({'error': 'No selected file.', "success": False}), 400
 
-    client = get_user_client()
-    if client is None:
+    if not telegram_api_configured():
         return jsonify({'error': 'Server Telegram API not configured.', "success": False}), 500
 
     try:
-        await client.connect()
-
         file_stream = file_storage.stream # Get the underlying file stream
         original_filename = file_storage.filename
         # User might provide a different filename in form data
@@ -552,67 +2023,471 @@ async def upload_file():
         if not custom_filename: # Ensure filename is not empty
             custom_filename = original_filename # Fallback to original if provided is empty
 
-        tags_input_str = request.form.get('tags', '') # e.g., "tag1, tag2, #tag3"
-        
-        # Prepare caption with tags: Start with filename, then add #tags
-        caption_elements = [custom_filename]
-        if tags_input_str:
-            # Split by comma or space, then ensure each tag is #-prefixed and unique
-            raw_tags = re.split(r'[\s,]+', tags_input_str)
-            processed_tags = set() # Use set for uniqueness
-            for tag in raw_tags:
-                if not tag: continue
-                clean_tag = tag.lstrip('#') # Remove existing # if any
-                if clean_tag: # Ensure tag is not empty after stripping
-                    processed_tags.add(f"#{clean_tag}")
-            if processed_tags:
-                caption_elements.extend(sorted(list(processed_tags))) # Add sorted tags
-
-        final_caption = "\n".join(caption_elements)
-        if len(final_caption) > 1024: # Telegram caption limit for media
-            final_caption = final_caption[:1021] + "..." # Truncate if too long
-
-        # Use send_document as it's versatile. force_document=False lets Telegram try to show as photo/video.
-        sent_message = await client.send_document(
-            "me", # Send to "Saved Messages"
-            document=file_stream,
-            caption=final_caption,
-            file_name=custom_filename, # This ensures the filename is preserved
-            force_document=False, 
-            progress=logging_progress,
-            progress_args=(f"upload_{custom_filename}",) # Pass filename for progress tracking id
-        )
+        final_caption = build_upload_caption(custom_filename, request.form.get('tags', ''))
+
+        file_size = file_stream.size # Counted, like the hash, while the form was parsed (HashingSpooledFile)
+
+        owner_id = await get_owner_id()
+        shard = upload_shard(custom_filename)
+        async def target_chat(client):
+            chats = await storage.attach(client, owner_id, create=shard > 0)
+            return chats.get(shard, SAVED_MESSAGES)
+
+        content_hash = None
+        if upload_deduplicator and file_size:
+            content_hash = file_stream.sha256()
+            async def send_existing(client):
+                return await upload_deduplicator.send_existing(client, owner_id, content_hash, file_size, final_caption,
+                                                               await target_chat(client), custom_filename)
+            existing_message = await run_with_user_client(send_existing)
+            if existing_message:
+                return jsonify({
+                    "success": True,
+                    "message": "File already stored; sent it again without re-uploading.",
+                    "newItem": await create_media_item_from_message(existing_message,
+                                                                    shard=storage.shard_of(owner_id, existing_message)),
+                    "deduplicated": True
+                })
+
+        upload_stats = None
+        transfer = start_transfer('upload', f"upload_{custom_filename}", file_size)
+        try:
+            if UPLOAD_WORKERS > 0 and file_size >= UPLOAD_PARALLEL_THRESHOLD:
+                async def send_parallel(client):
+                    uploader = ParallelUploader(
+                        client, workers=UPLOAD_WORKERS, connections=UPLOAD_CONNECTIONS, max_retries=UPLOAD_PART_RETRIES,
+                        progress=transfer.progress,
+                    )
+                    message = await uploader.send_document(await target_chat(client), file_stream, custom_filename,
+                                                           final_caption)
+                    return message, uploader.stats
+                sent_message, upload_stats = await run_with_user_client(send_parallel)
+            else:
+                # Use send_document as it's versatile. force_document=False lets Telegram try to show as photo/video.
+                async def send(client):
+                    return await client.send_document(
+                        await target_chat(client), # Saved Messages or the storage channel placement picked
+                        document=file_stream,
+                        caption=final_caption,
+                        file_name=custom_filename, # This ensures the filename is preserved
+                        force_document=False,
+                        progress=transfer.progress,
+                    )
+                sent_message = await run_with_user_client(send)
+        except Exception as e:
+            transfer.finish(e)
+            raise
+        transfer.finish(None if sent_message else "Telegram returned no message.")
         
         if not sent_message:
             return jsonify({'error': 'Failed to upload file to Telegram.', "success": False}), 500
+        if content_hash:
+            await asyncio.to_thread(upload_deduplicator.remember, owner_id, content_hash, file_size, sent_message)
 
         # Convert the sent message to the MediaItem structure for the response
-        new_media_item = await create_media_item_from_message(sent_message)
+        new_media_item = await create_media_item_from_message(sent_message, shard=storage.shard_of(owner_id, sent_message))
         if not new_media_item:
              # This case should ideally not happen if upload was successful and create_media_item_from_message is robust
              logging.error(f"File uploaded (msg_id: {sent_message.id}), but could not process its details for response.")
              return jsonify({'error': 'File uploaded, but could not format its details for the response.', "success": False}), 500
         
-        logging.info(f"File '{custom_filename}' uploaded successfully by user to Saved Messages.")
-        return jsonify({
+        logging.info(f"File '{custom_filename}' uploaded successfully by user to storage shard {shard}.")
+        response_data = {
             "success": True,
-            "message": "File uploaded successfully to Saved Messages.",
+            "message": "File uploaded successfully.",
             "newItem": new_media_item
-        })
+        }
+        if upload_stats:
+            response_data["upload"] = upload_stats # Parts, retries and throughput of the parallel upload
+        return jsonify(response_data)
 
-    except AuthKeyUnregistered:
+    except SESSION_INVALID_ERRORS:
         logging.warning("Auth key unregistered during file upload. Clearing session.")
         session.clear()
         return jsonify({'error': 'Session is invalid. Please log in again.', "success": False}), 401
     except FloodWait as e:
         logging.warning(f"Flood wait during file upload: {e.value}s for user.")
         return jsonify({'error': f'Too many requests. Try again in {e.value} seconds.', "success": False}), 429
+    except UploadPartError as e:
+        logging.error(f"Parallel upload of '{file_storage.filename}' failed: {e}")
+        return jsonify({'error': f'Upload to Telegram failed: {str(e)}', "success": False}), 502
     except Exception as e:
         logging.error(f"Error uploading file '{file_storage.filename}': {e}", exc_info=True)
         return jsonify({'error': f'An unexpected error occurred during file upload: {str(e)}', "success": False}), 500
+
+@app.route('/upload_batch', methods=['POST'])
+async def upload_batch():
+    """
+    Uploads every file of one multipart/form-data request and streams one NDJSON line per file as it lands.
+    Files start uploading as soon as they have been received; ``tags`` fields apply to the files after them.
+    Pass ?group=true to send images and videos as albums of up to 10.
+    """
+    if not session.get('telegram_authenticated'):
+        return jsonify({'error': 'User not authenticated.', "success": False}), 401
+
+    if not telegram_api_configured():
+        return jsonify({'error': 'Server Telegram API not configured.', "success": False}), 500
+
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'error': 'Expected a multipart/form-data body.', "success": False}), 400
+
+    stream = request.stream # Read by a worker thread while the response is streaming
+    fields = {'tags': request.args.get('tags', '')}
+    base_url = get_backend_base_url()
+
+    def read_body(on_file):
+        read_multipart(stream, boundary.encode('latin1'), fields.__setitem__, on_file,
+                       spool_max_size=BATCH_UPLOAD_SPOOL_BYTES)
+
+    group = request.args.get('group', '').lower() in ('true', '1', 't')
+
+    def make_results(client, owner_id):
+        async def lines():
+            chats = await storage.attach(client, owner_id, create=True) # Creates missing storage channels, if any
+            uploader = BatchUploader(
+                client, chat_for=lambda file_name: chats.get(upload_shard(file_name), SAVED_MESSAGES),
+                caption_for=lambda file_name: build_upload_caption(file_name, fields.get('tags', '')),
+                describe=lambda message: create_media_item_from_message(message, base_url,
+                                                                        storage.shard_of(owner_id, message)),
+                concurrency=BATCH_UPLOAD_CONCURRENCY, part_workers=UPLOAD_WORKERS, connections=UPLOAD_CONNECTIONS,
+                max_retries=UPLOAD_PART_RETRIES, group=group, deduplicator=upload_deduplicator, owner_id=owner_id,
+            )
+            async for result in uploader.run(read_body):
+                yield json.dumps(result) + '\n'
+            yield json.dumps({'done': True, **uploader.stats}) + '\n'
+        return lines()
+
+    try:
+        owner_id = await get_owner_id()
+        results = await client_pool.open_stream(session.get('telegram_session_string'),
+                                                lambda client: make_results(client, owner_id),
+                                                prefetch=BATCH_UPLOAD_CONCURRENCY * 2)
+        await results.prime() # Surface session errors before headers are sent
+        return stream_response(results, mimetype='application/x-ndjson')
+    except SESSION_INVALID_ERRORS:
+        logging.warning("Auth key unregistered during batch upload. Clearing session.")
+        session.clear()
+        return jsonify({'error': 'Session is invalid. Please log in again.', "success": False}), 401
+    except Exception as e:
+        logging.error(f"Error during batch upload: {e}", exc_info=True)
+        return jsonify({'error': f'An unexpected error occurred during batch upload: {str(e)}', "success": False}), 500
+
+# --- Resumable Upload Endpoints ---
+def upload_status_response(upload, status=200):
+    response = jsonify(upload.describe())
+    response.status_code = status
+    response.headers['Upload-Offset'] = str(upload.offset)
+    response.headers['Upload-Length'] = str(upload.size)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+async def get_upload_session(upload_id: str):
+    """Returns the caller's upload session, or None if it does not exist, expired or is someone else's."""
+    if not session.get('telegram_authenticated'):
+        return None
+    return upload_sessions.get(upload_id, await get_owner_id())
+
+@app.route('/uploads', methods=['POST'])
+async def create_upload():
+    """Starts a resumable upload. JSON body: {"fileName": ..., "size": <bytes>, "tags": "optional, tags"}."""
+    if not session.get('telegram_authenticated'):
+        return jsonify({'error': 'User not authenticated.'}), 401
+
+    if not telegram_api_configured():
+        return jsonify({'error': 'Server Telegram API not configured.'}), 500
+
+    data = request.get_json(silent=True) or request.form
+    file_name = (data.get('fileName') or '').strip()
+    try:
+        size = int(data.get('size') or request.headers.get('Upload-Length', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'size must be an integer number of bytes.'}), 400
+    if not file_name:
+        return jsonify({'error': 'fileName is required.'}), 400
+    if not 0 < size <= RESUMABLE_UPLOAD_MAX_BYTES:
+        return jsonify({'error': f'size must be between 1 and {RESUMABLE_UPLOAD_MAX_BYTES} bytes.'}), 400
+
+    try:
+        upload = upload_sessions.create(await get_owner_id(), file_name, size, data.get('tags', ''))
+    except SESSION_INVALID_ERRORS:
+        session.clear()
+        return jsonify({'error': 'Session is invalid. Please log in again.'}), 401
+    logging.info(f"Resumable upload {upload.id} created for '{file_name}' ({size} bytes).")
+    response = upload_status_response(upload, 201)
+    response.headers['Location'] = f"/uploads/{upload.id}"
+    return response
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+async def get_upload_status(upload_id):
+    """Reports how many bytes of an upload the server has; resume by sending the rest from ``offset``."""
+    upload = await get_upload_session(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found or expired.'}), 404
+    return upload_status_response(upload)
+
+@app.route('/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+async def upload_chunk(upload_id):
+    """
+    Appends the raw request body at the offset given by the Upload-Offset header (or ?offset=).
+    Complete parts are sent to Telegram before the response, so the returned offset survives a dropped connection.
+    """
+    upload = await get_upload_session(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found or expired.'}), 404
+
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.args.get('offset', -1)))
+    except ValueError:
+        offset = -1
+    if offset < 0:
+        return jsonify({'error': 'Upload-Offset header or offset parameter is required.'}), 400
+    content_length = request.content_length
+    if content_length is not None and offset + content_length > upload.size:
+        return jsonify({'error': 'Chunk extends past the declared upload size.'}), 400
+
+    if not upload.lock.acquire(blocking=False):
+        return jsonify({'error': 'Another request for this upload is still in progress.'}), 409
+    transfer = None
+    try:
+        if offset != upload.offset:
+            return upload_status_response(upload, 409) # Tell the client where to resume
+
+        body = request.stream # Captured here; the body is read from the Telegram loop's worker threads
+        transfer = start_transfer('upload', f"upload_{upload.file_name}", content_length or upload.size - offset)
+        def read_body(size):
+            try:
+                data = body.read(size)
+            except ClientDisconnected:
+                return b'' # Keep whatever arrived; the client resumes from the new offset
+            transfer.advance(len(data))
+            return data
+
+        part_count = math.ceil((content_length or UPLOAD_PART_SIZE) / UPLOAD_PART_SIZE)
+        await run_with_user_client(lambda client: upload.receive(
+            ParallelUploader(client, workers=max(UPLOAD_WORKERS, 1),
+                             connections=min(UPLOAD_CONNECTIONS, part_count), max_retries=UPLOAD_PART_RETRIES),
+            read_body,
+        ))
+        transfer.finish()
+        return upload_status_response(upload)
+    except SESSION_INVALID_ERRORS:
+        logging.warning("Auth key unregistered during resumable upload. Clearing session.")
+        session.clear()
+        return jsonify({'error': 'Session is invalid. Please log in again.'}), 401
+    except UploadPartError as e:
+        logging.error(f"Resumable upload {upload_id}: {e}")
+        return upload_status_response(upload, 502)
+    except FloodWait as e:
+        logging.warning(f"Resumable upload {upload_id}: flood wait of {e.value}s; the client resumes later.")
+        return upload_status_response(upload, 429)
+    except Exception as e:
+        logging.error(f"Error receiving chunk for upload {upload_id}: {e}", exc_info=True)
+        return upload_status_response(upload, 500)
+    finally:
+        if transfer is not None:
+            transfer.finish("Chunk was not fully delivered.") # No-op if it already finished
+        upload.lock.release()
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+async def finalize_upload(upload_id):
+    """Sends a fully received upload to its storage chat and returns the new MediaItem, like /upload_file."""
+    upload = await get_upload_session(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found or expired.', "success": False}), 404
+
+    if not upload.lock.acquire(blocking=False):
+        return jsonify({'error': 'Another request for this upload is still in progress.', "success": False}), 409
+    try:
+        if not upload.complete:
+            return upload_status_response(upload, 409)
+
+        final_caption = build_upload_caption(upload.file_name, upload.tags)
+        owner_id = await get_owner_id()
+        shard = upload_shard(upload.file_name)
+        async def send(client):
+            chats = await storage.attach(client, owner_id, create=shard > 0)
+            return await ParallelUploader(client).send_input_file(
+                chats.get(shard, SAVED_MESSAGES), upload.input_file(), upload.file_name, final_caption)
+        sent_message = await run_with_user_client(send)
+        if not sent_message:
+            return jsonify({'error': 'Failed to upload file to Telegram.', "success": False}), 500
+        upload_sessions.remove(upload.id)
+        if upload_deduplicator and upload.content_hash:
+            await asyncio.to_thread(upload_deduplicator.remember, owner_id, upload.content_hash, upload.size, sent_message)
+
+        new_media_item = await create_media_item_from_message(sent_message, shard=storage.shard_of(owner_id, sent_message))
+        logging.info(f"Resumable upload {upload.id} of '{upload.file_name}' sent to storage shard {shard}.")
+        return jsonify({
+            "success": True,
+            "message": "File uploaded successfully.",
+            "newItem": new_media_item
+        })
+    except FilePartMissing as e:
+        # Telegram no longer has part of the file; the client re-sends from that part and finalizes again
+        logging.warning(f"Resumable upload {upload.id}: Telegram is missing part {e.value}.")
+        upload.rewind(e.value)
+        return upload_status_response(upload, 409)
+    except SESSION_INVALID_ERRORS:
+        logging.warning("Auth key unregistered while finalizing upload. Clearing session.")
+        session.clear()
+        return jsonify({'error': 'Session is invalid. Please log in again.', "success": False}), 401
+    except FloodWait as e:
+        return jsonify({'error': f'Too many requests. Try again in {e.value} seconds.', "success": False}), 429
+    except Exception as e:
+        logging.error(f"Error finalizing upload {upload_id}: {e}", exc_info=True)
+        return jsonify({'error': f'An unexpected error occurred while finalizing the upload: {str(e)}', "success": False}), 500
     finally:
-        if client and client.is_connected:
-            await client.disconnect()
+        upload.lock.release()
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+async def cancel_upload(upload_id):
+    upload = await get_upload_session(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found or expired.'}), 404
+    upload_sessions.remove(upload.id) # Parts already on Telegram expire there on their own
+    return '', 204
+
+# --- Live Update Endpoint ---
+@app.route('/events', methods=['GET'])
+async def live_events():
+    """
+    Server-Sent Events with the user's new ('created'), edited ('updated') and deleted ('deleted') media.
+    'resync' means events were missed and the client should list again.
+    """
+    if not session.get('telegram_authenticated'):
+        return jsonify({'error': 'User not authenticated'}), 401
+    if not LIVE_UPDATES:
+        return jsonify({'error': 'Live updates are disabled on this server.'}), 404
+    if not telegram_api_configured():
+        return jsonify({'error': 'Server Telegram API not configured.'}), 500
+
+    try:
+        owner_id = await get_owner_id()
+        listener = await update_listeners.acquire(owner_id, session.get('telegram_session_string'))
+    except SESSION_INVALID_ERRORS:
+        logging.warning("Auth key unregistered while starting live updates. Clearing session.")
+        session.clear()
+        return jsonify({'error': 'Session is invalid. Please log in again.'}), 401
+    except ListenerLimitReached as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        logging.error(f"Error starting live updates: {e}", exc_info=True)
+        return jsonify({'error': 'Could not start live updates.'}), 500
+
+    subscription = event_broker.subscribe(owner_id, request.headers.get('Last-Event-ID'))
+    base_url = get_backend_base_url()
+
+    def generate():
+        yield 'retry: 3000\n\n' # Reconnect delay for EventSource, in milliseconds
+        while not subscription.closed:
+            item = subscription.get(LIVE_UPDATES_KEEPALIVE)
+            yield format_server_sent_event(*item, base_url) if item else ': keepalive\n\n'
+
+    async def agenerate():
+        yield b'retry: 3000\n\n'
+        while not subscription.closed:
+            item = await subscription.aget(LIVE_UPDATES_KEEPALIVE)
+            yield (format_server_sent_event(*item, base_url) if item else ': keepalive\n\n').encode()
+
+    def close(): # Once per response; the subscription may already be closed by begin_drain()
+        subscription.close()
+        telegram_loop.submit(update_listeners.release(listener))
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Keep nginx from buffering the stream
+    response.call_on_close(close)
+    request.environ[ASYNC_BODY_ENVIRON_KEY] = agenerate() # Under asgi.py, waits on the loop instead of in a thread
+    return response
+
+# --- Metrics and Transfer Endpoints ---
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched' # Route templates keep label sets small
+    started = g.get('request_started')
+    if started is not None: # For streamed bodies this is the time to first byte, not the whole download
+        http_request_seconds.observe(time.monotonic() - started, route=route, method=request.method,
+                                     status=response.status_code)
+    if request.content_length:
+        http_request_bytes.inc(request.content_length, route=route)
+    if response.content_length:
+        http_response_bytes.inc(response.content_length, route=route)
+    return response
+
+def collect_component_metrics():
+    """Exports the stats() the pool, scheduler, caches and transfer registry already keep."""
+    pool = client_pool.stats()
+    yield 'teledrive_telegram_clients', 'gauge', 'Pooled Telegram clients, and how many are leased.', [
+        ({'state': 'connected'}, pool['clients']), ({'state': 'busy'}, pool['busy'])]
+    yield 'teledrive_telegram_media_sessions', 'gauge', 'Media sessions pooled clients keep open for parallel downloads.', [
+        ({}, pool['media_sessions'])]
+
+    transfer_stats = transfers.stats()
+    yield 'teledrive_active_transfers', 'gauge', 'Streams/downloads and uploads in progress.', [
+        ({'kind': kind}, transfer_stats['active'].get(kind, 0)) for kind in ('download', 'upload')]
+    yield 'teledrive_transfer_bytes_total', 'counter', 'Bytes moved by tracked transfers.', [
+        ({'kind': kind}, transfer_stats['bytes'].get(kind, 0)) for kind in ('download', 'upload')]
+    yield 'teledrive_transfers_finished_total', 'counter', 'Transfers that ended, by outcome.', [
+        ({'kind': kind, 'state': state}, count) for (kind, state), count in transfer_stats['finished'].items()]
+
+    yield 'teledrive_cache_hit_ratio', 'gauge', 'Share of cache lookups that were hits (NaN before any lookup).', [
+        ({'cache': 'media'}, media_cache.stats()['hit_ratio']),
+        ({'cache': 'thumbnail'}, thumbnail_cache.stats()['hit_ratio']),
+        ({'cache': 'message'}, message_cache.stats()['hit_ratio']),
+        ({'cache': 'preview'}, preview_generator.cache.stats()['hit_ratio']),
+        ({'cache': 'session'}, app.session_interface.stats()['hit_ratio']),
+    ]
+    yield 'teledrive_previews_rendered_total', 'counter', 'Preview renditions rendered, and renders that failed.', [
+        ({'kind': kind}, count) for kind, count in preview_generator.stats()['generated'].items()]
+
+    prefetch_stats = prefetcher.stats()
+    yield 'teledrive_prefetch_jobs', 'gauge', 'Background prefetches queued and running.', [
+        ({'state': state}, prefetch_stats[state]) for state in ('queued', 'running')]
+    yield 'teledrive_prefetch_jobs_total', 'counter', 'Background prefetches that ended, by outcome.', [
+        ({'state': state}, prefetch_stats[state]) for state in ('done', 'failed', 'cancelled', 'over_budget')]
+    yield 'teledrive_prefetch_bytes_total', 'counter', 'Bytes fetched into the caches by background prefetches.', [
+        ({}, prefetch_stats['bytes'])]
+
+    live_stats = event_broker.stats()
+    yield 'teledrive_live_update_subscribers', 'gauge', 'Open /events streams.', [({}, live_stats['subscribers'])]
+    yield 'teledrive_live_update_listeners', 'gauge', 'Telegram clients receiving updates for /events subscribers.', [
+        ({}, update_listeners.stats()['listeners'])]
+    yield 'teledrive_live_update_events_total', 'counter', 'Media events published to /events subscribers.', [
+        ({}, live_stats['published'])]
+
+    scheduler_stats = telegram_scheduler.stats()
+    lanes, methods = scheduler_stats['lanes'].items(), scheduler_stats['methods'].items()
+    yield 'teledrive_telegram_queue_depth', 'gauge', 'Telegram requests waiting for a rate-limit token, per lane.', [
+        ({'lane': lane}, values['waiting']) for lane, values in lanes]
+    yield 'teledrive_telegram_queue_wait_seconds_total', 'counter', 'Time Telegram requests spent queued, per lane.', [
+        ({'lane': lane}, values['wait_seconds']) for lane, values in lanes]
+    yield 'teledrive_telegram_requests_total', 'counter', 'Telegram requests sent, per method class.', [
+        ({'class': kind}, values['requests']) for kind, values in methods]
+    yield 'teledrive_telegram_flood_waits_total', 'counter', 'FloodWait errors received, per method class.', [
+        ({'class': kind}, values['flood_waits']) for kind, values in methods]
+    yield 'teledrive_telegram_flood_wait_seconds_total', 'counter', 'Seconds of FloodWait imposed, per method class.', [
+        ({'class': kind}, values['flood_wait_seconds']) for kind, values in methods]
+
+metrics_registry.add_collector(collect_component_metrics)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of request, Telegram, cache and transfer metrics."""
+    if METRICS_TOKEN and request.headers.get('Authorization', '') != f"Bearer {METRICS_TOKEN}":
+        return jsonify({'error': 'A valid metrics token is required.'}), 401
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/transfers', methods=['GET'])
+def list_transfers():
+    """The current user's uploads and downloads in progress, and the ones that finished recently, with live throughput."""
+    if not session.get('telegram_authenticated'):
+        return jsonify({'error': 'User not authenticated'}), 401
+    return jsonify(transfers.snapshot(owner=client_pool.describe_key(session.get('telegram_session_string'))))
 
 if __name__ == '__main__':
     # Determine debug mode from environment variable, default to True for dev
@@ -0,0 +1,241 @@
+"""
+ASGI entry point for the backend, with the same routes and JSON contracts as ``python app.py``:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+The server's event loop becomes the Telegram loop, so async views, the client pool and Pyrogram all
+run on that one long-lived loop. Flask's WSGI plumbing (routing, sessions, request parsing) runs on a
+bounded pool of worker threads, and media streams are sent straight from the loop without holding a
+thread for the length of the download.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, telegram_loop, client_pool, ASYNC_BODY_ENVIRON_KEY
+
+_END = object()
+
+
+class ASGIRequestBody:
+    """A blocking ``wsgi.input`` that pulls the ASGI request body on demand, so uploads are never buffered whole."""
+
+    def __init__(self, receive, loop: asyncio.AbstractEventLoop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self.complete = False
+        self.disconnected = False
+        self._completed = asyncio.Event() # Only ever set on the loop
+
+    async def prefetch(self, limit: int):
+        """
+        Buffers up to ``limit`` bytes before the app runs. Async views run on the loop itself, where a
+        blocking read would deadlock, so small bodies (JSON, forms) must already be here by then; views
+        that read large bodies do so from a worker thread (asyncio.to_thread).
+        """
+        while not self.complete and len(self._buffer) < limit:
+            self._accept(await self._receive())
+
+    async def wait_complete(self):
+        await self._completed.wait()
+
+    def _accept(self, message):
+        if message['type'] == 'http.disconnect':
+            self.disconnected = True # Short read; Werkzeug turns it into ClientDisconnected
+        else:
+            self._buffer += message.get('body', b'')
+        if message['type'] == 'http.disconnect' or not message.get('more_body', False):
+            self.complete = True
+            self._loop.call_soon_threadsafe(self._completed.set)
+
+    def _pull(self) -> bool:
+        """Waits for the next body message from a worker thread."""
+        if self.complete:
+            return False
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            raise RuntimeError("Large request bodies must be read off the event loop (e.g. with asyncio.to_thread).")
+        self._accept(asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result())
+        return True
+
+    def read(self, size=-1) -> bytes:
+        if size is None or size < 0:
+            while self._pull():
+                pass
+            size = len(self._buffer)
+        else:
+            while len(self._buffer) < size and self._pull():
+                pass
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, size=-1) -> bytes:
+        while b'\n' not in self._buffer and (size is None or size < 0 or len(self._buffer) < size) and self._pull():
+            pass
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        return self.read(end)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+class ASGIApplication:
+    """Serves a WSGI app over ASGI, streaming request and response bodies instead of buffering them."""
+
+    def __init__(self, wsgi_app, threads: int = 64, buffer_body_bytes: int = 1024 * 1024):
+        self.wsgi_app = wsgi_app
+        self.buffer_body_bytes = buffer_body_bytes
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi-wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else: # WebSockets are not part of the API
+            await send({'type': 'websocket.close', 'code': 1003})
+
+    async def _lifespan(self, receive, send):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._adopt_loop()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    await loop.run_in_executor(self.executor, client_pool.shutdown) # Waits on this very loop
+                except Exception as e:
+                    logging.warning(f"Error closing pooled Telegram clients: {e}")
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _adopt_loop(self):
+        if not telegram_loop.adopt(asyncio.get_running_loop()):
+            logging.warning("Telegram loop was already running in its own thread; ASGI requests will hop to it.")
+
+    async def _http(self, scope, receive, send):
+        self._adopt_loop() # In case the server does not speak the lifespan protocol
+        loop = asyncio.get_running_loop()
+        body = ASGIRequestBody(receive, loop)
+        environ = self._build_environ(scope, body)
+        await body.prefetch(self.buffer_body_bytes)
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start['status'] = int(status.split(' ', 1)[0])
+            response_start['headers'] = [(name.lower().encode('latin1'), value.encode('latin1'))
+                                         for name, value in headers]
+
+        # Every call into the app for this request shares one context: each may land on a different worker
+        # thread, and stream_with_context() resets context variables it set in an earlier one
+        context = contextvars.copy_context()
+        iterable = await loop.run_in_executor(self.executor, context.run, self.wsgi_app, environ, start_response)
+        async_body = environ.get(ASYNC_BODY_ENVIRON_KEY)
+        disconnected = asyncio.Event()
+        watcher = None
+        try:
+            iterator = iter(iterable)
+            first_chunk = b''
+            if not response_start: # start_response may be deferred until the first chunk
+                first_chunk = await loop.run_in_executor(self.executor, context.run, next, iterator, b'')
+            await send({'type': 'http.response.start', 'status': response_start['status'],
+                        'headers': response_start['headers']})
+            watcher = asyncio.ensure_future(self._watch_disconnect(body, receive, disconnected))
+
+            if first_chunk:
+                await send({'type': 'http.response.body', 'body': first_chunk, 'more_body': True})
+            if async_body is not None:
+                async for chunk in async_body:
+                    if disconnected.is_set():
+                        break
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            else:
+                while not disconnected.is_set():
+                    chunk = await loop.run_in_executor(self.executor, context.run, next, iterator, _END)
+                    if chunk is _END:
+                        break
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not disconnected.is_set():
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        except OSError: # The client went away mid-response
+            pass
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            if async_body is not None:
+                await async_body.aclose()
+            if hasattr(iterable, 'close'): # Runs Response.call_on_close callbacks, e.g. PooledStream.close
+                await loop.run_in_executor(self.executor, context.run, iterable.close)
+
+    @staticmethod
+    async def _watch_disconnect(body: ASGIRequestBody, receive, disconnected: asyncio.Event):
+        """
+        Sets ``disconnected`` when the client hangs up, so a long response stops being produced. Only
+        one reader may call receive(), so this waits until the app has read the whole request body
+        (a view may still be consuming it while its response streams, e.g. /upload_batch).
+        """
+        await body.wait_complete()
+        if body.disconnected:
+            disconnected.set()
+            return
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+
+    @staticmethod
+    def _build_environ(scope, body: ASGIRequestBody) -> dict:
+        script_name = scope.get('root_path', '').encode('utf8').decode('latin1')
+        path_info = scope['path'].encode('utf8').decode('latin1')
+        if path_info.startswith(script_name):
+            path_info = path_info[len(script_name):]
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': script_name,
+            'PATH_INFO': path_info,
+            'QUERY_STRING': scope['query_string'].decode('latin1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            key = name if name in ('CONTENT_LENGTH', 'CONTENT_TYPE') else f"HTTP_{name}"
+            value = value.decode('latin1')
+            separator = '; ' if key == 'HTTP_COOKIE' else ','
+            environ[key] = f"{environ[key]}{separator}{value}" if key in environ else value
+        if 'CONTENT_LENGTH' not in environ:
+            environ['wsgi.input_terminated'] = True # Chunked body; read until the client says it is done
+        return environ
+
+
+application = ASGIApplication(app, threads=int(os.getenv('ASGI_WSGI_THREADS', 64)))
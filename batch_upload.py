@@ -0,0 +1,270 @@
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+
+from parallel_upload import ParallelUploader, open_upload_sessions
+
+ALBUM_MAX_ITEMS = 10 # Telegram's limit for one grouped message
+READ_BLOCK_SIZE = 64 * 1024
+MAX_FIELD_BYTES = 64 * 1024 # Form fields are small options like tags; files go through on_file
+
+_DONE = object()
+
+
+class BatchAborted(Exception):
+    """Raised inside the body reader once the batch has been abandoned (e.g. the client went away)."""
+
+
+def read_multipart(stream, boundary: bytes, on_field, on_file, spool_max_size: int = 4 * 1024 * 1024):
+    """
+    Parses a multipart/form-data body from the blocking ``stream`` as it arrives. ``on_field(name, value)``
+    is called for each form field and ``on_file(file_name, fp, size, sha256)`` as soon as each file part
+    is complete, with ``fp`` a spooled temporary file positioned at 0 that the callee now owns and
+    ``sha256`` the hex digest of its bytes, hashed as they streamed in.
+    """
+    decoder = MultipartDecoder(boundary)
+    part, name, buffer, size, digest = None, None, None, 0, None
+    while True:
+        block = stream.read(READ_BLOCK_SIZE)
+        decoder.receive_data(block or None)
+        event = decoder.next_event()
+        while not isinstance(event, NeedData):
+            if isinstance(event, Field):
+                part, name, buffer = 'field', event.name, bytearray()
+            elif isinstance(event, File):
+                part, name, buffer, size = 'file', event.filename, tempfile.SpooledTemporaryFile(spool_max_size), 0
+                digest = hashlib.sha256()
+            elif isinstance(event, Data):
+                if part == 'field':
+                    buffer += event.data
+                    if len(buffer) > MAX_FIELD_BYTES:
+                        raise ValueError(f"Form field '{name}' is too large.")
+                    if not event.more_data:
+                        on_field(name, buffer.decode('utf-8', 'replace'))
+                elif part == 'file':
+                    buffer.write(event.data)
+                    digest.update(event.data)
+                    size += len(event.data)
+                    if not event.more_data:
+                        buffer.seek(0)
+                        on_file(name, buffer, size, digest.hexdigest())
+            elif isinstance(event, Epilogue):
+                return
+            event = decoder.next_event()
+        if not block:
+            raise ValueError("Request body ended before the multipart data did.")
+
+
+class BatchFile:
+    def __init__(self, index: int, file_name: str, fp, size: int, sha256: str = None, caption: str = ""):
+        self.index = index
+        self.file_name = file_name
+        self.fp = fp
+        self.size = size
+        self.sha256 = sha256
+        self.caption = caption # Built when the file arrived, from the form fields sent before it
+        self.input_file = None
+        self.uploader = None
+
+
+class BatchUploader:
+    """
+    Uploads the files of one multipart request while it is still being received. Files are handed
+    to ``concurrency`` workers as soon as each one has arrived; all of them send their parts over one
+    shared set of ``connections`` media sessions. With ``group`` set, images and videos are collected
+    into albums of up to 10 per chat and sent as grouped messages. Results are yielded as each file lands.
+    With a ``deduplicator`` (an UploadDeduplicator), files whose bytes ``owner_id`` already has are
+    re-sent by reference instead of uploaded.
+    """
+
+    def __init__(self, client, chat_for, caption_for, describe, concurrency=4, part_workers=8, connections=4,
+                 max_retries=3, group=False, deduplicator=None, owner_id=None):
+        self.client = client
+        self.chat_for = chat_for # file_name -> chat the file is sent to
+        self.caption_for = caption_for # file_name -> caption; called from the reader thread as each file arrives
+        self.describe = describe # async (message) -> MediaItem dict
+        self.concurrency = max(1, concurrency)
+        self.part_workers = max(1, part_workers)
+        self.connections = max(1, connections)
+        self.max_retries = max_retries
+        self.group = group
+        self.deduplicator = deduplicator
+        self.owner_id = owner_id
+        self.stats = {}
+
+    async def run(self, read_body):
+        """
+        Runs ``read_body(on_file)`` (blocking; e.g. read_multipart) in a worker thread and yields one
+        result dict per file: ``{"index", "fileName", "success", "newItem"}`` or ``{..., "error"}``.
+        """
+        loop = asyncio.get_running_loop()
+        received = asyncio.Queue() # Files waiting for a worker, then one None per worker once reading ends
+        room = threading.Semaphore(self.concurrency) # Bounds how many spooled files wait for a worker
+        results = asyncio.Queue()
+        album = {} # chat id -> files waiting to be sent together
+        abandoned = False
+        counter = 0
+        started = time.monotonic()
+        sessions = await open_upload_sessions(self.client, self.connections)
+
+        def on_file(file_name, fp, size, sha256=None):
+            nonlocal counter
+            room.acquire() # Waits while workers are busy
+            if abandoned:
+                fp.close()
+                raise BatchAborted()
+            item = BatchFile(counter, file_name, fp, size, sha256, self.caption_for(file_name or ''))
+            counter += 1
+            loop.call_soon_threadsafe(hand_over, item)
+
+        def hand_over(item): # On the loop, so it can't slip in after the cleanup below drained the queue
+            if abandoned:
+                item.fp.close()
+            else:
+                received.put_nowait(item)
+
+        async def read():
+            try:
+                await asyncio.to_thread(read_body, on_file)
+            except BatchAborted:
+                pass
+            except Exception as e:
+                logging.warning(f"Batch upload: reading the request failed: {e}")
+                await results.put({'success': False, 'error': f"Request body could not be read: {e}"})
+            finally:
+                for _ in range(self.concurrency):
+                    received.put_nowait(None)
+
+        async def worker():
+            while (item := await received.get()) is not None:
+                room.release()
+                await self._upload(item, sessions, album, results)
+
+        async def run_all():
+            try:
+                await asyncio.gather(reader, *workers)
+                for chat_id, items in album.items():
+                    while items:
+                        await self._send_album(chat_id, items[:ALBUM_MAX_ITEMS], results)
+                        del items[:ALBUM_MAX_ITEMS]
+            finally:
+                await results.put(_DONE)
+
+        reader = asyncio.create_task(read())
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        runner = asyncio.create_task(run_all())
+        uploaded = failed = deduplicated = 0
+        try:
+            while (result := await results.get()) is not _DONE:
+                if result['success']:
+                    uploaded += 1
+                    deduplicated += bool(result.get('deduplicated'))
+                else:
+                    failed += 1
+                yield result
+        finally:
+            abandoned = True
+            room.release(self.concurrency) # A reader thread waiting for room sees ``abandoned`` and stops
+            for task in (runner, *workers):
+                task.cancel()
+            while not received.empty():
+                item = received.get_nowait()
+                if item is not None:
+                    item.fp.close()
+            await asyncio.gather(runner, *workers, return_exceptions=True)
+            for items in album.values():
+                for item in items:
+                    item.fp.close()
+            await asyncio.gather(*(session.stop() for session in sessions), return_exceptions=True)
+            elapsed = time.monotonic() - started
+            self.stats = {'uploaded': uploaded, 'failed': failed, 'deduplicated': deduplicated, 'seconds': round(elapsed, 3)}
+            logging.info(f"Batch upload: {uploaded} files uploaded, {failed} failed in {elapsed:.1f}s "
+                         f"over {len(sessions)} connections.")
+
+    def _groupable(self, file_name: str) -> bool:
+        mime_type = self.client.guess_mime_type(file_name) or ''
+        return self.group and mime_type.startswith(('image/', 'video/'))
+
+    async def _upload(self, item: BatchFile, sessions, album: dict, results: asyncio.Queue):
+        keep_open = False
+        try:
+            if not item.file_name:
+                raise ValueError("File part has no file name.")
+            chat_id = self.chat_for(item.file_name)
+            if self.deduplicator and item.size:
+                message = await self.deduplicator.send_existing(self.client, self.owner_id, item.sha256, item.size,
+                                                                item.caption, chat_id, item.file_name)
+                if message:
+                    await results.put(await self._result(item, message, deduplicated=True))
+                    return
+            item.uploader = ParallelUploader(self.client, workers=self.part_workers, max_retries=self.max_retries,
+                                             sessions=sessions)
+            item.input_file = await item.uploader.upload(item.fp, item.file_name)
+            if self._groupable(item.file_name):
+                waiting = album.setdefault(chat_id, [])
+                waiting.append(item)
+                keep_open = True # Parts may need resending until the album is sent
+                if len(waiting) >= ALBUM_MAX_ITEMS:
+                    batch = waiting[:ALBUM_MAX_ITEMS]
+                    del waiting[:ALBUM_MAX_ITEMS]
+                    await self._send_album(chat_id, batch, results)
+                return
+            message = await item.uploader.send_input_file(
+                chat_id, item.input_file, item.file_name, item.caption,
+                resend_part=lambda part_index: item.uploader.resend_part(item.fp, part_index, item.file_name))
+            await results.put(await self._result(item, message))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Batch upload: '{item.file_name}' failed: {e}")
+            await results.put(self._error(item, e))
+        finally:
+            if not keep_open:
+                item.fp.close()
+
+    async def _send_album(self, chat_id, items: list, results: asyncio.Queue):
+        items = sorted(items, key=lambda item: item.index)
+        try:
+            if len(items) == 1: # An album needs at least two items
+                item = items[0]
+                message = await item.uploader.send_input_file(
+                    chat_id, item.input_file, item.file_name, item.caption,
+                    resend_part=lambda part_index: item.uploader.resend_part(item.fp, part_index, item.file_name))
+                await results.put(await self._result(item, message))
+                return
+            messages = await items[0].uploader.send_album(
+                chat_id, [(item.input_file, item.file_name, item.caption) for item in items],
+                resend_part=lambda item_index, part_index: items[item_index].uploader.resend_part(
+                    items[item_index].fp, part_index, items[item_index].file_name))
+            if len(messages) != len(items):
+                raise RuntimeError(f"Telegram returned {len(messages)} messages for an album of {len(items)}.")
+            for item, message in zip(items, messages):
+                await results.put(await self._result(item, message, album=True))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Batch upload: album of {len(items)} files failed: {e}")
+            for item in items:
+                await results.put(self._error(item, e))
+        finally:
+            for item in items:
+                item.fp.close()
+
+    async def _result(self, item: BatchFile, message, album: bool = False, deduplicated: bool = False) -> dict:
+        if self.deduplicator and not deduplicated:
+            await asyncio.to_thread(self.deduplicator.remember, self.owner_id, item.sha256, item.size, message)
+        result = {'index': item.index, 'fileName': item.file_name, 'success': True, 'newItem': await self.describe(message)}
+        if album:
+            result['album'] = True
+        if deduplicated:
+            result['deduplicated'] = True
+        return result
+
+    @staticmethod
+    def _error(item: BatchFile, error: Exception) -> dict:
+        return {'index': item.index, 'fileName': item.file_name, 'success': False, 'error': str(error)}
@@ -0,0 +1,183 @@
+"""
+Measures how many concurrent media streams the backend sustains under ``app.run`` (threaded WSGI)
+versus ``uvicorn asgi:application``, against the fake Telegram client in fake_telegram.py:
+
+    python benchmarks/concurrent_streams.py --streams 16,64,256 --file-mb 16
+
+For each server mode and concurrency level it opens N simultaneous GET /stream_media requests and
+reports completed streams, time to first byte, aggregate throughput and the server's peak thread
+count and RSS.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def serve(mode: str, port: int):
+    """Runs the backend with the fake client; prints a session cookie once it is importable."""
+    sys.path[:0] = [ROOT, os.path.dirname(os.path.abspath(__file__))]
+    import fake_telegram
+    fake_telegram.install()
+    import app
+    cookie = app.app.session_interface.create(
+        {'telegram_session_string': 'benchmark', 'telegram_authenticated': True, 'telegram_user_id': 42})
+    print(cookie, flush=True)
+    if mode == 'asgi':
+        import uvicorn
+        import asgi
+        uvicorn.run(asgi.application, host='127.0.0.1', port=port, log_level='warning', backlog=4096)
+    else:
+        app.app.run(host='127.0.0.1', port=port, threaded=True, debug=False)
+
+
+def process_stats(pid: int) -> dict:
+    stats = {}
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            name, _, value = line.partition(':')
+            if name in ('Threads', 'VmRSS'):
+                stats[name] = int(value.split()[0])
+    return stats
+
+
+async def fetch(port: int, path: str, cookie: str, timeout: float) -> dict:
+    started = time.monotonic()
+    result = {'ok': False, 'bytes': 0, 'ttfb': None}
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nCookie: session={cookie}\r\n"
+                     f"Connection: close\r\n\r\n".encode())
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        result['ttfb'] = time.monotonic() - started
+        await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+        while chunk := await asyncio.wait_for(reader.read(256 * 1024), timeout):
+            result['bytes'] += len(chunk)
+        result['ok'] = status_line.split()[1] in (b'200', b'206')
+        writer.close()
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, IndexError):
+        pass
+    result['seconds'] = time.monotonic() - started
+    return result
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def run_level(mode: str, port: int, cookie: str, server_pid: int, streams: int, expected_bytes: int, timeout: float):
+    peak = {'Threads': 0, 'VmRSS': 0}
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            try:
+                for name, value in process_stats(server_pid).items():
+                    peak[name] = max(peak[name], value)
+            except OSError:
+                return
+            done.wait(0.1)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    started = time.monotonic()
+
+    async def run_all():
+        # Distinct messages so no stream rides on another's cached message
+        return await asyncio.gather(*(fetch(port, f"/stream_media/{i + 1}", cookie, timeout) for i in range(streams)))
+
+    results = asyncio.run(run_all())
+    elapsed = time.monotonic() - started
+    done.set()
+    sampler.join()
+    completed = [r for r in results if r['ok'] and r['bytes'] >= expected_bytes]
+    ttfbs = [r['ttfb'] for r in results if r['ttfb'] is not None]
+    total_bytes = sum(r['bytes'] for r in results)
+    return {
+        'mode': mode,
+        'streams': streams,
+        'completed': len(completed),
+        'ttfb_p50_ms': round(percentile(ttfbs, 0.5) * 1000) if ttfbs else None,
+        'ttfb_p99_ms': round(percentile(ttfbs, 0.99) * 1000) if ttfbs else None,
+        'stream_p50_s': round(statistics.median(r['seconds'] for r in completed), 2) if completed else None,
+        'throughput_mbps': round(total_bytes * 8 / elapsed / 1_000_000, 1),
+        'peak_threads': peak['Threads'],
+        'peak_rss_mb': round(peak['VmRSS'] / 1024),
+    }
+
+
+def benchmark(mode: str, port: int, levels, args) -> list:
+    env = dict(os.environ,
+               TELEGRAM_API_ID=os.getenv('TELEGRAM_API_ID', '1'), TELEGRAM_API_HASH=os.getenv('TELEGRAM_API_HASH', 'fake'),
+               FAKE_TELEGRAM_FILE_BYTES=str(args.file_mb * 1024 * 1024),
+               FAKE_TELEGRAM_CHUNK_LATENCY=str(args.chunk_latency),
+               MEDIA_CACHE_MAX_BYTES='0', # Measure streaming, not the disk cache
+               DOWNLOAD_WORKERS='1', # One connection per stream; load_test.py's stream_parallel covers the rest
+               MEDIA_INDEX_PATH=os.path.join(args.workdir, f"media_index_{mode}.sqlite3"),
+               THUMBNAIL_CACHE_DIR=os.path.join(args.workdir, 'thumbnail_cache'),
+               CLIENT_POOL_MAX_CLIENTS='4',
+               SESSION_STORE='memory') # The benchmark session only has to outlive the run
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode, '--port', str(port)],
+                              env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        cookie = server.stdout.readline().strip()
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline: # Wait until the port accepts connections
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.2)
+        results = []
+        for streams in levels:
+            result = run_level(mode, port, cookie, server.pid, streams, args.file_mb * 1024 * 1024, args.timeout)
+            print(result, flush=True)
+            results.append(result)
+        return results
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default='threaded,asgi', help="Comma-separated: threaded (app.run) and/or asgi (uvicorn)")
+    parser.add_argument('--streams', default='16,64,256', help="Comma-separated concurrency levels")
+    parser.add_argument('--file-mb', type=int, default=16, help="Size of each streamed file")
+    parser.add_argument('--chunk-latency', type=float, default=0.02, help="Fake Telegram delay per 1 MiB chunk, in seconds")
+    parser.add_argument('--timeout', type=float, default=120, help="Per-stream read timeout, in seconds")
+    parser.add_argument('--port', type=int, default=5090)
+    parser.add_argument('--workdir', default=os.path.join(ROOT, 'benchmarks', '.work'))
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+    os.makedirs(args.workdir, exist_ok=True)
+    levels = [int(level) for level in args.streams.split(',')]
+    results = []
+    for offset, mode in enumerate(args.modes.split(',')):
+        results += benchmark(mode, args.port + offset, levels, args)
+
+    print(f"\n{'mode':<10}{'streams':>8}{'done':>6}{'ttfb p50':>10}{'ttfb p99':>10}{'stream p50':>12}"
+          f"{'Mbit/s':>9}{'threads':>9}{'RSS MB':>8}")
+    for r in results:
+        print(f"{r['mode']:<10}{r['streams']:>8}{r['completed']:>6}{str(r['ttfb_p50_ms']) + 'ms':>10}"
+              f"{str(r['ttfb_p99_ms']) + 'ms':>10}{str(r['stream_p50_s']) + 's':>12}{r['throughput_mbps']:>9}"
+              f"{r['peak_threads']:>9}{r['peak_rss_mb']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+An in-process stand-in for ``pyrogram.Client`` so the backend can be benchmarked without a Telegram
+account. ``install()`` patches it into the client pool; every session string then sees the same
+Saved Messages: ``FAKE_TELEGRAM_MESSAGES`` videos of ``FAKE_TELEGRAM_FILE_BYTES`` bytes each, plus
+whatever was uploaded since the server started. File ids are real, decodable ones, and
+``install()`` also fakes the raw media sessions, so the parallel download and upload paths
+(DOWNLOAD_WORKERS > 1, UPLOAD_WORKERS > 0) run against it too.
+
+Each simulated API request goes through the backend's request scheduler, like a real one would, and
+can be slowed down or refused with these environment variables:
+
+    FAKE_TELEGRAM_LATENCY          Seconds per request (history page, get_messages, send, ...)
+    FAKE_TELEGRAM_CHUNK_LATENCY    Seconds per 1 MiB download chunk or 512 KiB upload part
+    FAKE_TELEGRAM_BANDWIDTH        Bytes per second per transfer; 0 means unlimited
+    FAKE_TELEGRAM_CONNECT_LATENCY  Seconds per connect() (the MTProto handshake)
+    FAKE_TELEGRAM_FLOOD_EVERY      Every Nth request raises FloodWait; 0 disables
+    FAKE_TELEGRAM_FLOOD_SECONDS    The FloodWait's duration
+"""
+import asyncio
+import datetime
+import io
+import itertools
+import os
+import types
+
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+from pyrogram.file_id import FileId, FileType
+
+CHUNK_SIZE = 1024 * 1024 # upload.GetFile
+PART_SIZE = 512 * 1024 # upload.SaveFilePart
+HISTORY_PAGE_SIZE = 100 # messages.GetHistory
+DC_ID = 2 # Every fake file lives in the fake account's home DC
+
+
+def file_id(file_type: FileType, media_id: int) -> str:
+    """A Bot API style file id for a fake file, which ParallelDownloader can decode."""
+    return FileId(file_type=file_type, dc_id=DC_ID, media_id=media_id, access_hash=0, file_reference=b'').encode()
+
+
+class FakeMedia(types.SimpleNamespace):
+    """Attribute bag standing in for Pyrogram's Message, Video and Thumbnail types; unknown fields are None."""
+
+    def __getattr__(self, name):
+        return None
+
+
+class FakeQuery:
+    """Just enough of a raw function for the scheduler to classify it."""
+
+    def __init__(self, method: str):
+        self.QUALNAME = f"functions.{method}"
+
+
+class FakeStorage:
+    async def user_id(self):
+        return 42
+
+    async def dc_id(self):
+        return DC_ID
+
+    async def test_mode(self):
+        return False
+
+    async def auth_key(self):
+        return bytes(256)
+
+
+class FakeSession:
+    """Stands in for ``pyrogram.session.Session`` on the parallel paths: upload.GetFile and Save(Big)FilePart."""
+
+    def __init__(self, client, dc_id, auth_key, test_mode, is_media=False):
+        self.client = client
+        self.auth_key = auth_key
+
+    async def start(self):
+        await asyncio.sleep(self.client.connect_latency)
+
+    async def stop(self):
+        pass
+
+    async def invoke(self, query, *args, **kwargs):
+        method = query.QUALNAME.split('.', 1)[-1]
+        if isinstance(query, raw.functions.upload.GetFile):
+            size = max(0, min(query.limit, self.client._file_size(query.location.id) - query.offset))
+            await self.client._request(method, self.client._transfer_seconds(size))
+            return types.SimpleNamespace(bytes=self.client._chunk[:size])
+        await self.client._request(method, self.client._transfer_seconds(len(query.bytes)))
+        self.client._parts.setdefault(query.file_id, {})[query.file_part] = len(query.bytes)
+        return True
+
+
+class FakeClient:
+    """Implements the ``Client`` methods app.py, the client pool and the upload deduplicator call."""
+
+    messages = int(os.getenv('FAKE_TELEGRAM_MESSAGES', 1000))
+    file_bytes = int(os.getenv('FAKE_TELEGRAM_FILE_BYTES', 64 * CHUNK_SIZE))
+    latency = float(os.getenv('FAKE_TELEGRAM_LATENCY', 0.05))
+    chunk_latency = float(os.getenv('FAKE_TELEGRAM_CHUNK_LATENCY', 0.02))
+    bandwidth = float(os.getenv('FAKE_TELEGRAM_BANDWIDTH', 0))
+    connect_latency = float(os.getenv('FAKE_TELEGRAM_CONNECT_LATENCY', 0.3))
+    flood_every = int(os.getenv('FAKE_TELEGRAM_FLOOD_EVERY', 0))
+    flood_seconds = int(os.getenv('FAKE_TELEGRAM_FLOOD_SECONDS', 1))
+    _chunk = bytes(range(256)) * (CHUNK_SIZE // 256)
+    _requests = itertools.count(1) # Shared by every client, like a server-wide flood counter
+    _uploaded = {} # message id -> message, for files sent through send_document
+    _parts = {} # upload file id -> {part index: size}, for files uploaded through FakeSessions
+    _next_id = itertools.count(10_000_000)
+
+    def __init__(self, name='fake', **kwargs):
+        self.name = name
+        self.is_connected = False
+        self.storage = FakeStorage()
+
+    async def connect(self):
+        await asyncio.sleep(self.connect_latency)
+        self.is_connected = True
+        return True
+
+    async def disconnect(self):
+        self.is_connected = False
+
+    async def invoke(self, query, *args, **kwargs):
+        await self._request(getattr(query, 'QUALNAME', 'functions.help.GetConfig').split('.', 1)[-1], self.latency)
+        return None
+
+    async def _request(self, method: str, seconds: float):
+        """One simulated API request: queued by the scheduler, delayed, or refused with a FloodWait."""
+        async def send():
+            if self.flood_every and next(self._requests) % self.flood_every == 0:
+                raise FloodWait(value=self.flood_seconds)
+            if seconds > 0:
+                await asyncio.sleep(seconds)
+
+        import scheduler
+        if scheduler.installed is not None:
+            await scheduler.installed.call(self, FakeQuery(method), send)
+        else:
+            await send()
+
+    def _transfer_seconds(self, size: int) -> float:
+        return self.chunk_latency + (size / self.bandwidth if self.bandwidth > 0 else 0)
+
+    def _message(self, message_id: int):
+        if message_id in self._uploaded:
+            return self._uploaded[message_id]
+        video = FakeMedia(file_id=file_id(FileType.VIDEO, message_id), file_unique_id=f"fake-{message_id}",
+                          file_size=self.file_bytes, mime_type='video/mp4', file_name=f"video_{message_id}.mp4",
+                          thumbs=[FakeMedia(file_id=f"thumb-{message_id}", file_unique_id=f"thumb-{message_id}",
+                                            file_size=len(self._chunk[:4096]))])
+        return FakeMedia(id=message_id, media='video', video=video, caption=f"Video {message_id}",
+                         date=datetime.datetime.fromtimestamp(1700000000 + message_id * 60))
+
+    async def get_chat_history(self, chat_id, limit=0, offset_id=0, offset_date=None):
+        top = offset_id - 1 if offset_id else self.messages
+        for count, message_id in enumerate(range(top, 0, -1)):
+            if limit and count >= limit:
+                return
+            if count % HISTORY_PAGE_SIZE == 0:
+                await self._request('messages.GetHistory', self.latency)
+            yield self._message(message_id)
+
+    async def get_messages(self, chat_id, message_ids):
+        await self._request('messages.GetMessages', self.latency)
+        if isinstance(message_ids, list):
+            return [self._message(message_id) for message_id in message_ids]
+        return self._message(message_ids)
+
+    async def stream_media(self, message, limit=0, offset=0):
+        file_size = self._payload(message).file_size or self.file_bytes
+        total_chunks = -(-file_size // CHUNK_SIZE)
+        stop = min(offset + limit, total_chunks) if limit else total_chunks
+        for index in range(offset, stop):
+            size = min(CHUNK_SIZE, file_size - index * CHUNK_SIZE)
+            await self._request('upload.GetFile', self._transfer_seconds(size))
+            yield self._chunk[:size]
+
+    async def download_media(self, message, in_memory=False, **kwargs):
+        await self._request('upload.GetFile', self._transfer_seconds(4096))
+        data = io.BytesIO(self._chunk[:4096])
+        data.name = 'thumb.jpg'
+        return data
+
+    async def send_document(self, chat_id, document, caption="", file_name=None, progress=None, progress_args=(),
+                            **kwargs):
+        """Reads ``document`` in 512 KiB parts, one SaveBigFilePart-like request each, then sends the message."""
+        document.seek(0, os.SEEK_END)
+        total = document.tell()
+        document.seek(0)
+        sent = 0
+        while part := document.read(PART_SIZE): # Pyrogram reads parts on the event loop too
+            await self._request('upload.SaveBigFilePart', self._transfer_seconds(len(part)))
+            sent += len(part)
+            if progress:
+                progress(sent, total, *progress_args)
+        await self._request('messages.SendMedia', self.latency)
+        return self._store(file_name or getattr(document, 'name', 'document'), total, caption)
+
+    async def send_cached_media(self, chat_id, file_id, caption=""):
+        await self._request('messages.SendMedia', self.latency)
+        original = next(message for message in self._uploaded.values() if message.document.file_id == file_id)
+        return self._store(original.document.file_name, original.document.file_size, caption, original.document)
+
+    async def send_uploaded(self, chat_id, input_file, file_name: str, caption: str = "", resend_part=None):
+        """ParallelUploader.send_input_file(): sends the parts FakeSessions received as a document."""
+        await self._request('messages.SendMedia', self.latency)
+        return self._store(file_name, sum(self._parts.pop(input_file.id, {}).values()), caption)
+
+    def rnd_id(self) -> int:
+        return int.from_bytes(os.urandom(8), 'little', signed=True)
+
+    def guess_mime_type(self, file_name: str):
+        import mimetypes
+        return mimetypes.guess_type(file_name)[0]
+
+    def _store(self, file_name: str, size: int, caption: str, original=None):
+        message_id = next(self._next_id)
+        document = FakeMedia(file_id=original.file_id if original else file_id(FileType.DOCUMENT, message_id),
+                             file_unique_id=original.file_unique_id if original else f"upload-{message_id}",
+                             file_size=size, mime_type=self.guess_mime_type(file_name) or 'application/octet-stream',
+                             file_name=file_name)
+        message = FakeMedia(id=message_id, media='document', document=document, caption=caption,
+                            date=datetime.datetime.now())
+        self._uploaded[message_id] = message
+        return message
+
+    def _file_size(self, media_id: int) -> int:
+        """Size of the file behind a fake file id, whose media id is the id of the message it was first sent in."""
+        message = self._uploaded.get(media_id)
+        return message.document.file_size if message else self.file_bytes
+
+    @staticmethod
+    def _payload(message):
+        return message.video or message.document or FakeMedia()
+
+
+def install():
+    """Makes the client pool create FakeClients, and the parallel transfers FakeSessions; call before the first request."""
+    import client_pool
+    import parallel_download
+    import parallel_upload
+    client_pool.Client = FakeClient
+    parallel_download.Session = parallel_upload.Session = FakeSession
+    parallel_upload.ParallelUploader.send_input_file = lambda uploader, *args, **kwargs: \
+        uploader.client.send_uploaded(*args, **kwargs)
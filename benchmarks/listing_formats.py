@@ -0,0 +1,67 @@
+"""
+Payload size and serialization time of each /get_saved_messages_media format (json, ndjson,
+columnar and msgpack) for one page of --items fake media items, encoded in-process exactly as the
+route does it (Telegram is not involved, so this is the serialization cost alone):
+
+    python benchmarks/listing_formats.py --items 10000
+
+Reports each format's bytes, gzip -6 bytes (what a compressing proxy would send) and the best
+encoding time of --runs.
+"""
+import argparse
+import gzip
+import os
+import sys
+import time
+
+from concurrent_streams import ROOT
+
+
+def encode(app, name: str, records: list, base_url: str) -> bytes:
+    page = app.ListingPage(((0, record['message_id'], record) for record in records), len(records), {0: 0}, {})
+    if name == 'json':
+        body = app.generate_json_listing(page, base_url)
+    elif name == 'ndjson':
+        body = app.generate_ndjson_listing(page, base_url)
+    elif name == 'columnar':
+        body = app.generate_columnar_listing(page)
+    else:
+        body = app.generate_msgpack_listing(page)
+    return b''.join(block if isinstance(block, bytes) else block.encode() for block in body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=10_000, help="Media items in the listing")
+    parser.add_argument('--runs', type=int, default=5, help="Encodings per format; the fastest is reported")
+    parser.add_argument('--base-url', default='https://teledrive.example.com', help="BACKEND_BASE_URL for json and ndjson")
+    parser.add_argument('--workdir', default=os.path.join(ROOT, 'benchmarks', '.work'))
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    for name, value in {'TELEGRAM_API_ID': '1', 'TELEGRAM_API_HASH': 'fake', 'SESSION_STORE': 'memory',
+                        'MEDIA_INDEX_PATH': os.path.join(args.workdir, 'listing_formats.sqlite3')}.items():
+        os.environ.setdefault(name, value)
+    sys.path[:0] = [ROOT, os.path.dirname(os.path.abspath(__file__))]
+    import fake_telegram
+    fake_telegram.install()
+    import app
+
+    client = fake_telegram.FakeClient()
+    records = [app.describe_media_message(client._message(message_id)) for message_id in range(args.items, 0, -1)]
+    formats = [name for name in app.LISTING_FORMATS if name != 'msgpack' or app.MSGPACK_AVAILABLE]
+
+    print(f"{'format':<10}{'bytes':>12}{'gzip bytes':>12}{'encode':>12}")
+    for name in formats:
+        timings = []
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            payload = encode(app, name, records, args.base_url)
+            timings.append(time.perf_counter() - started)
+        print(f"{name:<10}{len(payload):>12}{len(gzip.compress(payload, 6)):>12}{min(timings) * 1000:>10.1f}ms")
+    if not app.MSGPACK_AVAILABLE:
+        print("msgpack skipped: the msgpack package is not installed")
+
+
+if __name__ == '__main__':
+    main()
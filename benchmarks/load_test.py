@@ -0,0 +1,353 @@
+"""
+Load scenarios for catching performance regressions, run against the fake Telegram client in
+fake_telegram.py (latency, bandwidth and flood waits are configurable there and below):
+
+    python benchmarks/load_test.py --save baseline.json
+    python benchmarks/load_test.py --compare baseline.json --tolerance 0.2
+
+Scenarios:
+    listing     Pages through all --messages items of GET /get_saved_messages_media
+    thumbnails  --thumbnails concurrent GET /stream_thumbnail requests, cold and then from the disk cache
+    stream      One GET /stream_media of --stream-mb
+    upload      One POST /upload_file of --upload-mb, generated on the fly
+    stream_parallel  stream, with parallel downloads on (needs --stream-mb of at least 16)
+    upload_parallel  upload, with parallel uploads on (needs --upload-mb of at least 10)
+    stream_cached    stream twice with the media cache on: filling it, then sent from disk
+
+The first four run with one connection per transfer and no media cache, so they measure the plain
+Telegram path; the last three turn on what the server ships with.
+Each scenario reports p50/p99 request latency, throughput and the server's peak RSS and threads.
+With --compare, any latency or RSS more than --tolerance above (or throughput below) the saved
+results is listed and the exit status is 1.
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from concurrent_streams import ROOT, serve, process_stats, percentile
+
+SCENARIOS = ('listing', 'thumbnails', 'stream', 'upload', 'stream_parallel', 'upload_parallel', 'stream_cached')
+LISTING_PAGE_SIZE = 1000 # LISTING_MAX_PAGE_SIZE in app.py
+BODY_BLOCK_SIZE = 1024 * 1024
+HIGHER_IS_BETTER = {'throughput'}
+COMPARED = ('p50_ms', 'p99_ms', 'throughput', 'peak_rss_mb')
+
+
+async def request(port: int, method: str, path: str, cookie: str, timeout: float, body=None, headers=None,
+                  keep_body=False) -> dict:
+    """One HTTP/1.1 request; ``body`` is an iterable of byte blocks sent after the headers."""
+    started = time.monotonic()
+    result = {'ok': False, 'bytes': 0, 'ttfb': None, 'body': b''}
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+        head = f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nCookie: session={cookie}\r\nConnection: close\r\n"
+        head += ''.join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        writer.write((head + '\r\n').encode())
+        for block in body or ():
+            writer.write(block)
+            await asyncio.wait_for(writer.drain(), timeout)
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        result['ttfb'] = time.monotonic() - started
+        response_head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+        chunks = []
+        while chunk := await asyncio.wait_for(reader.read(256 * 1024), timeout):
+            result['bytes'] += len(chunk)
+            if keep_body:
+                chunks.append(chunk)
+        result['body'] = b''.join(chunks)
+        if keep_body and b'transfer-encoding: chunked' in response_head.lower():
+            result['body'] = dechunk(result['body'])
+        result['ok'] = status_line.split()[1] in (b'200', b'206', b'304')
+        writer.close()
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, IndexError):
+        pass
+    result['seconds'] = time.monotonic() - started
+    return result
+
+
+def dechunk(data: bytes) -> bytes:
+    body, position = [], 0
+    while (line_end := data.find(b'\r\n', position)) != -1:
+        size = int(data[position:line_end].split(b';')[0], 16)
+        if size == 0:
+            break
+        body.append(data[line_end + 2:line_end + 2 + size])
+        position = line_end + 2 + size + 2
+    return b''.join(body)
+
+
+class PeakSampler:
+    """Samples the server's RSS and thread count every 100 ms while a scenario runs."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak = {'Threads': 0, 'VmRSS': 0}
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._done.is_set():
+            try:
+                for name, value in process_stats(self.pid).items():
+                    self.peak[name] = max(self.peak[name], value)
+            except OSError:
+                return
+            self._done.wait(0.1)
+
+
+def summarize(results: list, elapsed: float, amount: float, unit: str, sampler: PeakSampler) -> dict:
+    latencies = [r['seconds'] for r in results if r['ok']]
+    return {
+        'requests': len(results),
+        'errors': sum(1 for r in results if not r['ok']),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        'throughput': round(amount / elapsed, 1) if elapsed > 0 else None,
+        'unit': unit,
+        'seconds': round(elapsed, 2),
+        'peak_rss_mb': round(sampler.peak['VmRSS'] / 1024),
+        'peak_threads': sampler.peak['Threads'],
+    }
+
+
+# --- Scenarios ---
+async def listing(port: int, cookie: str, args) -> tuple:
+    """Walks every page with the offset_id cursor, as the frontend's infinite scroll does."""
+    results, items = [], 0
+    for _ in range(args.listing_runs):
+        offset_id = 0
+        while True:
+            path = f"/get_saved_messages_media?limit={LISTING_PAGE_SIZE}" + (f"&offset_id={offset_id}" if offset_id else '')
+            result = await request(port, 'GET', path, cookie, args.timeout, keep_body=True)
+            results.append(result)
+            if not result['ok']:
+                break
+            page = json.loads(result['body'])
+            items += len(page['items'])
+            if not page.get('next_offset_id'):
+                break
+            offset_id = page['next_offset_id']
+    return results, items, 'items/s'
+
+
+async def thumbnails(port: int, cookie: str, args) -> tuple:
+    """Cold (every thumbnail fetched from Telegram) and then warm (served from the thumbnail cache)."""
+    ids = range(1, min(args.thumbnails, args.messages) + 1)
+    results = []
+    for _ in ('cold', 'warm'):
+        results += await asyncio.gather(*(request(port, 'GET', f"/stream_thumbnail/{message_id}", cookie, args.timeout)
+                                          for message_id in ids))
+    return results, len(results), 'thumbnails/s'
+
+
+async def stream(port: int, cookie: str, args) -> tuple:
+    result = await request(port, 'GET', f"/stream_media/{args.messages}", cookie, args.timeout)
+    result['ok'] = result['ok'] and result['bytes'] >= args.stream_mb * 1024 * 1024
+    return [result], result['bytes'] / 1_000_000, 'MB/s'
+
+
+async def upload(port: int, cookie: str, args) -> tuple:
+    size = args.upload_mb * 1024 * 1024
+    boundary = uuid.uuid4().hex
+    # A unique first block, so the deduplicator never turns a rerun into a re-send
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"load_test.bin\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + uuid.uuid4().bytes
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    block = bytes(range(256)) * (BODY_BLOCK_SIZE // 256)
+
+    def body():
+        yield head
+        remaining = size - 16
+        while remaining > 0:
+            yield block[:min(remaining, BODY_BLOCK_SIZE)]
+            remaining -= BODY_BLOCK_SIZE
+        yield tail
+
+    headers = {'Content-Type': f"multipart/form-data; boundary={boundary}", 'Content-Length': len(head) + size - 16 + len(tail)}
+    result = await request(port, 'POST', '/upload_file', cookie, args.timeout, body=body(), headers=headers, keep_body=True)
+    result['ok'] = result['ok'] and json.loads(result['body'] or b'{}').get('success') is True
+    return [result], size / 1_000_000, 'MB/s'
+
+
+async def stream_parallel(port: int, cookie: str, args) -> tuple:
+    return await stream(port, cookie, args)
+
+
+async def upload_parallel(port: int, cookie: str, args) -> tuple:
+    return await upload(port, cookie, args)
+
+
+async def stream_cached(port: int, cookie: str, args) -> tuple:
+    """Cold (downloaded from Telegram into the media cache) and then warm (sent from the cache on disk)."""
+    results = []
+    for _ in ('cold', 'warm'):
+        results += (await stream(port, cookie, args))[0]
+    return results, sum(result['bytes'] for result in results) / 1_000_000, 'MB/s'
+
+
+def scenario_env(name: str, args) -> dict:
+    """Server settings a scenario changes from the base server's; None leaves the server's own default."""
+    if name == 'stream_parallel':
+        return {'DOWNLOAD_WORKERS': None}
+    if name == 'upload_parallel':
+        return {'UPLOAD_WORKERS': None}
+    if name == 'stream_cached':
+        return {'MEDIA_CACHE_MAX_BYTES': str(2 * args.stream_mb * 1024 * 1024)}
+    return {}
+
+
+# --- Runner ---
+@contextlib.contextmanager
+def server_process(args, env: dict):
+    """Runs the server with ``env`` (None values removed) and yields ``(pid, session cookie)`` once it accepts connections."""
+    env = {name: value for name, value in env.items() if value is not None}
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', args.mode, '--port', str(args.port)],
+                              env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        cookie = server.stdout.readline().strip()
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline: # Wait until the port accepts connections
+            try:
+                socket.create_connection(('127.0.0.1', args.port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.2)
+        yield server.pid, cookie
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def run(args) -> dict:
+    os.makedirs(args.workdir, exist_ok=True)
+    index_path = os.path.join(args.workdir, 'load_test_index.sqlite3')
+    for suffix in ('', '-wal', '-shm'): # Start from an empty index every run
+        if os.path.exists(index_path + suffix):
+            os.remove(index_path + suffix)
+    thumbnail_dir = os.path.join(args.workdir, 'load_test_thumbnails')
+    shutil.rmtree(thumbnail_dir, ignore_errors=True) # So the first thumbnail pass is cold
+    media_cache_dir = os.path.join(args.workdir, 'load_test_media_cache')
+    shutil.rmtree(media_cache_dir, ignore_errors=True)
+    env = dict(os.environ,
+               TELEGRAM_API_ID=os.getenv('TELEGRAM_API_ID', '1'), TELEGRAM_API_HASH=os.getenv('TELEGRAM_API_HASH', 'fake'),
+               FAKE_TELEGRAM_MESSAGES=str(args.messages),
+               FAKE_TELEGRAM_FILE_BYTES=str(args.stream_mb * 1024 * 1024),
+               FAKE_TELEGRAM_LATENCY=str(args.latency),
+               FAKE_TELEGRAM_CHUNK_LATENCY=str(args.chunk_latency),
+               FAKE_TELEGRAM_BANDWIDTH=str(args.bandwidth),
+               FAKE_TELEGRAM_FLOOD_EVERY=str(args.flood_every),
+               FAKE_TELEGRAM_FLOOD_SECONDS=str(args.flood_seconds),
+               MEDIA_CACHE_MAX_BYTES='0', # Measure the Telegram path, not the disk cache (but see scenario_env)
+               MEDIA_CACHE_DIR=media_cache_dir,
+               DOWNLOAD_WORKERS='1', # One connection per transfer
+               UPLOAD_WORKERS='0',
+               MEDIA_INDEX_PATH=index_path,
+               THUMBNAIL_CACHE_DIR=thumbnail_dir,
+               SESSION_STORE='memory') # The benchmark session only has to outlive the run
+    if args.rate_limits is not None:
+        env['TELEGRAM_RATE_LIMITS'] = args.rate_limits
+    report = {}
+    try:
+        # Consecutive scenarios with the same settings share a server
+        for _, names in itertools.groupby(args.scenarios.split(','), lambda name: scenario_env(name, args)):
+            names = list(names)
+            with server_process(args, {**env, **scenario_env(names[0], args)}) as (pid, cookie):
+                for name in names:
+                    with PeakSampler(pid) as sampler:
+                        started = time.monotonic()
+                        results, amount, unit = asyncio.run(globals()[name](args.port, cookie, args))
+                        elapsed = time.monotonic() - started
+                    report[name] = summarize(results, elapsed, amount, unit, sampler)
+                    print(name, report[name], flush=True)
+        return report
+    finally:
+        shutil.rmtree(media_cache_dir, ignore_errors=True) # Up to twice --stream-mb
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Returns a line per metric that got worse than ``baseline`` by more than ``tolerance`` (a fraction)."""
+    regressions = []
+    for name, results in report.items():
+        for metric in COMPARED:
+            before, after = baseline.get(name, {}).get(metric), results.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (-change if metric in HIGHER_IS_BETTER else change) > tolerance:
+                regressions.append(f"{name} {metric}: {before} -> {after} ({change:+.0%})")
+        if results['errors'] > baseline.get(name, {}).get('errors', 0):
+            regressions.append(f"{name} errors: {baseline.get(name, {}).get('errors', 0)} -> {results['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="Comma-separated subset of " + ', '.join(SCENARIOS))
+    parser.add_argument('--mode', default='asgi', choices=('asgi', 'threaded'), help="uvicorn asgi:application or app.run")
+    parser.add_argument('--messages', type=int, default=10_000, help="Media items in the fake Saved Messages")
+    parser.add_argument('--listing-runs', type=int, default=3, help="Times to page through the whole listing")
+    parser.add_argument('--thumbnails', type=int, default=100, help="Concurrent thumbnail requests")
+    parser.add_argument('--stream-mb', type=int, default=2048, help="Size of the streamed file")
+    parser.add_argument('--upload-mb', type=int, default=2048, help="Size of the uploaded file")
+    parser.add_argument('--latency', type=float, default=0.05, help="Fake Telegram delay per request, in seconds")
+    parser.add_argument('--chunk-latency', type=float, default=0.02, help="Fake Telegram delay per chunk or part, in seconds")
+    parser.add_argument('--bandwidth', type=float, default=0, help="Fake Telegram bytes per second per transfer; 0 is unlimited")
+    parser.add_argument('--flood-every', type=int, default=0, help="Make every Nth fake request a FloodWait; 0 disables")
+    parser.add_argument('--flood-seconds', type=int, default=1, help="Duration of injected flood waits")
+    parser.add_argument('--rate-limits', help="TELEGRAM_RATE_LIMITS for the server, e.g. 'download=0,upload=0' to lift them")
+    parser.add_argument('--timeout', type=float, default=600, help="Per-request timeout, in seconds")
+    parser.add_argument('--port', type=int, default=5095)
+    parser.add_argument('--workdir', default=os.path.join(ROOT, 'benchmarks', '.work'))
+    parser.add_argument('--save', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="Compare against results saved with --save")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative change before --compare fails")
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+    unknown = set(args.scenarios.split(',')) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    report = run(args)
+    print(f"\n{'scenario':<16}{'requests':>9}{'errors':>7}{'p50':>11}{'p99':>11}{'throughput':>22}{'RSS MB':>8}{'threads':>9}")
+    for name, r in report.items():
+        print(f"{name:<16}{r['requests']:>9}{r['errors']:>7}{str(r['p50_ms']) + 'ms':>11}{str(r['p99_ms']) + 'ms':>11}"
+              f"{str(r['throughput']) + ' ' + r['unit']:>22}{r['peak_rss_mb']:>8}{r['peak_threads']:>9}")
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
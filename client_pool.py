@@ -0,0 +1,449 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from pyrogram import Client, raw
+from pyrogram.errors import AuthKeyUnregistered, AuthKeyInvalid, SessionRevoked, UserDeactivated
+
+from metrics import Histogram
+from parallel_download import MediaSessions
+
+# Errors that mean the session string itself is dead; the pooled client is dropped when one is raised.
+SESSION_INVALID_ERRORS = (AuthKeyUnregistered, AuthKeyInvalid, SessionRevoked, UserDeactivated)
+
+
+class ClientPoolExhausted(Exception):
+    """Raised when every pooled client is busy and none frees up within the acquire timeout."""
+
+
+class TelegramLoop:
+    """
+    A single long-lived asyncio event loop, either running in a daemon thread or adopted from an
+    ASGI server. Pyrogram clients are bound to the loop they connected on, so all Telegram work
+    (and, via app.async_to_sync, every async view) is funnelled through this one.
+    """
+
+    def __init__(self, name="telegram-loop"):
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._adopted = False
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    self._thread = threading.Thread(target=loop.run_forever, name=self.name, daemon=True)
+                    self._thread.start()
+                    self._loop = loop
+        return self._loop
+
+    @property
+    def started(self) -> bool:
+        return self._loop is not None
+
+    @property
+    def running(self) -> bool:
+        return self._loop is not None and self._loop.is_running()
+
+    def adopt(self, loop: asyncio.AbstractEventLoop) -> bool:
+        """
+        Uses an already running loop (e.g. an ASGI server's) instead of starting a thread. Returns False
+        if a different loop was already started, in which case work keeps hopping to that one.
+        """
+        with self._lock:
+            if self._loop is None:
+                self._loop = loop
+                self._adopted = True
+            return self._loop is loop
+
+    def in_loop_thread(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def submit(self, coro):
+        """Schedules a coroutine on the loop and returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run(self, coro):
+        """Awaits a coroutine on the loop from any other event loop (or from the loop itself)."""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            return await coro
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def run_sync(self, coro, timeout=None):
+        """Blocks the calling (non-loop) thread until the coroutine finishes on the loop."""
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError("run_sync() called from the Telegram loop itself; await run() instead.")
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        if self._loop is not None and self._loop.is_running() and not self._adopted: # Never stop a server's loop
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+class _StreamEnd:
+    def __init__(self, error=None):
+        self.error = error
+
+
+class PooledStream:
+    """
+    Items of an async generator running on the Telegram loop, consumed from a plain thread (e.g. a
+    WSGI response body) or, with ``async for``, from the loop itself. At most ``prefetch`` items are buffered ahead of the consumer,
+    so a slow HTTP client slows the producer down instead of growing memory.
+    """
+
+    def __init__(self, telegram_loop: TelegramLoop, queue: asyncio.Queue, task: asyncio.Task):
+        self.telegram_loop = telegram_loop
+        self._queue = queue
+        self._task = task
+        self._head = [] # Items pulled by prime() that __iter__ must yield first
+        self._finished = False
+
+    async def prime(self):
+        """Waits for the first item so errors surface before any response headers are sent."""
+        item = await self.telegram_loop.run(self._queue.get())
+        if isinstance(item, _StreamEnd):
+            self._finished = True
+            if item.error is not None:
+                raise item.error
+        else:
+            self._head.append(item)
+
+    def __iter__(self):
+        try:
+            while self._head:
+                yield self._head.pop(0)
+            while not self._finished:
+                item = self.telegram_loop.run_sync(self._queue.get())
+                if isinstance(item, _StreamEnd):
+                    self._finished = True
+                    if item.error is not None:
+                        raise item.error
+                    break
+                yield item
+        finally:
+            self.close()
+
+    async def __aiter__(self):
+        """Async counterpart of __iter__ for consumers that already run on an event loop (asgi.py)."""
+        try:
+            while self._head:
+                yield self._head.pop(0)
+            while not self._finished:
+                item = await self.telegram_loop.run(self._queue.get())
+                if isinstance(item, _StreamEnd):
+                    self._finished = True
+                    if item.error is not None:
+                        raise item.error
+                    break
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops the producer (e.g. the HTTP client went away); safe to call more than once."""
+        if not self._task.done():
+            self.telegram_loop.loop.call_soon_threadsafe(self._task.cancel)
+
+
+class _PoolEntry:
+    def __init__(self, key: str):
+        self.key = key
+        self.client = None
+        self.ready = asyncio.get_running_loop().create_future() # Resolved once connect() finishes
+        self.leases = 0
+        self.last_used = time.monotonic()
+        self.last_checked = time.monotonic()
+        self.check_lock = asyncio.Lock()
+        self.retired = False # Out of the pool; disconnected once its last lease is released
+
+
+class ClientPool:
+    """
+    Keeps connected Pyrogram clients alive across requests, keyed by session string.
+
+    - Concurrent requests for the same session share one client and one connect() handshake.
+    - Clients idle for longer than ``idle_timeout`` seconds are disconnected by a background reaper.
+    - At most ``max_clients`` clients are kept; the least recently used idle one is evicted to make room.
+    - A client that has been idle longer than ``health_check_interval`` is pinged before being handed out
+      and transparently reconnected if the ping fails.
+    - With a ``scheduler`` (a TelegramScheduler), each client is registered under its session, so rate
+      limits and flood waits are tracked per account rather than per connection.
+    - Each client keeps the media sessions its parallel downloads open (``client.parallel_media_sessions``)
+      until it is disconnected.
+    """
+
+    def __init__(self, telegram_loop: TelegramLoop, api_id, api_hash, max_clients=64, idle_timeout=600,
+                 health_check_interval=60, acquire_timeout=30, scheduler=None, **client_kwargs):
+        self.telegram_loop = telegram_loop
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self.scheduler = scheduler
+        self.client_kwargs = client_kwargs
+        self._entries = {} # session string -> _PoolEntry; only touched from the Telegram loop
+        self._capacity = None # asyncio.Condition, created lazily on the Telegram loop
+        self._reaper_task = None
+        self._counter = 0
+        self.connect_seconds = Histogram('teledrive_telegram_connect_seconds',
+                                         'Time to connect a pooled client (MTProto handshake included).')
+
+    @staticmethod
+    def describe_key(key: str) -> str:
+        """Short, non-reversible label for a session string, safe for logs."""
+        return hashlib.sha256(key.encode()).hexdigest()[:8] if key else "none"
+
+    # --- Public API (callable from any thread / event loop) ---
+    async def run(self, session_string: str, fn):
+        """Runs ``await fn(client)`` on the Telegram loop with a leased, connected client."""
+        return await self.telegram_loop.run(self._run(session_string, fn))
+
+    def run_sync(self, session_string: str, fn, timeout=None):
+        """Blocking variant of run() for plain threads (e.g. response generators)."""
+        return self.telegram_loop.run_sync(self._run(session_string, fn), timeout)
+
+    async def open_stream(self, session_string: str, agen_factory, prefetch=2) -> PooledStream:
+        """
+        Starts iterating ``agen_factory(client)`` on the Telegram loop with a leased client.
+        The lease is held until the stream is exhausted or closed.
+        """
+        return await self.telegram_loop.run(self._open_stream(session_string, agen_factory, prefetch))
+
+    async def discard(self, session_string: str):
+        """Disconnects and forgets the pooled client for a session (logout, revoked key)."""
+        await self.telegram_loop.run(self._discard(session_string))
+
+    def shutdown(self, timeout=10):
+        """Disconnects every pooled client; called once at process exit."""
+        if self.telegram_loop.running: # Nothing to do once an ASGI server has stopped its loop
+            self.telegram_loop.run_sync(self._close(), timeout)
+
+    def stats(self) -> dict:
+        entries = list(self._entries.values())
+        return {
+            'clients': len(entries),
+            'busy': sum(1 for entry in entries if entry.leases > 0),
+            'max_clients': self.max_clients,
+            'media_sessions': sum(entry.client.parallel_media_sessions.count for entry in entries if entry.client),
+        }
+
+    # --- Internals (run on the Telegram loop) ---
+    async def _run(self, session_string, fn):
+        entry = await self._acquire(session_string)
+        try:
+            return await fn(entry.client)
+        except SESSION_INVALID_ERRORS:
+            self._release(entry)
+            entry = None
+            await self._discard(session_string)
+            raise
+        finally:
+            if entry is not None:
+                self._release(entry)
+
+    async def _open_stream(self, session_string, agen_factory, prefetch):
+        queue = asyncio.Queue(maxsize=max(1, prefetch))
+
+        async def pump(client):
+            agen = agen_factory(client)
+            try:
+                async for item in agen:
+                    await queue.put(item)
+            finally:
+                await agen.aclose()
+
+        async def produce():
+            try:
+                await self._run(session_string, pump)
+            except asyncio.CancelledError:
+                raise # Consumer is gone; nobody is waiting for the end marker
+            except Exception as e:
+                await queue.put(_StreamEnd(e))
+            else:
+                await queue.put(_StreamEnd())
+
+        return PooledStream(self.telegram_loop, queue, asyncio.ensure_future(produce()))
+
+    async def _acquire(self, key: str) -> _PoolEntry:
+        if not key:
+            raise AuthKeyUnregistered()
+        self._ensure_reaper()
+
+        while True:
+            entry = self._entries.get(key)
+            if entry is None:
+                await self._make_room()
+                if key in self._entries: # Another request created it while we waited for room
+                    continue
+                entry = _PoolEntry(key)
+                self._entries[key] = entry
+                entry.leases += 1
+                try:
+                    entry.client = await self._connect(key)
+                except BaseException as e:
+                    self._entries.pop(key, None)
+                    if isinstance(e, Exception):
+                        entry.ready.set_exception(e)
+                        entry.ready.exception() # Mark retrieved so failures without waiters don't warn
+                    else:
+                        entry.ready.cancel()
+                    self._notify_capacity()
+                    raise
+                entry.ready.set_result(True)
+                entry.last_used = entry.last_checked = time.monotonic()
+                return entry
+
+            entry.leases += 1
+            try:
+                await asyncio.shield(entry.ready)
+            except BaseException:
+                self._release(entry) # Connect failed for the request that created the entry; share its error
+                raise
+            if entry.retired: # Dropped while we waited; don't pile more work onto a client on its way out
+                self._release(entry)
+                continue
+            if time.monotonic() - entry.last_checked > self.health_check_interval:
+                try:
+                    await self._health_check(entry)
+                except SESSION_INVALID_ERRORS:
+                    self._release(entry)
+                    raise
+                except Exception:
+                    self._release(entry)
+                    continue # Stale connection was dropped; start over with a fresh client
+            entry.last_used = time.monotonic()
+            return entry
+
+    def _release(self, entry: _PoolEntry):
+        entry.leases -= 1
+        entry.last_used = time.monotonic()
+        if entry.leases == 0:
+            if entry.retired:
+                asyncio.ensure_future(self._disconnect(entry))
+            self._notify_capacity()
+
+    async def _connect(self, key: str) -> Client:
+        self._counter += 1
+        client = Client(name=f"pooled_session_{self._counter}", api_id=self.api_id, api_hash=self.api_hash,
+                        session_string=key, in_memory=True, no_updates=True, **self.client_kwargs)
+        if self.scheduler is not None:
+            self.scheduler.register(client, self.describe_key(key))
+        started = time.monotonic()
+        await client.connect()
+        client.parallel_media_sessions = MediaSessions(client)
+        self.connect_seconds.observe(time.monotonic() - started)
+        logging.info(f"Pool: connected client for session {self.describe_key(key)} in {time.monotonic() - started:.2f}s "
+                     f"({len(self._entries)} pooled).")
+        return client
+
+    async def _health_check(self, entry: _PoolEntry):
+        async with entry.check_lock:
+            if time.monotonic() - entry.last_checked <= self.health_check_interval:
+                return # Another request checked it while we waited for the lock
+            try:
+                await asyncio.wait_for(entry.client.invoke(raw.functions.updates.GetState()), timeout=10)
+                entry.last_checked = time.monotonic()
+            except SESSION_INVALID_ERRORS:
+                await self._drop(entry)
+                raise
+            except Exception as e:
+                logging.warning(f"Pool: health check failed for session {self.describe_key(entry.key)}: {e}. Reconnecting.")
+                await self._drop(entry)
+                raise
+
+    async def _make_room(self):
+        if self._capacity is None:
+            self._capacity = asyncio.Condition()
+        deadline = time.monotonic() + self.acquire_timeout
+        while len(self._entries) >= self.max_clients:
+            idle = [entry for entry in self._entries.values() if entry.leases == 0 and entry.ready.done()]
+            if idle:
+                await self._drop(min(idle, key=lambda entry: entry.last_used))
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ClientPoolExhausted(f"All {self.max_clients} pooled Telegram clients are busy.")
+            async with self._capacity:
+                try:
+                    await asyncio.wait_for(self._capacity.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _notify_capacity(self):
+        if self._capacity is None:
+            return
+
+        async def notify():
+            async with self._capacity:
+                self._capacity.notify_all()
+        asyncio.ensure_future(notify())
+
+    async def _drop(self, entry: _PoolEntry, force: bool = False):
+        """
+        Takes ``entry`` out of the pool so the next request connects afresh. Its client is disconnected
+        once no request holds a lease on it any more (at once with ``force``, on shutdown).
+        """
+        if self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+        entry.retired = True
+        if entry.leases == 0 or force:
+            await self._disconnect(entry)
+        self._notify_capacity()
+
+    async def _disconnect(self, entry: _PoolEntry):
+        client = entry.client
+        if client is not None:
+            await client.parallel_media_sessions.close()
+        if client is not None and client.is_connected:
+            try:
+                await client.disconnect()
+            except Exception as e:
+                logging.warning(f"Pool: error disconnecting session {self.describe_key(entry.key)}: {e}")
+
+    async def _discard(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        if not entry.ready.done():
+            try:
+                await asyncio.shield(entry.ready)
+            except Exception:
+                return
+        await self._drop(entry)
+
+    async def _close(self):
+        for entry in list(self._entries.values()):
+            await self._drop(entry, force=True)
+        if self._reaper_task:
+            self._reaper_task.cancel()
+            self._reaper_task = None
+
+    def _ensure_reaper(self):
+        if self._reaper_task is None or self._reaper_task.done():
+            self._reaper_task = asyncio.ensure_future(self._reap_idle())
+
+    async def _reap_idle(self):
+        interval = max(1, min(30, self.idle_timeout / 2))
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for entry in list(self._entries.values()):
+                if entry.leases == 0 and entry.ready.done() and now - entry.last_used > self.idle_timeout:
+                    logging.info(f"Pool: evicting idle client for session {self.describe_key(entry.key)}.")
+                    await self._drop(entry)
@@ -0,0 +1,436 @@
+"""
+Production launcher: several backend processes (workers) behind a router on one port.
+
+    python cluster.py --workers 4 --port 5000
+
+Each worker serves asgi.py under uvicorn on its own Unix socket. The router reads the head of every
+request and forwards it to the worker its session cookie hashes to on a consistent-hash ring, so a
+signed-in session always reaches the process holding its pooled Telegram client, message cache and
+live update listener, and changing --workers only moves about 1/N of the sessions. Requests without a
+session (signing in) go to the workers in turn.
+
+Workers share what has to be shared between processes: sessions (SESSION_STORE sqlite or redis, not
+memory), the media index, and the cache directories, which they lock per file (MEDIA_CACHE_SHARED).
+
+Signals:
+    SIGHUP          Rolling restart: each worker in turn is replaced by a fresh one, which takes over
+                    its sessions as soon as it accepts connections, and the old one drains
+    SIGTERM/SIGINT  Stop accepting connections, drain every worker and exit
+
+A draining worker finishes the responses in flight (downloads, uploads, listings) for up to
+--drain-timeout seconds, ends its /events streams so browsers reconnect, then closes its Telegram
+clients. Browsers resume interrupted media with a Range request, which the replacement serves.
+Needs Unix sockets and POSIX file locks (Linux, macOS).
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http import HTTPStatus
+
+HEAD_LIMIT = 64 * 1024 # Longest request line plus headers the router accepts
+COPY_BLOCK_SIZE = 256 * 1024
+DRAIN_GRACE = 15 # Seconds past --drain-timeout before a worker that is still running is killed
+
+
+class HashRing:
+    """Consistent hashing of keys onto ``nodes``, with ``replicas`` points per node to even out the load."""
+
+    def __init__(self, nodes, replicas: int = 160):
+        points = sorted((self._hash(f"{node}-{replica}"), node) for node in nodes for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key: str):
+        return self._nodes[bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+def parse_headers(head: bytes) -> dict:
+    """A request head's headers as {lower-case name: value}; repeated headers are joined."""
+    headers = {}
+    for line in head.decode('latin1').split('\r\n')[1:]:
+        name, separator, value = line.partition(':')
+        if not separator:
+            continue
+        name, value = name.strip().lower(), value.strip()
+        if name in headers:
+            value = f"{headers[name]}{'; ' if name == 'cookie' else ', '}{value}"
+        headers[name] = value
+    return headers
+
+
+def parse_cookies(header: str) -> dict:
+    cookies = {}
+    for item in header.split(';'):
+        name, _, value = item.strip().partition('=')
+        cookies.setdefault(name, value.strip('"'))
+    return cookies
+
+
+async def copy_exactly(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, length: int):
+    while length > 0:
+        data = await reader.read(min(COPY_BLOCK_SIZE, length))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', length)
+        writer.write(data)
+        await writer.drain()
+        length -= len(data)
+
+
+async def copy_body(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, headers: dict):
+    """Forwards one request body, framed by Transfer-Encoding: chunked or Content-Length."""
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            size_line = await reader.readuntil(b'\r\n')
+            writer.write(size_line)
+            size = int(size_line.split(b';', 1)[0], 16)
+            if size == 0:
+                while (line := await reader.readuntil(b'\r\n')) != b'\r\n': # Trailers
+                    writer.write(line)
+                writer.write(line)
+                break
+            await copy_exactly(reader, writer, size + 2) # The chunk and its CRLF
+    else:
+        await copy_exactly(reader, writer, int(headers.get('content-length') or 0))
+    await writer.drain()
+
+
+class _Upstream:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+        self.task = None # Pipes the worker's responses back to the client
+
+
+class _ClientConnection:
+    def __init__(self, router: "Router", reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.router = router
+        self.reader = reader
+        self.writer = writer
+        self.upstreams = {} # Worker socket path -> _Upstream
+        self.current = None # The upstream the latest request went to
+
+    async def serve(self):
+        try:
+            while True:
+                try:
+                    head = await self.reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError: # No further requests; let the last response finish
+                    if self.current is not None and not self.current.closed:
+                        await self.current.task
+                    return
+                except asyncio.LimitOverrunError:
+                    await self._reply(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, 'Request headers are too large.')
+                    return
+                headers = parse_headers(head)
+                upstream = await self._upstream(self.router.slot_for(headers))
+                if upstream is None:
+                    await self._reply(HTTPStatus.BAD_GATEWAY, 'No worker is available.')
+                    return
+                self.current = upstream
+                upstream.writer.write(head)
+                try:
+                    await copy_body(self.reader, upstream.writer, headers)
+                except ValueError: # Malformed Content-Length or chunk size
+                    await self._reply(HTTPStatus.BAD_REQUEST, 'Malformed request body framing.')
+                    return
+        except (OSError, asyncio.IncompleteReadError): # Either side went away mid-request
+            pass
+
+    def close(self):
+        for upstream in self.upstreams.values():
+            upstream.writer.close()
+            if upstream.task is not None:
+                upstream.task.cancel()
+        self.writer.close()
+
+    async def _upstream(self, slot: int):
+        """This connection's upstream to the worker now serving ``slot``, waiting out a restart if need be."""
+        deadline = time.monotonic() + self.router.connect_timeout
+        while True:
+            path = self.router.addresses.get(slot)
+            upstream = self.upstreams.get(path)
+            if upstream is not None and not upstream.closed:
+                return upstream
+            if path is not None:
+                try:
+                    reader, writer = await asyncio.open_unix_connection(path)
+                    break
+                except OSError:
+                    pass
+            if time.monotonic() > deadline:
+                return None
+            await asyncio.sleep(0.2)
+        upstream = self.upstreams[path] = _Upstream(reader, writer)
+        upstream.task = asyncio.ensure_future(self._pipe(upstream))
+        return upstream
+
+    async def _pipe(self, upstream: _Upstream):
+        try:
+            while data := await upstream.reader.read(COPY_BLOCK_SIZE):
+                self.writer.write(data)
+                await self.writer.drain()
+        except OSError:
+            pass
+        finally:
+            upstream.closed = True
+            upstream.writer.close()
+            if upstream is self.current: # The close may be what ends its response; pass it on
+                self.writer.close()
+
+    async def _reply(self, status: HTTPStatus, error: str):
+        body = json.dumps({'error': error}).encode()
+        self.writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: application/json\r\n"
+                          f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await self.writer.drain()
+
+
+class Router:
+    """
+    HTTP/1.1 front end that forwards each request as it is to the worker slot its session cookie hashes
+    to. Only request heads and body framing are parsed; responses are piped back untouched. A client
+    connection keeps one upstream connection per worker it has used, so keep-alive works end to end and
+    a request whose session changed (e.g. after signing in) simply goes to another worker.
+    """
+
+    def __init__(self, slots: int, cookie_name: str = 'session', connect_timeout: float = 30):
+        self.ring = HashRing(range(slots))
+        self.cookie_name = cookie_name
+        self.connect_timeout = connect_timeout # Seconds a request waits for its worker, e.g. while it restarts
+        self.addresses = {} # slot -> Unix socket of the worker serving it
+        self.connections = set()
+        self._turns = itertools.cycle(range(slots))
+
+    def slot_for(self, headers: dict) -> int:
+        sid = parse_cookies(headers.get('cookie', '')).get(self.cookie_name)
+        return self.ring.node_for(sid) if sid else next(self._turns)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = _ClientConnection(self, reader, writer)
+        self.connections.add(connection)
+        try:
+            await connection.serve()
+        finally:
+            self.connections.discard(connection)
+            connection.close()
+
+
+class Worker:
+    def __init__(self, slot: int, path: str, process: subprocess.Popen):
+        self.slot = slot
+        self.path = path
+        self.process = process
+
+
+class Supervisor:
+    """
+    Runs one worker per router slot and respawns workers that die. A restart replaces the workers one at a
+    time: the replacement takes over the slot once it accepts connections, and only then is the old one
+    sent SIGTERM to drain; it is killed if it is still running ``drain_timeout`` + DRAIN_GRACE seconds later.
+    """
+
+    def __init__(self, router: Router, count: int, runtime_dir: str, worker_command: list,
+                 drain_timeout: float = 300, start_timeout: float = 120):
+        self.router = router
+        self.count = count
+        self.runtime_dir = runtime_dir
+        self.worker_command = worker_command # Runs one worker; the socket path is appended
+        self.drain_timeout = drain_timeout
+        self.start_timeout = start_timeout
+        self.workers = {} # slot -> Worker
+        self.stopping = False
+        self._generations = itertools.count(1)
+        self._slot_locks = [asyncio.Lock() for _ in range(count)]
+        self._restart_task = None
+        self._reapers = set()
+
+    async def start(self):
+        await asyncio.gather(*(self._replace(slot) for slot in range(self.count)))
+
+    def request_restart(self):
+        if self._restart_task is not None and not self._restart_task.done():
+            logging.info("Cluster: a rolling restart is already in progress.")
+            return
+        self._restart_task = asyncio.ensure_future(self._restart())
+
+    async def watch(self):
+        """Respawns workers that exit on their own."""
+        while not self.stopping:
+            await asyncio.sleep(1)
+            for slot, worker in list(self.workers.items()):
+                if worker.process.poll() is None or self.stopping or self._slot_locks[slot].locked():
+                    continue
+                logging.error(f"Cluster: worker {slot} (pid {worker.process.pid}) exited with status "
+                              f"{worker.process.returncode}; starting another.")
+                try:
+                    await self._replace(slot)
+                except RuntimeError as e:
+                    logging.error(f"Cluster: {e}") # Tried again on the next pass
+
+    async def stop(self):
+        self.stopping = True
+        if self._restart_task is not None:
+            self._restart_task.cancel()
+        for worker in self.workers.values():
+            self._drain(worker)
+        await asyncio.gather(*self._reapers, return_exceptions=True)
+
+    # --- Internals ---
+    async def _restart(self):
+        logging.info(f"Cluster: rolling restart of {self.count} workers.")
+        for slot in range(self.count):
+            if self.stopping:
+                return
+            try:
+                await self._replace(slot)
+            except RuntimeError as e:
+                logging.error(f"Cluster: {e}; keeping the running worker {slot}.")
+        logging.info("Cluster: rolling restart finished.")
+
+    async def _replace(self, slot: int):
+        async with self._slot_locks[slot]:
+            worker = await self._spawn(slot)
+            previous = self.workers.get(slot)
+            self.workers[slot] = worker
+            self.router.addresses[slot] = worker.path # New requests go to the new worker from here on
+            if previous is not None and previous.process.poll() is None:
+                self._drain(previous)
+
+    async def _spawn(self, slot: int) -> Worker:
+        path = os.path.join(self.runtime_dir, f"worker-{slot}-{next(self._generations)}.sock")
+        process = subprocess.Popen([*self.worker_command, path])
+        started = time.monotonic()
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"Worker {slot} exited with status {process.returncode} while starting.")
+            try:
+                _, writer = await asyncio.open_unix_connection(path)
+                writer.close()
+                break
+            except OSError:
+                pass
+            if time.monotonic() - started > self.start_timeout:
+                process.kill()
+                raise RuntimeError(f"Worker {slot} did not start within {self.start_timeout:.0f}s.")
+            await asyncio.sleep(0.2)
+        logging.info(f"Cluster: worker {slot} (pid {process.pid}) is ready after {time.monotonic() - started:.1f}s.")
+        return Worker(slot, path, process)
+
+    def _drain(self, worker: Worker):
+        if worker.process.poll() is None:
+            worker.process.terminate()
+        reaper = asyncio.ensure_future(self._reap(worker))
+        self._reapers.add(reaper)
+        reaper.add_done_callback(self._reapers.discard)
+
+    async def _reap(self, worker: Worker):
+        started = time.monotonic()
+        while worker.process.poll() is None:
+            if time.monotonic() - started > self.drain_timeout + DRAIN_GRACE:
+                logging.warning(f"Cluster: worker {worker.slot} (pid {worker.process.pid}) is still draining; killing it.")
+                worker.process.kill()
+            await asyncio.sleep(0.2)
+        logging.info(f"Cluster: worker {worker.slot} (pid {worker.process.pid}) exited after draining for "
+                     f"{time.monotonic() - started:.1f}s.")
+        try:
+            os.remove(worker.path)
+        except FileNotFoundError:
+            pass
+
+
+async def run_cluster(args):
+    runtime_dir = args.runtime_dir or tempfile.mkdtemp(prefix='teledrive-')
+    os.makedirs(runtime_dir, exist_ok=True)
+    router = Router(args.workers, args.cookie_name)
+    worker_command = [sys.executable, os.path.abspath(__file__), '--drain-timeout', str(args.drain_timeout), '--worker']
+    supervisor = Supervisor(router, args.workers, runtime_dir, worker_command, drain_timeout=args.drain_timeout)
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await supervisor.start()
+    except RuntimeError as e:
+        logging.error(f"Cluster: {e}")
+        await supervisor.stop()
+        sys.exit(1)
+    server = await asyncio.start_server(router.handle, args.host, args.port, limit=HEAD_LIMIT, backlog=4096)
+    loop.add_signal_handler(signal.SIGHUP, supervisor.request_restart)
+    watcher = asyncio.ensure_future(supervisor.watch())
+    logging.info(f"Cluster: {args.workers} workers serving http://{args.host}:{args.port} (sockets in {runtime_dir}).")
+
+    await stop.wait()
+    logging.info("Cluster: shutting down; draining the workers.")
+    server.close() # No new connections; the open ones are served until their workers have drained
+    watcher.cancel()
+    await supervisor.stop()
+    for connection in list(router.connections):
+        connection.close()
+    if not args.runtime_dir:
+        shutil.rmtree(runtime_dir, ignore_errors=True)
+
+
+def run_worker(socket_path: str, drain_timeout: float):
+    """Runs one worker: asgi.py under uvicorn on ``socket_path``, draining on SIGTERM."""
+    import uvicorn
+    import app as backend
+    from asgi import application
+
+    class WorkerServer(uvicorn.Server):
+        def handle_exit(self, sig, frame):
+            if not self.should_exit: # In a signal handler, so off to a thread: begin_drain() takes locks
+                threading.Thread(target=backend.begin_drain, daemon=True).start()
+            super().handle_exit(sig, frame)
+
+    for sig in (signal.SIGTERM, signal.SIGINT): # uvicorn raises the signal again once drained; exit through atexit
+        signal.signal(sig, lambda *_: sys.exit(0))
+    WorkerServer(uvicorn.Config(application, uds=socket_path, lifespan='on', log_level='warning', backlog=4096,
+                                timeout_graceful_shutdown=drain_timeout)).run()
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=int(os.getenv('CLUSTER_WORKERS', os.cpu_count() or 2)))
+    parser.add_argument('--host', default=os.getenv('CLUSTER_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', 5000)))
+    parser.add_argument('--drain-timeout', type=float, default=float(os.getenv('CLUSTER_DRAIN_TIMEOUT', 300)),
+                        help="Seconds a stopping worker may spend finishing its responses")
+    parser.add_argument('--runtime-dir', default=os.getenv('CLUSTER_RUNTIME_DIR'),
+                        help="Where the workers' sockets go; a temporary directory by default")
+    parser.add_argument('--cookie-name', default='session', help="Flask's SESSION_COOKIE_NAME")
+    parser.add_argument('--worker', metavar='SOCKET', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(args.worker, args.drain_timeout)
+        return
+    if args.workers < 1:
+        parser.error("--workers must be at least 1.")
+    if args.workers > 1 and os.getenv('SESSION_STORE', 'sqlite') == 'memory':
+        parser.error("SESSION_STORE=memory keeps sessions in one process; use sqlite or redis with several workers.")
+    os.environ.setdefault('MEDIA_CACHE_SHARED', 'True') # Inherited by the workers
+    source_host = '127.0.0.1' if args.host in ('', '0.0.0.0', '::') else args.host
+    os.environ.setdefault('PREVIEW_SOURCE_URL', f"http://{source_host}:{args.port}") # Workers reach the router
+    asyncio.run(run_cluster(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+import asyncio
+import collections
+import logging
+import threading
+import time
+import uuid
+
+from pyrogram import Client, raw
+from pyrogram.handlers import MessageHandler, EditedMessageHandler, DeletedMessagesHandler
+
+
+class ListenerLimitReached(Exception):
+    pass
+
+
+class Subscription:
+    """
+    One subscriber's pending events, waited on from a WSGI thread (get) or an event loop (aget).
+    Items are (event id, event name, data); a subscriber that falls ``max_pending`` events behind
+    loses them and gets a single 'resync' event instead.
+    """
+
+    def __init__(self, broker, owner, max_pending: int):
+        self.broker = broker
+        self.owner = owner
+        self.max_pending = max_pending
+        self.closed = False
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._overflowed = False
+        self._ready = threading.Event()
+        self._waker = None # (loop, asyncio.Event) of an aget() in progress
+
+    def get(self, timeout: float):
+        """The next event, or None if there was none within ``timeout`` seconds."""
+        item = self._pop()
+        if item is None and not self.closed and self._ready.wait(timeout):
+            item = self._pop()
+        return item
+
+    async def aget(self, timeout: float):
+        item = self._pop()
+        if item is not None:
+            return item
+        event = asyncio.Event()
+        self._waker = (asyncio.get_running_loop(), event)
+        try:
+            item = self._pop() # Anything pushed before the waker was in place
+            if item is None and not self.closed:
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    return None
+                item = self._pop()
+            return item
+        finally:
+            self._waker = None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broker._unsubscribe(self)
+            self._wake() # A get() or aget() in progress returns None at once
+
+    # --- Internals ---
+    def _push(self, item):
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self._pending.clear()
+                self._overflowed = True
+            elif not self._overflowed:
+                self._pending.append(item)
+        self._wake()
+
+    def _wake(self):
+        self._ready.set()
+        waker = self._waker
+        if waker is not None:
+            loop, event = waker
+            loop.call_soon_threadsafe(event.set)
+
+    def _pop(self):
+        with self._lock:
+            if self._overflowed:
+                self._overflowed = False
+                return None, 'resync', {}
+            if self._pending:
+                return self._pending.popleft()
+            self._ready.clear()
+            return None
+
+
+class EventBroker:
+    """
+    Fans each owner's (user's) events out to their subscribers, e.g. one per open browser tab. The last
+    ``replay_events`` events per owner are kept, so a subscriber reconnecting with the id of the last
+    event it saw (SSE's Last-Event-ID) gets what it missed; if that is no longer possible, for example
+    after a restart, it gets a 'resync' event telling it to list from scratch. Thread-safe.
+    """
+
+    def __init__(self, replay_events: int = 100, max_pending: int = 1000):
+        self.replay_events = replay_events
+        self.max_pending = max_pending
+        self.epoch = uuid.uuid4().hex[:8] # Event ids are "<epoch>.<sequence>"; ids from another run need a resync
+        self._lock = threading.Lock()
+        self._subscribers = {} # owner -> set of Subscription
+        self._recent = {} # owner -> deque of (sequence, event id, event name, data)
+        self._sequences = collections.Counter() # owner -> last sequence number used
+        self._published = 0
+
+    def subscribe(self, owner, last_event_id: str = None) -> Subscription:
+        subscription = Subscription(self, owner, self.max_pending)
+        with self._lock:
+            self._subscribers.setdefault(owner, set()).add(subscription)
+            if last_event_id:
+                for item in self._missed(owner, last_event_id):
+                    subscription._push(item)
+        return subscription
+
+    def publish(self, owner, event: str, data):
+        with self._lock:
+            self._sequences[owner] += 1
+            sequence = self._sequences[owner]
+            item = (f"{self.epoch}.{sequence}", event, data)
+            recent = self._recent.setdefault(owner, collections.deque(maxlen=self.replay_events))
+            recent.append((sequence, *item))
+            subscribers = list(self._subscribers.get(owner, ()))
+            self._published += 1
+        for subscription in subscribers:
+            subscription._push(item)
+
+    def subscribers(self, owner) -> int:
+        with self._lock:
+            return len(self._subscribers.get(owner, ()))
+
+    def close_all(self):
+        """Ends every subscription, e.g. so the event streams of a worker that is shutting down finish."""
+        with self._lock:
+            subscriptions = [subscription for subscribers in self._subscribers.values() for subscription in subscribers]
+        for subscription in subscriptions:
+            subscription.close()
+
+    def forget(self, owner):
+        """Drops an owner's replay history (e.g. on logout)."""
+        with self._lock:
+            self._recent.pop(owner, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'subscribers': sum(len(subscribers) for subscribers in self._subscribers.values()),
+                    'published': self._published}
+
+    # --- Internals ---
+    def _missed(self, owner, last_event_id: str) -> list:
+        epoch, _, sequence = last_event_id.partition('.')
+        recent = self._recent.get(owner, ())
+        if epoch != self.epoch or not sequence.isdigit():
+            return [(None, 'resync', {})]
+        sequence = int(sequence)
+        if recent and recent[0][0] > sequence + 1: # Some of the missed events were already dropped
+            return [(None, 'resync', {})]
+        return [tuple(item) for item_sequence, *item in recent if item_sequence > sequence]
+
+    def _unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.owner)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.owner]
+
+
+class _Listener:
+    def __init__(self, owner_id: int, session_string: str):
+        self.owner_id = owner_id
+        self.session_string = session_string
+        self.client = None
+        self.refs = 0
+        self.ready = asyncio.get_running_loop().create_future()
+        self.stop_task = None
+
+
+class UpdateListeners:
+    """
+    One long-lived Telegram client per user that receives updates (pooled clients are connected with
+    no_updates) and hands new, edited and deleted messages to ``on_message(owner_id, message, edited)``
+    and ``on_deleted(owner_id, messages)``. A listener starts with its owner's first acquire() and stops
+    ``idle_timeout`` seconds after the matching last release(), so users nobody is watching cost nothing.
+    Runs on the Telegram loop.
+    """
+
+    def __init__(self, api_id, api_hash, on_message, on_deleted, idle_timeout: float = 60, max_listeners: int = 256,
+                 scheduler=None, describe_key=str):
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self.on_message = on_message
+        self.on_deleted = on_deleted
+        self.idle_timeout = idle_timeout
+        self.max_listeners = max_listeners
+        self.scheduler = scheduler
+        self.describe_key = describe_key # Labels session strings in logs and the scheduler, like the client pool
+        self._listeners = {} # owner_id -> _Listener
+
+    async def acquire(self, owner_id: int, session_string: str) -> _Listener:
+        """
+        Makes sure ``owner_id`` has a running listener and returns it, to be handed back to release();
+        raises if the session is invalid.
+        """
+        listener = self._listeners.get(owner_id)
+        if listener is not None and listener.session_string != session_string: # Signed in again
+            await self.stop(owner_id)
+            listener = None
+        if listener is None:
+            if len(self._listeners) >= self.max_listeners:
+                raise ListenerLimitReached(f"At most {self.max_listeners} users can receive live updates at once.")
+            listener = self._listeners[owner_id] = _Listener(owner_id, session_string)
+            listener.refs += 1
+            try:
+                listener.client = await self._start(owner_id, session_string)
+            except BaseException as e:
+                self._listeners.pop(owner_id, None)
+                if isinstance(e, Exception):
+                    listener.ready.set_exception(e)
+                    listener.ready.exception() # Retrieved, so failures without waiters don't warn
+                else:
+                    listener.ready.cancel()
+                raise
+            listener.ready.set_result(True)
+            return listener
+        listener.refs += 1
+        if listener.stop_task is not None:
+            listener.stop_task.cancel()
+            listener.stop_task = None
+        try:
+            await asyncio.shield(listener.ready)
+        except BaseException:
+            listener.refs -= 1
+            raise
+        return listener
+
+    async def release(self, listener: _Listener):
+        """Gives back a listener from acquire(). One that was replaced (signed in again) or stopped is left alone."""
+        listener.refs -= 1
+        if self._listeners.get(listener.owner_id) is not listener:
+            return
+        if listener.refs <= 0 and listener.stop_task is None:
+            listener.stop_task = asyncio.get_running_loop().create_task(self._stop_when_idle(listener.owner_id, listener))
+
+    async def stop(self, owner_id: int):
+        """Stops ``owner_id``'s listener right away (logout, revoked session)."""
+        listener = self._listeners.pop(owner_id, None)
+        if listener is None:
+            return
+        if listener.stop_task is not None:
+            listener.stop_task.cancel()
+        if listener.client is not None:
+            try:
+                await listener.client.stop()
+            except Exception as e:
+                logging.info(f"Live updates: stopping the listener for owner {owner_id} failed: {e}")
+
+    async def close(self):
+        for owner_id in list(self._listeners):
+            await self.stop(owner_id)
+
+    def stats(self) -> dict:
+        return {'listeners': len(self._listeners), 'max_listeners': self.max_listeners}
+
+    # --- Internals ---
+    async def _start(self, owner_id: int, session_string: str) -> Client:
+        client = Client(name=f"listener_{owner_id}", api_id=self.api_id, api_hash=self.api_hash,
+                        session_string=session_string, in_memory=True, workers=2)
+
+        async def new_message(_, message):
+            await self._dispatch(self.on_message, owner_id, message, False)
+
+        async def edited_message(_, message):
+            await self._dispatch(self.on_message, owner_id, message, True)
+
+        async def deleted_messages(_, messages):
+            await self._dispatch(self.on_deleted, owner_id, messages)
+
+        client.add_handler(MessageHandler(new_message))
+        client.add_handler(EditedMessageHandler(edited_message))
+        client.add_handler(DeletedMessagesHandler(deleted_messages))
+        if self.scheduler is not None:
+            self.scheduler.register(client, self.describe_key(session_string))
+        started = time.monotonic()
+        # Not Client.start(): that would prompt on stdin if the session were no longer authorized
+        await client.connect()
+        try:
+            await client.invoke(raw.functions.updates.GetState()) # Tells Telegram to start sending updates
+            await client.initialize()
+        except BaseException:
+            await client.disconnect()
+            raise
+        logging.info(f"Live updates: listening for owner {owner_id} ({len(self._listeners)} listeners, "
+                     f"started in {time.monotonic() - started:.2f}s).")
+        return client
+
+    async def _stop_when_idle(self, owner_id: int, listener: _Listener):
+        await asyncio.sleep(self.idle_timeout)
+        if self._listeners.get(owner_id) is listener and listener.refs <= 0:
+            listener.stop_task = None
+            await self.stop(owner_id)
+            logging.info(f"Live updates: stopped the idle listener for owner {owner_id}.")
+
+    @staticmethod
+    async def _dispatch(handler, *args):
+        try:
+            await handler(*args)
+        except Exception as e:
+            logging.error(f"Live updates: handling an update for owner {args[0]} failed: {e}", exc_info=True)
@@ -0,0 +1,540 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError: # Windows; only shared caches need it
+    fcntl = None
+
+CLAIMS_FILE = '.claims' # In a shared cache directory: one lockable byte per key, held by the process filling it
+
+
+class CacheFillError(Exception):
+    """Raised to readers following a fill that was aborted before it completed."""
+
+
+class CacheFill:
+    """
+    An in-progress download into the cache. The writer appends chunks to a temp file while any
+    number of readers follow it, so concurrent viewers of an uncached file share one Telegram download.
+    """
+
+    def __init__(self, cache: "MediaCache", key: str, expected_size: int):
+        self.cache = cache
+        self.key = key
+        self.expected_size = expected_size
+        self.temp_path = cache.temp_path_for(key)
+        os.makedirs(os.path.dirname(self.temp_path), exist_ok=True)
+        self._file = open(self.temp_path, 'wb')
+        self.written = 0
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self.on_abandoned = None # Set by the writer to stop downloading once every reader has gone away
+        self._condition = threading.Condition()
+
+    # --- Writer side ---
+    def write(self, chunk: bytes):
+        self._file.write(chunk)
+        self._file.flush() # Readers open the temp file separately; make the bytes visible to them
+        with self._condition:
+            self.written += len(chunk)
+            self._condition.notify_all()
+
+    def finish(self):
+        """Atomically publishes the temp file under its final name."""
+        self._file.close()
+        if self.expected_size and self.written != self.expected_size:
+            self.abort(CacheFillError(f"Expected {self.expected_size} bytes for {self.key}, got {self.written}."))
+            return
+        os.replace(self.temp_path, self.cache.path_for(self.key))
+        with self._condition:
+            self.done = True
+            self._condition.notify_all()
+        self.cache._complete_fill(self, success=True)
+
+    def abort(self, error: Exception = None):
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.remove(self.temp_path) # Readers that still hold it open keep reading the unlinked inode
+        except FileNotFoundError:
+            pass
+        with self._condition:
+            self.error = error or CacheFillError(f"Cache fill for {self.key} was aborted.")
+            self._condition.notify_all()
+        self.cache._complete_fill(self, success=False)
+
+    # --- Reader side ---
+    def _open_for_reading(self):
+        try:
+            return open(self.temp_path, 'rb') # os.replace() on finish keeps this descriptor valid
+        except FileNotFoundError:
+            with self._condition:
+                if self.error:
+                    raise self.error
+            return open(self.cache.path_for(self.key), 'rb') # Already published
+
+
+    def wait(self, timeout=None) -> bool:
+        """Blocks until the fill completes; raises if it was aborted."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.done or self.error, timeout)
+            if self.error:
+                raise self.error
+            return self.done
+
+    def iter_range(self, start: int, stop: int, chunk_size=1024 * 1024, stall_timeout=60):
+        """Yields bytes [start, stop) as soon as the writer has produced them."""
+        with self._condition:
+            self.readers += 1
+        try:
+            with self._open_for_reading() as f:
+                position = start
+                while position < stop:
+                    with self._condition:
+                        if not self._condition.wait_for(
+                                lambda: self.written > position or self.done or self.error, stall_timeout):
+                            raise CacheFillError(f"Cache fill for {self.key} stalled.")
+                        if self.error and self.written <= position:
+                            raise self.error
+                        available = min(stop, self.written)
+                    if available <= position: # Done but shorter than requested; nothing more will come
+                        break
+                    f.seek(position)
+                    data = f.read(min(chunk_size, available - position))
+                    if not data:
+                        break
+                    position += len(data)
+                    yield data
+        finally:
+            with self._condition:
+                self.readers -= 1
+                complete = self.expected_size and self.written >= self.expected_size # Only finish() is left
+                abandoned = self.readers == 0 and not self.done and not self.error and not complete
+            if abandoned and self.on_abandoned:
+                self.on_abandoned()
+
+
+class SharedCacheFill:
+    """
+    A fill that another process sharing the cache directory is writing, followed through its temp file
+    (which keeps its inode when it is published) by polling. Offers the reader side of CacheFill.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, cache: "MediaCache", key: str):
+        self.cache = cache
+        self.key = key
+        self.temp_path = cache.temp_path_for(key)
+
+    @property
+    def written(self) -> int:
+        for path in (self.temp_path, self.cache.path_for(self.key)):
+            try:
+                return os.stat(path).st_size
+            except FileNotFoundError:
+                pass
+        return 0
+
+    def wait(self, timeout=None) -> bool:
+        """Blocks until the fill completes; raises if it was aborted."""
+        deadline = time.monotonic() + (timeout if timeout is not None else 60)
+        with self._open(deadline) as f:
+            while (state := self._state(f)) == 'running':
+                if time.monotonic() > deadline:
+                    return False
+                time.sleep(self.poll_interval)
+        if state == 'aborted':
+            raise CacheFillError(f"Cache fill for {self.key} in another process was aborted.")
+        return True
+
+    def iter_range(self, start: int, stop: int, chunk_size=1024 * 1024, stall_timeout=60):
+        """Yields bytes [start, stop) as soon as the other process has written them."""
+        with self._open(time.monotonic() + stall_timeout) as f:
+            position, progressed_at = start, time.monotonic()
+            while position < stop:
+                state = self._state(f) # Before the size, so a finished file is read to its end
+                available = min(stop, os.fstat(f.fileno()).st_size)
+                if available > position:
+                    f.seek(position)
+                    data = f.read(min(chunk_size, available - position))
+                    position += len(data)
+                    progressed_at = time.monotonic()
+                    yield data
+                elif state == 'done': # Shorter than requested; nothing more will come
+                    break
+                elif state == 'aborted':
+                    raise CacheFillError(f"Cache fill for {self.key} in another process was aborted.")
+                elif time.monotonic() - progressed_at > stall_timeout:
+                    raise CacheFillError(f"Cache fill for {self.key} stalled.")
+                else:
+                    time.sleep(self.poll_interval)
+
+    # --- Internals ---
+    def _open(self, deadline: float):
+        while True:
+            for path in (self.temp_path, self.cache.path_for(self.key)): # Already published if there's no temp file
+                try:
+                    return open(path, 'rb')
+                except FileNotFoundError:
+                    pass
+            if time.monotonic() > deadline:
+                raise CacheFillError(f"Cache fill for {self.key} in another process went away.")
+            time.sleep(self.poll_interval)
+
+    def _state(self, f) -> str:
+        """'done' once the file ``f`` reads was published, 'running' while it's written, else 'aborted'."""
+        inode = os.fstat(f.fileno()).st_ino
+        final_path = self.cache.path_for(self.key)
+        for path, state in ((final_path, 'done'), (self.temp_path, 'running'), (final_path, 'done')): # Around a rename
+            try:
+                if os.stat(path).st_ino == inode:
+                    return state
+            except FileNotFoundError:
+                pass
+        return 'aborted'
+
+
+class MediaCache:
+    """
+    Content-addressed on-disk cache of Telegram files keyed by ``file_unique_id``.
+
+    Files are written to a temp file and published with an atomic rename, the total size is kept
+    under ``max_bytes`` by evicting the least recently used files, and concurrent requests for the
+    same uncached key share a single CacheFill.
+
+    With ``shared``, several processes (cluster.py's workers) use the same directory: a key is filled by
+    whichever process claims it in the claims file, the others follow that fill (SharedCacheFill), files
+    cached by another process are picked up on lookup, and the index is re-read from disk every
+    ``rescan_interval`` seconds so ``max_bytes`` holds for the directory as a whole.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_file_bytes: int = None, shared: bool = False,
+                 rescan_interval: float = 60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes if max_file_bytes is not None else max_bytes // 4
+        self.shared = shared
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> size in bytes, least recently used first
+        self._fills = {} # key -> CacheFill in progress
+        self._reserved = 0 # Bytes promised to fills in progress
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._claims = None
+        self._scanned_at = time.monotonic()
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            if shared:
+                if fcntl is None:
+                    raise ValueError("A shared media cache needs POSIX file locks (fcntl).")
+                self._claims = open(os.path.join(directory, CLAIMS_FILE), 'a+b')
+            self._load_index()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def path_for(self, key: str) -> str:
+        safe_key = re.sub(r'[^A-Za-z0-9_-]', '_', key)
+        return os.path.join(self.directory, safe_key[:2], safe_key) # Shard to keep directories small
+
+    def temp_path_for(self, key: str) -> str:
+        if self.shared: # One name, so other processes can follow the fill; the claim keeps it to one writer
+            return f"{self.path_for(key)}.part"
+        return f"{self.path_for(key)}.{os.getpid()}.{threading.get_ident()}.part"
+
+    def can_cache(self, size: int) -> bool:
+        return self.enabled and 0 < size <= self.max_file_bytes
+
+    def contains(self, key: str) -> bool:
+        """Whether ``key`` is cached, without counting a hit or miss or touching its recency."""
+        with self._lock:
+            if bool(key) and key in self._entries:
+                return True
+        return bool(key) and self.shared and os.path.exists(self.path_for(key))
+
+    def lookup(self, key: str):
+        """Returns the path of a cached file and marks it recently used, or None on a miss."""
+        if not self.enabled or not key:
+            return None
+        with self._lock:
+            known = key in self._entries
+            if known:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if not known and not (self.shared and self._adopt(key)): # Another process may have cached it
+            with self._lock:
+                self.misses += 1
+            return None
+        path = self.path_for(key)
+        try:
+            os.utime(path) # Persist recency so LRU order survives restarts
+        except FileNotFoundError: # Removed behind our back
+            with self._lock:
+                self.total_bytes -= self._entries.pop(key, 0)
+            return None
+        return path
+
+    def get_or_create_fill(self, key: str, expected_size: int):
+        """
+        Returns ``(fill, created)``. Exactly one caller gets ``created=True`` and must write the data
+        and call finish() or abort(); everybody else just reads from the returned fill.
+        """
+        self._rescan_if_due()
+        with self._lock:
+            fill = self._fills.get(key)
+            if fill is not None:
+                return fill, False
+            if self.shared and not self._claim(key): # Another process is filling it
+                return SharedCacheFill(self, key), False
+            self._make_room(expected_size)
+            fill = CacheFill(self, key, expected_size)
+            self._fills[key] = fill
+            self._reserved += expected_size
+            return fill, True
+
+    def active_fill(self, key: str):
+        with self._lock:
+            fill = self._fills.get(key)
+        if fill is None and key and self.shared and os.path.exists(self.temp_path_for(key)):
+            return SharedCacheFill(self, key)
+        return fill
+
+    def store(self, key: str, data: bytes):
+        """Writes a small blob (e.g. a thumbnail) in one go."""
+        fill, created = self.get_or_create_fill(key, len(data))
+        if created:
+            fill.write(data)
+            fill.finish()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'files': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'fills_in_progress': len(self._fills),
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+    # --- Internals ---
+    def _load_index(self):
+        for _, name, size in self._scan(remove_parts=True):
+            self._entries[name] = size
+            self.total_bytes += size
+        logging.info(f"Media cache: {len(self._entries)} files, {self.total_bytes} bytes in {self.directory}"
+                     f"{' (shared)' if self.shared else ''}.")
+
+    def _scan(self, remove_parts: bool) -> list:
+        """Cached files on disk as (mtime, key, size), least recently used first."""
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.startswith('.'): # The claims file
+                    continue
+                if name.endswith('.part'):
+                    key = name.split('.', 1)[0]
+                    # Left over from a crash mid-fill, unless another process sharing the cache is writing it
+                    if remove_parts and (not self.shared or self._claim(key)):
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                        if self.shared:
+                            self._release(key)
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                found.append((stat.st_mtime, name, stat.st_size))
+        return sorted(found)
+
+    def _rescan_if_due(self):
+        """Re-reads a shared cache's index from disk, which other processes add to and evict from."""
+        if not self.shared or not self.enabled or time.monotonic() - self._scanned_at < self.rescan_interval:
+            return
+        self._scanned_at = time.monotonic()
+        found = self._scan(remove_parts=False)
+        with self._lock:
+            self._entries = OrderedDict((name, size) for _, name, size in found)
+            self.total_bytes = sum(size for _, _, size in found)
+
+    def _adopt(self, key: str) -> bool:
+        """Adds a file another process cached to the index; False if there is none."""
+        try:
+            size = os.stat(self.path_for(key)).st_size
+        except FileNotFoundError:
+            return False
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = size
+                self.total_bytes += size
+            self.hits += 1
+        return True
+
+    def _claim(self, key: str) -> bool:
+        """Takes ``key``'s byte in the claims file, or returns False if another process holds it."""
+        try:
+            fcntl.lockf(self._claims, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self._claim_offset(key))
+            return True
+        except OSError:
+            return False
+
+    def _release(self, key: str):
+        fcntl.lockf(self._claims, fcntl.LOCK_UN, 1, self._claim_offset(key))
+
+    def _claim_offset(self, key: str) -> int:
+        # One byte per key name; POSIX locks are per process, so threads rely on _fills instead
+        return zlib.crc32(os.path.basename(self.path_for(key)).encode())
+
+    def _make_room(self, incoming: int):
+        """Evicts least recently used files until ``incoming`` more bytes fit. Caller holds the lock."""
+        while self._entries and self.total_bytes + self._reserved + incoming > self.max_bytes:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path_for(key)) # Open readers (e.g. sendfile in progress) keep their copy
+            except FileNotFoundError:
+                pass
+            logging.info(f"Media cache: evicted {key} ({size} bytes).")
+
+    def _complete_fill(self, fill: CacheFill, success: bool):
+        with self._lock:
+            if self._fills.get(fill.key) is fill:
+                del self._fills[fill.key]
+                self._reserved -= fill.expected_size
+            if success:
+                self.total_bytes -= self._entries.pop(fill.key, 0)
+                self._entries[fill.key] = fill.written
+                self.total_bytes += fill.written
+                self._make_room(0)
+        if self.shared: # After the rename, so processes following it see it published
+            self._release(fill.key)
+
+
+class ThumbnailCache:
+    """
+    Two-level thumbnail cache: an in-memory LRU of raw bytes bounded by ``memory_max_bytes`` in front
+    of a dedicated on-disk MediaCache, so large videos never push thumbnails out of the disk budget.
+    """
+
+    def __init__(self, disk: MediaCache, memory_max_bytes: int):
+        self.disk = disk
+        self.memory_max_bytes = memory_max_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict() # key -> bytes, least recently used first
+        self._memory_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            if key in self._memory:
+                return True
+        return self.disk.contains(key)
+
+    def get(self, key: str):
+        """Returns cached thumbnail bytes, or None on a miss. May read from disk; see get_or_fetch."""
+        data = self._from_memory(key)
+        return data if data is not None else self._from_disk(key)
+
+    async def get_or_fetch(self, key: str, fetch) -> bytes:
+        """
+        Returns the thumbnail for ``key``, calling ``await fetch()`` on a miss. Concurrent misses for the
+        same key (from any thread or event loop) share one fetch via the disk cache's fill mechanism.
+        Only memory hits are answered on the calling loop; disk reads and writes run in worker threads.
+        """
+        data = self._from_memory(key)
+        if data is None:
+            data = await asyncio.to_thread(self._from_disk, key)
+        if data is not None:
+            return data
+        if not self.disk.enabled:
+            data = await fetch()
+            self._remember(key, data)
+            return data
+
+        fill, created = await asyncio.to_thread(self.disk.get_or_create_fill, key, 0)
+        if not created:
+            await asyncio.to_thread(fill.wait, 60)
+            data = await asyncio.to_thread(self.get, key)
+            if data is not None:
+                return data
+            return await fetch() # Evicted in the meantime; fetch without caching
+        try:
+            data = await fetch()
+        except BaseException as e:
+            fill.abort(e if isinstance(e, Exception) else None)
+            raise
+        await asyncio.to_thread(_write_fill, fill, data)
+        self._remember(key, data)
+        return data
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_items': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'memory_max_bytes': self.memory_max_bytes,
+                'disk': self.disk.stats(),
+                'hit_ratio': round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else None,
+            }
+
+    def _from_memory(self, key: str):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+            return data
+
+    def _from_disk(self, key: str):
+        path = self.disk.lookup(key)
+        if path:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = None
+            if data is not None:
+                self._remember(key, data)
+                with self._lock:
+                    self.disk_hits += 1
+                return data
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.memory_max_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous)
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.memory_max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+
+def _write_fill(fill: CacheFill, data: bytes):
+    fill.write(data)
+    fill.finish()
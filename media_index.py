@@ -0,0 +1,484 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+SCHEMA_VERSION = 3 # Bump when a table changes shape, and say in _migrate() how older databases catch up
+
+VALIDATE_BATCH_SIZE = 100 # Message ids per get_messages call when re-checking indexed rows
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    id INTEGER PRIMARY KEY, -- rowid, referenced by the FTS table
+    owner_id INTEGER NOT NULL,
+    shard INTEGER NOT NULL DEFAULT 0, -- Storage chat (see storage.py); message ids are per chat
+    message_id INTEGER NOT NULL,
+    name TEXT NOT NULL COLLATE NOCASE,
+    type TEXT NOT NULL,
+    mime_type TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    timestamp INTEGER NOT NULL,
+    caption TEXT,
+    tags TEXT NOT NULL DEFAULT '[]', -- JSON list, as in MediaItem.tags
+    file_unique_id TEXT,
+    has_thumbnail INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (owner_id, shard, message_id)
+);
+CREATE INDEX IF NOT EXISTS media_owner_timestamp ON media (owner_id, timestamp);
+CREATE INDEX IF NOT EXISTS media_owner_type_size ON media (owner_id, type, size);
+CREATE INDEX IF NOT EXISTS media_owner_size ON media (owner_id, size);
+CREATE INDEX IF NOT EXISTS media_owner_name ON media (owner_id, name); -- Serves case-insensitive prefix LIKE
+CREATE INDEX IF NOT EXISTS media_unique_id ON media (file_unique_id);
+
+CREATE TABLE IF NOT EXISTS media_tags (
+    owner_id INTEGER NOT NULL,
+    tag TEXT NOT NULL COLLATE NOCASE,
+    shard INTEGER NOT NULL DEFAULT 0,
+    message_id INTEGER NOT NULL,
+    PRIMARY KEY (owner_id, tag, shard, message_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS content_hashes (
+    owner_id INTEGER NOT NULL,
+    sha256 TEXT NOT NULL, -- Hex digest of the file's bytes
+    size INTEGER NOT NULL,
+    message_id INTEGER NOT NULL, -- A message already holding these bytes
+    shard INTEGER NOT NULL DEFAULT 0, -- ... in this storage chat
+    PRIMARY KEY (owner_id, sha256, size)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS content_hashes_message ON content_hashes (owner_id, message_id);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    owner_id INTEGER NOT NULL,
+    shard INTEGER NOT NULL DEFAULT 0,
+    newest_id INTEGER NOT NULL DEFAULT 0, -- Everything newer than this still needs syncing
+    oldest_id INTEGER NOT NULL DEFAULT 0, -- Backfill resumes below this id
+    backfill_complete INTEGER NOT NULL DEFAULT 0,
+    validated_id INTEGER NOT NULL DEFAULT 0, -- Re-validation resumes below this id; 0 starts again from the newest
+    synced_at REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (owner_id, shard)
+);
+
+CREATE TABLE IF NOT EXISTS storage_chats (
+    owner_id INTEGER NOT NULL,
+    shard INTEGER NOT NULL, -- 1 and up; shard 0 is always Saved Messages
+    chat_id INTEGER NOT NULL,
+    access_hash INTEGER NOT NULL, -- Lets any client address the channel without looking it up first
+    PRIMARY KEY (owner_id, shard)
+);
+
+CREATE TABLE IF NOT EXISTS video_probes (
+    file_unique_id TEXT PRIMARY KEY, -- The same file in any chat, for any user
+    duration REAL NOT NULL, -- Seconds; 0 if ffprobe found no video stream
+    width INTEGER,
+    height INTEGER
+) WITHOUT ROWID;
+"""
+
+# Run on databases from before SCHEMA_VERSION 2; the dropped tables are a cache of Telegram history
+MIGRATION_V2 = """
+DROP TABLE IF EXISTS media_fts;
+DROP TABLE IF EXISTS media;
+DROP TABLE IF EXISTS media_tags;
+DROP TABLE IF EXISTS sync_state;
+"""
+
+# Trigram FTS gives indexed substring search on file names (SQLite 3.34+); LIKE is the fallback
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS media_fts USING fts5(name, content='media', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS media_fts_insert AFTER INSERT ON media BEGIN
+    INSERT INTO media_fts (rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS media_fts_delete AFTER DELETE ON media BEGIN
+    INSERT INTO media_fts (media_fts, rowid, name) VALUES ('delete', old.id, old.name);
+END;
+CREATE TRIGGER IF NOT EXISTS media_fts_update AFTER UPDATE OF name ON media BEGIN
+    INSERT INTO media_fts (media_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    INSERT INTO media_fts (rowid, name) VALUES (new.id, new.name);
+END;
+"""
+
+
+class MediaIndex:
+    """
+    Local SQLite index of every media message in each user's storage chats (Saved Messages and any
+    storage channels), built from describe_media_message() records, so searches never have to walk
+    Telegram history. Also remembers each user's storage channels and what ffprobe found in videos.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local() # One connection per thread; WAL lets readers and a writer overlap
+        self._write_lock = threading.Lock()
+        connection = self._connection()
+        self._migrate(connection)
+        connection.executescript(SCHEMA)
+        try:
+            connection.executescript(FTS_SCHEMA)
+            self.has_fts = True
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Media index: trigram FTS unavailable ({e}); name search falls back to LIKE.")
+            self.has_fts = False
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _migrate(connection: sqlite3.Connection):
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        exists = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'media'").fetchone()
+        if exists and version < 2:
+            logging.info("Media index: adding storage shards; the index will be rebuilt from Telegram history.")
+            connection.executescript(MIGRATION_V2)
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'content_hashes'").fetchone():
+                connection.execute("ALTER TABLE content_hashes ADD COLUMN shard INTEGER NOT NULL DEFAULT 0")
+        elif exists and version < 3:
+            connection.execute("ALTER TABLE sync_state ADD COLUMN validated_id INTEGER NOT NULL DEFAULT 0")
+        connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    # --- Writes ---
+    def upsert(self, owner_id: int, records: list[dict]):
+        """Inserts or refreshes describe_media_message() records for one user."""
+        if not records:
+            return
+        rows = [(owner_id, r.get('shard', 0), r['message_id'], r['name'], r['type'], r['mime_type'], r['size'],
+                 r['timestamp'], r['caption'], json.dumps(r['tags']), r['file_unique_id'], int(r['has_thumbnail']))
+                for r in records]
+        tag_rows = [(owner_id, tag, r.get('shard', 0), r['message_id']) for r in records for tag in set(r['tags'])]
+        message_ids = [(owner_id, r.get('shard', 0), r['message_id']) for r in records]
+        with self._write_lock, self._connection() as connection:
+            connection.executemany("""
+                INSERT INTO media (owner_id, shard, message_id, name, type, mime_type, size, timestamp, caption, tags,
+                                   file_unique_id, has_thumbnail)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (owner_id, shard, message_id) DO UPDATE SET
+                    name = excluded.name, type = excluded.type, mime_type = excluded.mime_type, size = excluded.size,
+                    timestamp = excluded.timestamp, caption = excluded.caption, tags = excluded.tags,
+                    file_unique_id = excluded.file_unique_id, has_thumbnail = excluded.has_thumbnail
+            """, rows)
+            connection.executemany("DELETE FROM media_tags WHERE owner_id = ? AND shard = ? AND message_id = ?", message_ids)
+            connection.executemany("INSERT OR IGNORE INTO media_tags (owner_id, tag, shard, message_id) VALUES (?, ?, ?, ?)",
+                                   tag_rows)
+
+    def delete(self, owner_id: int, message_ids: list[int], shard: int = 0):
+        rows = [(owner_id, shard, message_id) for message_id in message_ids]
+        with self._write_lock, self._connection() as connection:
+            connection.executemany("DELETE FROM media WHERE owner_id = ? AND shard = ? AND message_id = ?", rows)
+            connection.executemany("DELETE FROM media_tags WHERE owner_id = ? AND shard = ? AND message_id = ?", rows)
+            connection.executemany("DELETE FROM content_hashes WHERE owner_id = ? AND shard = ? AND message_id = ?", rows)
+
+    def reconcile(self, owner_id: int, shard: int, low_id: int, high_id: int, present_ids) -> list[int]:
+        """
+        Drops the rows of messages from ``low_id`` to ``high_id`` (inclusive) that aren't in ``present_ids``:
+        that stretch of the chat's history was just read, so they have been deleted in Telegram. Returns their ids.
+        """
+        rows = self._connection().execute(
+            "SELECT message_id FROM media WHERE owner_id = ? AND shard = ? AND message_id BETWEEN ? AND ?",
+            (owner_id, shard, low_id, high_id)).fetchall()
+        removed = [row[0] for row in rows if row[0] not in present_ids]
+        if removed:
+            self.delete(owner_id, removed, shard)
+        return removed
+
+    def save_content_hash(self, owner_id: int, sha256: str, size: int, message_id: int, shard: int = 0):
+        with self._write_lock, self._connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO content_hashes (owner_id, sha256, size, message_id, shard) "
+                               "VALUES (?, ?, ?, ?, ?)", (owner_id, sha256, size, message_id, shard))
+
+    def forget_content_hash(self, owner_id: int, sha256: str, size: int):
+        with self._write_lock, self._connection() as connection:
+            connection.execute("DELETE FROM content_hashes WHERE owner_id = ? AND sha256 = ? AND size = ?",
+                               (owner_id, sha256, size))
+
+    def find_content_hash(self, owner_id: int, sha256: str, size: int):
+        """Returns ``(shard, message_id)`` of a message holding exactly these bytes, or None."""
+        row = self._connection().execute(
+            "SELECT shard, message_id FROM content_hashes WHERE owner_id = ? AND sha256 = ? AND size = ?",
+            (owner_id, sha256, size)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def get_sync_state(self, owner_id: int, shard: int = 0) -> dict:
+        row = self._connection().execute("SELECT * FROM sync_state WHERE owner_id = ? AND shard = ?",
+                                          (owner_id, shard)).fetchone()
+        if row is None:
+            return {'owner_id': owner_id, 'shard': shard, 'newest_id': 0, 'oldest_id': 0, 'backfill_complete': False,
+                    'validated_id': 0, 'synced_at': 0}
+        state = dict(row)
+        state['backfill_complete'] = bool(state['backfill_complete'])
+        return state
+
+    def save_sync_state(self, owner_id: int, shard: int = 0, **changes):
+        state = self.get_sync_state(owner_id, shard)
+        state.update(changes)
+        with self._write_lock, self._connection() as connection:
+            connection.execute("""
+                INSERT OR REPLACE INTO sync_state (owner_id, shard, newest_id, oldest_id, backfill_complete, validated_id,
+                                                   synced_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (owner_id, shard, state['newest_id'], state['oldest_id'], int(state['backfill_complete']),
+                  state['validated_id'], state['synced_at']))
+
+    def get_storage_chats(self, owner_id: int) -> dict:
+        """Returns the user's storage channels as {shard: (chat_id, access_hash)}."""
+        rows = self._connection().execute("SELECT shard, chat_id, access_hash FROM storage_chats WHERE owner_id = ?",
+                                          (owner_id,)).fetchall()
+        return {row['shard']: (row['chat_id'], row['access_hash']) for row in rows}
+
+    def save_storage_chat(self, owner_id: int, shard: int, chat_id: int, access_hash: int):
+        with self._write_lock, self._connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO storage_chats (owner_id, shard, chat_id, access_hash) VALUES (?, ?, ?, ?)",
+                               (owner_id, shard, chat_id, access_hash))
+
+    def save_video_probe(self, file_unique_id: str, duration: float, width: int, height: int):
+        with self._write_lock, self._connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO video_probes (file_unique_id, duration, width, height) VALUES (?, ?, ?, ?)",
+                               (file_unique_id, duration, width, height))
+
+    # --- Reads ---
+    def get_video_probe(self, file_unique_id: str):
+        """Returns ``(duration, width, height)`` as ffprobe found them for this file, or None if it never ran."""
+        row = self._connection().execute("SELECT duration, width, height FROM video_probes WHERE file_unique_id = ?",
+                                         (file_unique_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def search(self, owner_id: int, query: str = None, prefix: str = None, tags: list[str] = None,
+               media_type: str = None, min_size: int = None, max_size: int = None,
+               min_timestamp: int = None, max_timestamp: int = None,
+               limit: int = 100, offset: int = 0) -> list[dict]:
+        """
+        Returns matching records, newest first. ``query`` is a case-insensitive substring of the file name,
+        ``prefix`` a case-insensitive file name prefix, and every tag in ``tags`` must be present.
+        Timestamps are Unix milliseconds, inclusive.
+        """
+        clauses, params = ["m.owner_id = ?"], [owner_id]
+        if query:
+            if self.has_fts and len(query) >= 3: # Trigrams need at least three characters
+                clauses.append("m.id IN (SELECT rowid FROM media_fts WHERE media_fts MATCH ?)")
+                params.append('"' + query.replace('"', '""') + '"')
+            else:
+                clauses.append("m.name LIKE ? ESCAPE '\\'")
+                params.append('%' + _escape_like(query) + '%')
+        if prefix:
+            clauses.append("m.name LIKE ? ESCAPE '\\'")
+            params.append(_escape_like(prefix) + '%')
+        for tag in tags or []:
+            clauses.append("(m.shard, m.message_id) IN (SELECT shard, message_id FROM media_tags WHERE owner_id = ? AND tag = ?)")
+            params.extend([owner_id, tag.lstrip('#')])
+        if media_type:
+            clauses.append("m.type = ?")
+            params.append(media_type)
+        if min_size is not None:
+            clauses.append("m.size >= ?")
+            params.append(min_size)
+        if max_size is not None:
+            clauses.append("m.size <= ?")
+            params.append(max_size)
+        if min_timestamp is not None:
+            clauses.append("m.timestamp >= ?")
+            params.append(min_timestamp)
+        if max_timestamp is not None:
+            clauses.append("m.timestamp <= ?")
+            params.append(max_timestamp)
+        sql = (f"SELECT m.* FROM media m WHERE {' AND '.join(clauses)} "
+               f"ORDER BY m.timestamp DESC, m.shard DESC, m.message_id DESC LIMIT ? OFFSET ?")
+        rows = self._connection().execute(sql, params + [limit, offset]).fetchall()
+        return [self._record(row) for row in rows]
+
+    def message_ids(self, owner_id: int, shard: int, below_id: int = 0, limit: int = 1000) -> list[int]:
+        """Ids of up to ``limit`` indexed messages in one storage chat, newest first, below ``below_id`` (0: any)."""
+        rows = self._connection().execute(
+            "SELECT message_id FROM media WHERE owner_id = ? AND shard = ? AND (? = 0 OR message_id < ?) "
+            "ORDER BY message_id DESC LIMIT ?", (owner_id, shard, below_id, below_id, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def count(self, owner_id: int) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM media WHERE owner_id = ?", (owner_id,)).fetchone()[0]
+
+    @staticmethod
+    def _record(row: sqlite3.Row) -> dict:
+        record = dict(row)
+        record.pop('id', None)
+        record.pop('owner_id', None)
+        record['tags'] = json.loads(record['tags'])
+        record['has_thumbnail'] = bool(record['has_thumbnail'])
+        return record
+
+
+def _escape_like(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class MediaIndexSyncer:
+    """
+    Keeps a user's index current: for each storage chat, first pulls anything newer than the newest
+    indexed message, then backfills older history in batches, persisting progress so a restart resumes
+    where it stopped. Indexed messages that a stretch of history read this way no longer holds were deleted
+    from another client and are dropped. Older rows are re-checked with get_messages, ``validate_size`` per
+    chat and pass, cycling through the index, which also picks up edited captions.
+    At most one sync runs per user; ``run_sync`` is called on the Telegram loop with a pooled client, and
+    every index read and write it makes runs in a worker thread so the loop never waits on SQLite.
+    """
+
+    def __init__(self, index: MediaIndex, describe, batch_size=500, validate_size=1000, on_removed=None):
+        self.index = index
+        self.describe = describe # describe_media_message from app.py
+        self.batch_size = batch_size
+        self.validate_size = validate_size
+        self.on_removed = on_removed # on_removed(owner_id, shard, message_ids), on the loop, for rows dropped
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def is_running(self, owner_id: int) -> bool:
+        with self._lock:
+            return owner_id in self._running
+
+    def claim(self, owner_id: int) -> bool:
+        """Marks a sync as running; returns False if one already is."""
+        with self._lock:
+            if owner_id in self._running:
+                return False
+            self._running.add(owner_id)
+            return True
+
+    def release(self, owner_id: int):
+        with self._lock:
+            self._running.discard(owner_id)
+
+    async def run_sync(self, client, owner_id: int, chats: dict = None):
+        """Syncs each of the user's storage chats ({shard: chat id}; just Saved Messages by default) concurrently."""
+        started = time.monotonic()
+        chats = chats or {0: "me"}
+        await asyncio.gather(*(self._sync_chat(client, owner_id, shard, chat_id) for shard, chat_id in chats.items()))
+        count = await asyncio.to_thread(self.index.count, owner_id)
+        logging.info(f"Media index: synced owner {owner_id} in {time.monotonic() - started:.1f}s "
+                     f"({count} items indexed across {len(chats)} chats).")
+
+    async def _sync_chat(self, client, owner_id: int, shard: int, chat_id):
+        state = await asyncio.to_thread(self.index.get_sync_state, owner_id, shard)
+        stretch = _Stretch()
+
+        # 1. Forward: everything newer than the newest indexed message. The very first run walks the whole
+        #    history this way, so it checkpoints as it goes and doubles as the backfill.
+        first_run = not state['newest_id']
+        top_id = last_id = None
+        async for message in client.get_chat_history(chat_id):
+            stretch.cover(message)
+            if not first_run and message.id <= state['newest_id']:
+                break
+            top_id = top_id or message.id
+            last_id = message.id
+            self._collect(stretch, message, shard)
+            if first_run and len(stretch.records) >= self.batch_size:
+                await self._flush(owner_id, shard, stretch, newest_id=top_id, oldest_id=last_id)
+        else:
+            stretch.cover_to_start()
+        if first_run:
+            await self._flush(owner_id, shard, stretch, newest_id=top_id or 0, oldest_id=last_id or 0,
+                              backfill_complete=True)
+        else: # newest_id only moves once the gap is closed, so an interrupted pass is simply redone
+            await self._flush(owner_id, shard, stretch, newest_id=max(state['newest_id'], top_id or 0))
+
+        # 2. Backward: resume an interrupted first run below the oldest indexed message
+        state = await asyncio.to_thread(self.index.get_sync_state, owner_id, shard)
+        if not state['backfill_complete'] and state['oldest_id']:
+            oldest_id = state['oldest_id']
+            stretch = _Stretch(high_id=oldest_id - 1)
+            async for message in client.get_chat_history(chat_id, offset_id=oldest_id):
+                stretch.cover(message)
+                oldest_id = message.id
+                self._collect(stretch, message, shard)
+                if len(stretch.records) >= self.batch_size:
+                    await self._flush(owner_id, shard, stretch, oldest_id=oldest_id)
+            stretch.cover_to_start()
+            await self._flush(owner_id, shard, stretch, oldest_id=oldest_id, backfill_complete=True)
+
+        # 3. Re-check rows indexed earlier, which no stretch read above covers (a first run just read them all)
+        if not first_run:
+            await self._revalidate(client, owner_id, shard, chat_id, state['validated_id'])
+
+        await asyncio.to_thread(self.index.save_sync_state, owner_id, shard, synced_at=time.time())
+
+    async def _revalidate(self, client, owner_id: int, shard: int, chat_id, below_id: int):
+        message_ids = await asyncio.to_thread(self.index.message_ids, owner_id, shard, below_id, self.validate_size)
+        for start in range(0, len(message_ids), VALIDATE_BATCH_SIZE):
+            batch_ids = message_ids[start:start + VALIDATE_BATCH_SIZE]
+            stretch = _Stretch()
+            for message in await client.get_messages(chat_id, batch_ids):
+                if not message.media: # Deleted (an empty message), or an edit removed the media
+                    stretch.gone.append(message.id)
+                self._collect(stretch, message, shard)
+            await self._flush(owner_id, shard, stretch, validated_id=batch_ids[-1])
+        if len(message_ids) < self.validate_size: # Reached the oldest row; the next pass starts again from the newest
+            await asyncio.to_thread(self.index.save_sync_state, owner_id, shard, validated_id=0)
+
+    def _collect(self, stretch: '_Stretch', message, shard: int):
+        if not message.media:
+            return
+        try:
+            record = self.describe(message, shard)
+        except Exception as e:
+            logging.error(f"Media index: could not describe message {message.id}: {e}", exc_info=True)
+            return
+        if record:
+            stretch.records.append(record)
+
+    async def _flush(self, owner_id: int, shard: int, stretch: '_Stretch', **state_changes):
+        records, span, gone = stretch.take()
+        removed = await asyncio.to_thread(self._write, owner_id, shard, records, span, gone, state_changes)
+        if removed:
+            logging.info(f"Media index: dropped {len(removed)} messages of owner {owner_id} deleted in Telegram.")
+            if self.on_removed:
+                self.on_removed(owner_id, shard, removed)
+
+    def _write(self, owner_id: int, shard: int, records: list, span, gone: list, state_changes: dict) -> list:
+        self.index.upsert(owner_id, records)
+        removed = self.index.reconcile(owner_id, shard, *span) if span else []
+        if gone:
+            self.index.delete(owner_id, gone, shard)
+        if state_changes:
+            self.index.save_sync_state(owner_id, shard, **state_changes)
+        return removed + gone
+
+
+class _Stretch:
+    """
+    What a sync read since its last flush: records to index, and the span of message ids covered (newest
+    first, without gaps) with the ids of the media messages in it, so rows in the span but not in it can go.
+    """
+
+    def __init__(self, high_id: int = None):
+        self.records = []
+        self.present = set()
+        self.gone = [] # Ids get_messages returned empty
+        self.high_id = high_id
+        self.low_id = None
+
+    def cover(self, message):
+        if self.high_id is None:
+            self.high_id = message.id
+        self.low_id = message.id
+        if message.media:
+            self.present.add(message.id)
+
+    def cover_to_start(self):
+        """The history ended here: nothing older exists."""
+        if self.high_id is not None:
+            self.low_id = 0
+
+    def take(self) -> tuple:
+        """Returns (records, (low_id, high_id, present ids) or None, gone) and continues just below the span."""
+        span = (self.low_id, self.high_id, self.present) if self.low_id is not None else None
+        taken = self.records, span, self.gone
+        self.records, self.present, self.gone = [], set(), []
+        if span:
+            self.high_id, self.low_id = self.low_id - 1, None
+        return taken
@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class MessageCache:
+    """
+    TTL + LRU cache of resolved storage chat messages, keyed by ``(owner_id, shard, message_id)``.
+
+    The stream routes only need a message's media payload (file id with its file reference, size,
+    mime type and thumbnails), which the listing endpoint has usually just fetched; caching the
+    Message saves a get_messages round trip per media or thumbnail request. File references expire,
+    so entries live for at most ``ttl`` seconds and callers invalidate them on FILE_REFERENCE_* errors.
+    """
+
+    def __init__(self, max_items: int, ttl: float):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # (owner_id, shard, message_id) -> (stored_at, Message), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_items > 0 and self.ttl > 0
+
+    def get(self, owner_id: int, message_id: int, shard: int = 0):
+        """Returns the cached Message, or None on a miss or once it is older than the TTL."""
+        found, _ = self.get_many(owner_id, [message_id], shard)
+        return found.get(message_id)
+
+    def get_many(self, owner_id: int, message_ids: list[int], shard: int = 0):
+        """Returns ``({message_id: Message}, [missing message_ids])``."""
+        found, missing = {}, []
+        now = time.monotonic()
+        with self._lock:
+            for message_id in message_ids:
+                entry = self._entries.get((owner_id, shard, message_id))
+                if entry is not None and now - entry[0] < self.ttl:
+                    self._entries.move_to_end((owner_id, shard, message_id))
+                    found[message_id] = entry[1]
+                    self.hits += 1
+                else:
+                    if entry is not None: # Expired; its file reference may be stale
+                        del self._entries[(owner_id, shard, message_id)]
+                    missing.append(message_id)
+                    self.misses += 1
+        return found, missing
+
+    def put(self, owner_id: int, messages, shard: int = 0):
+        """Caches media messages; anything without media (e.g. deleted messages) is dropped instead."""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for message in messages:
+                if not message:
+                    continue
+                key = (owner_id, shard, message.id)
+                if getattr(message, 'empty', False) or not message.media:
+                    self._entries.pop(key, None)
+                    continue
+                self._entries[key] = (now, message)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, owner_id: int, message_id: int, shard: int = 0):
+        with self._lock:
+            self._entries.pop((owner_id, shard, message_id), None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'items': len(self._entries),
+                'max_items': self.max_items,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+            }
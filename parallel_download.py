@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import time
+
+from pyrogram import raw
+from pyrogram.file_id import FileId, FileType
+from pyrogram.session import Auth, Session
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024 # upload.GetFile's largest allowed limit
+
+
+class CdnRedirect(Exception):
+    """Raised when Telegram serves a file from a CDN DC, which the parallel path does not handle."""
+
+
+async def open_media_sessions(client, dc_id: int, count: int, auth_key: bytes = None) -> list:
+    """
+    Starts ``count`` media sessions to ``dc_id``. They share one auth key: the client's own for its home DC,
+    otherwise ``auth_key`` if that DC already has an authorized one, or a new key the client's authorization
+    is exported to.
+    """
+    storage = client.storage
+    test_mode = await storage.test_mode()
+    home_dc = dc_id == await storage.dc_id()
+    authorize = not home_dc and auth_key is None
+    if home_dc:
+        auth_key = await storage.auth_key()
+    elif auth_key is None:
+        auth_key = await Auth(client, dc_id, test_mode).create()
+    sessions = [Session(client, dc_id, auth_key, test_mode, is_media=True) for _ in range(count)]
+    try:
+        await sessions[0].start()
+        if authorize:
+            exported_auth = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+            await sessions[0].invoke(raw.functions.auth.ImportAuthorization(
+                id=exported_auth.id, bytes=exported_auth.bytes))
+        await asyncio.gather(*(session.start() for session in sessions[1:]))
+    except BaseException:
+        await asyncio.gather(*(session.stop() for session in sessions), return_exceptions=True)
+        raise
+    return sessions
+
+
+class MediaSessions:
+    """
+    Media sessions to each DC for one client, opened on first use and kept until close(), so downloads
+    after the first skip the key exchange and authorization import. ClientPool gives every pooled client
+    one as ``client.parallel_media_sessions``, alongside Pyrogram's own ``media_sessions``.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._sessions = {} # dc_id -> started Sessions sharing that DC's auth key
+        self._locks = {} # dc_id -> asyncio.Lock, so concurrent downloads open a DC's sessions once
+
+    @property
+    def count(self) -> int:
+        return sum(len(sessions) for sessions in self._sessions.values())
+
+    async def get(self, dc_id: int, count: int) -> list:
+        """``count`` started sessions to ``dc_id``, opening only those not open yet."""
+        async with self._locks.setdefault(dc_id, asyncio.Lock()):
+            sessions = self._sessions.get(dc_id, [])
+            if len(sessions) < count:
+                auth_key = sessions[0].auth_key if sessions else None
+                sessions = sessions + await open_media_sessions(self.client, dc_id, count - len(sessions), auth_key)
+                self._sessions[dc_id] = sessions
+            return sessions[:count]
+
+    async def close(self):
+        sessions = [session for sessions in self._sessions.values() for session in sessions]
+        self._sessions.clear()
+        await asyncio.gather(*(session.stop() for session in sessions), return_exceptions=True)
+
+
+class ParallelDownloader:
+    """
+    Downloads one Telegram file with ``workers`` concurrent 1 MiB GetFile requests spread over
+    ``connections`` media sessions to the file's DC. A reorder buffer hands chunks back in order, and
+    workers never run more than ``window`` chunks ahead of the consumer, so memory stays bounded at
+    roughly ``window`` MiB however large the file is.
+    """
+
+    def __init__(self, client, workers=4, connections=None, window=8, max_retries=3):
+        self.client = client
+        self.workers = max(1, workers)
+        self.connections = max(1, min(connections or self.workers, self.workers))
+        self.window = max(window, self.workers)
+        self.max_retries = max_retries
+        self.stats = {}
+
+    async def iter_range(self, file_id: str, start: int, stop: int):
+        """Yields exactly bytes [start, stop) of the file identified by the Bot API style ``file_id``."""
+        if start >= stop:
+            return
+        decoded = FileId.decode(file_id)
+        first_chunk = start // DOWNLOAD_CHUNK_SIZE
+        last_chunk = (stop - 1) // DOWNLOAD_CHUNK_SIZE
+        position = first_chunk * DOWNLOAD_CHUNK_SIZE
+        try:
+            async for chunk in self._iter_chunks(decoded, first_chunk, last_chunk):
+                chunk_start, position = position, position + len(chunk)
+                low, high = max(start - chunk_start, 0), min(stop - chunk_start, len(chunk))
+                if low < high:
+                    yield chunk if (low, high) == (0, len(chunk)) else chunk[low:high]
+                if position >= stop:
+                    break
+        except CdnRedirect:
+            if position != first_chunk * DOWNLOAD_CHUNK_SIZE:
+                raise
+            # Nothing sent yet; let Pyrogram's sequential downloader deal with the CDN
+            logging.info("Parallel download: file is served from a CDN; falling back to a single connection.")
+            async for chunk in self.client.stream_media(file_id, offset=first_chunk, limit=last_chunk - first_chunk + 1):
+                chunk_start, position = position, position + len(chunk)
+                low, high = max(start - chunk_start, 0), min(stop - chunk_start, len(chunk))
+                if low < high:
+                    yield chunk if (low, high) == (0, len(chunk)) else chunk[low:high]
+                if position >= stop:
+                    break
+
+    async def _iter_chunks(self, file_id: FileId, first_chunk: int, last_chunk: int):
+        """Yields chunks first_chunk..last_chunk (inclusive) in order, fetching up to ``window`` ahead."""
+        location = self._location(file_id)
+        shared = getattr(self.client, 'parallel_media_sessions', None) # Set on pooled clients
+        if shared is not None:
+            sessions = await shared.get(file_id.dc_id, self.connections)
+        else:
+            sessions = await open_media_sessions(self.client, file_id.dc_id, self.connections)
+        loop = asyncio.get_running_loop()
+        window = asyncio.Semaphore(self.window) # One permit per chunk fetched but not yet consumed
+        results = {} # chunk index -> future holding its bytes; the reorder buffer
+        next_to_claim = first_chunk
+        retries = 0
+        started = time.monotonic()
+        received = 0
+
+        def result_for(index):
+            if index not in results:
+                results[index] = loop.create_future()
+            return results[index]
+
+        async def worker(session):
+            nonlocal next_to_claim, retries
+            while True:
+                await window.acquire()
+                if next_to_claim > last_chunk:
+                    window.release()
+                    return
+                index = next_to_claim
+                next_to_claim += 1
+                future = result_for(index)
+                try:
+                    chunk, attempts = await self._fetch(session, location, index)
+                    retries += attempts
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                    return
+                if not future.done():
+                    future.set_result(chunk)
+                if len(chunk) < DOWNLOAD_CHUNK_SIZE: # End of file; nothing past this exists
+                    next_to_claim = last_chunk + 1
+
+        worker_tasks = [asyncio.create_task(worker(sessions[i % len(sessions)])) for i in range(self.workers)]
+        try:
+            for index in range(first_chunk, last_chunk + 1):
+                chunk = await result_for(index)
+                del results[index]
+                window.release()
+                received += len(chunk)
+                yield chunk
+                if len(chunk) < DOWNLOAD_CHUNK_SIZE:
+                    break
+        finally:
+            for task in worker_tasks:
+                task.cancel()
+            await asyncio.gather(*worker_tasks, return_exceptions=True)
+            for future in results.values():
+                if future.done() and not future.cancelled():
+                    future.exception() # Mark retrieved so asyncio doesn't log it
+            if shared is None:
+                await asyncio.gather(*(session.stop() for session in sessions), return_exceptions=True)
+            elapsed = time.monotonic() - started
+            self.stats = {
+                'bytes': received,
+                'workers': self.workers,
+                'connections': len(sessions),
+                'retries': retries,
+                'seconds': round(elapsed, 3),
+                'throughput_mbps': round(received * 8 / elapsed / 1_000_000, 2) if elapsed > 0 else None,
+            }
+            logging.info(f"Parallel download: {received} bytes over {len(sessions)} connections in {elapsed:.1f}s "
+                         f"({self.stats['throughput_mbps']} Mbit/s, {retries} retries).")
+
+    async def _fetch(self, session, location, index: int):
+        """
+        Fetches one chunk, retrying transient failures. Returns (bytes, retries). Flood waits are left to
+        the request scheduler, which waits out what the current lane allows and raises the rest.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                r = await session.invoke(
+                    raw.functions.upload.GetFile(location=location, offset=index * DOWNLOAD_CHUNK_SIZE,
+                                                 limit=DOWNLOAD_CHUNK_SIZE),
+                    sleep_threshold=0,
+                )
+                if isinstance(r, raw.types.upload.FileCdnRedirect):
+                    raise CdnRedirect()
+                return r.bytes, attempt
+            except (OSError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"Parallel download: chunk {index} failed ({e}); retrying.")
+                await asyncio.sleep(min(2 ** attempt, 10))
+
+    @staticmethod
+    def _location(file_id: FileId):
+        if file_id.file_type == FileType.PHOTO:
+            return raw.types.InputPhotoFileLocation(
+                id=file_id.media_id, access_hash=file_id.access_hash,
+                file_reference=file_id.file_reference, thumb_size=file_id.thumbnail_size)
+        return raw.types.InputDocumentFileLocation(
+            id=file_id.media_id, access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference, thumb_size=file_id.thumbnail_size)
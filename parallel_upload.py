@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from hashlib import md5
+
+from pyrogram import raw, types, utils
+from pyrogram.errors import FloodWait, FilePartMissing
+from pyrogram.session import Session
+
+UPLOAD_PART_SIZE = 512 * 1024 # The largest part Telegram accepts
+BIG_FILE_THRESHOLD = 10 * 1024 * 1024 # Telegram wants SaveBigFilePart above this
+
+
+class UploadPartError(Exception):
+    """Raised when a part still fails after all of its retries."""
+
+
+async def open_upload_sessions(client, connections: int) -> list[Session]:
+    """Opens ``connections`` media sessions to the client's home DC concurrently; all or none."""
+    async def open_session():
+        session = Session(client, await client.storage.dc_id(), await client.storage.auth_key(),
+                          await client.storage.test_mode(), is_media=True)
+        await session.start()
+        return session
+
+    opened = await asyncio.gather(*(open_session() for _ in range(connections)), return_exceptions=True)
+    sessions = [session for session in opened if not isinstance(session, BaseException)]
+    if len(sessions) < len(opened):
+        await asyncio.gather(*(session.stop() for session in sessions), return_exceptions=True)
+        raise next(error for error in opened if isinstance(error, BaseException))
+    return sessions
+
+
+class ParallelUploader:
+    """
+    Uploads one file to Telegram as 512 KiB parts sent concurrently by ``workers`` tasks spread over
+    ``connections`` media sessions. Pyrogram's own save_file() uses a single session and only logs a
+    failed part, so large uploads crawl and can silently end up corrupt; here every part is retried
+    on its own and the upload fails loudly if one never gets through.
+
+    Pass ``sessions`` (from open_upload_sessions()) to upload many files over one set of connections;
+    the caller then owns them and stops them when done.
+    """
+
+    def __init__(self, client, workers=8, connections=4, max_retries=3, progress=None, progress_args=(),
+                 sessions=None):
+        self.client = client
+        self.workers = max(1, workers)
+        self.connections = len(sessions) if sessions else max(1, min(connections, self.workers))
+        self.max_retries = max_retries
+        self.progress = progress
+        self.progress_args = progress_args
+        self.sessions = sessions
+        self.stats = {}
+        self._input_file = None
+
+    async def upload(self, fp, file_name: str):
+        """Uploads a seekable binary file object and returns the raw InputFile/InputFileBig."""
+        fp.seek(0, os.SEEK_END)
+        file_size = fp.tell()
+        fp.seek(0)
+        if file_size == 0:
+            raise ValueError("File size equals to 0 B")
+
+        total_parts = math.ceil(file_size / UPLOAD_PART_SIZE)
+        is_big = file_size > BIG_FILE_THRESHOLD
+        file_id = self.client.rnd_id()
+        md5_sum = None if is_big else md5() # Small files are checksummed, big ones are not
+        started = time.monotonic()
+
+        async def read_parts():
+            for part_index in range(total_parts):
+                chunk = await asyncio.to_thread(fp.read, UPLOAD_PART_SIZE) # Keep disk reads off the loop
+                if md5_sum is not None:
+                    md5_sum.update(chunk)
+                yield part_index, chunk
+
+        retries = await self.send_parts(read_parts(), file_id, total_parts, is_big, file_name,
+                                        on_sent=self._report_progress(file_size))
+
+        elapsed = time.monotonic() - started
+        self.stats = {
+            'bytes': file_size,
+            'parts': total_parts,
+            'workers': self.workers,
+            'connections': self.connections,
+            'retries': retries,
+            'seconds': round(elapsed, 3),
+            'throughput_mbps': round(file_size * 8 / elapsed / 1_000_000, 2) if elapsed > 0 else None,
+        }
+        logging.info(f"Upload '{file_name}': {file_size} bytes in {total_parts} parts over {self.connections} "
+                     f"connections in {elapsed:.1f}s ({self.stats['throughput_mbps']} Mbit/s, {retries} retries).")
+
+        if is_big:
+            self._input_file = raw.types.InputFileBig(id=file_id, parts=total_parts, name=file_name)
+        else:
+            self._input_file = raw.types.InputFile(id=file_id, parts=total_parts, name=file_name,
+                                                   md5_checksum=md5_sum.hexdigest())
+        return self._input_file
+
+    async def send_parts(self, parts, file_id: int, total_parts: int, is_big: bool, file_name: str,
+                         on_sent=None) -> int:
+        """
+        Sends the ``(part_index, bytes)`` pairs yielded by the async iterator ``parts`` concurrently and
+        returns the number of retries needed. ``on_sent(part_index, size)`` is called as each part lands.
+        """
+        sessions = self.sessions or await open_upload_sessions(self.client, self.connections)
+        queue = asyncio.Queue(self.workers * 2) # Bounds memory to a few MiB of read-ahead
+        retries = 0
+
+        async def worker(session):
+            nonlocal retries
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                part_index, chunk = item
+                retries += await self._send_part(session, file_id, total_parts, is_big, part_index, chunk, file_name)
+                if on_sent:
+                    on_sent(part_index, len(chunk))
+
+        worker_tasks = [asyncio.create_task(worker(sessions[i % len(sessions)])) for i in range(self.workers)]
+        try:
+            async for item in parts:
+                # Fail fast: stop reading as soon as a worker has given up on a part
+                put = asyncio.create_task(queue.put(item))
+                await asyncio.wait([put, *worker_tasks], return_when=asyncio.FIRST_COMPLETED)
+                for task in worker_tasks:
+                    if task.done():
+                        put.cancel()
+                        task.result() # Re-raises the worker's UploadPartError
+            for _ in worker_tasks:
+                await queue.put(None)
+            await asyncio.gather(*worker_tasks)
+        finally:
+            for task in worker_tasks:
+                task.cancel()
+            await asyncio.gather(*worker_tasks, return_exceptions=True)
+            if sessions is not self.sessions:
+                await asyncio.gather(*(session.stop() for session in sessions), return_exceptions=True)
+        return retries
+
+    async def send_input_file(self, chat_id, input_file, file_name: str, caption: str = "",
+                              resend_part=None) -> "types.Message":
+        """
+        Sends already uploaded parts as a document, like Client.send_document(). If Telegram reports a
+        part missing, ``await resend_part(part_index)`` is given the chance to upload it again.
+        """
+        peer = await self.client.resolve_peer(chat_id)
+        text = await utils.parse_text_entities(self.client, caption, None, None)
+        r = await self._invoke_with_resend(
+            lambda: raw.functions.messages.SendMedia(peer=peer, media=self._uploaded_document(input_file, file_name),
+                                                     random_id=self.client.rnd_id(), **text),
+            file_name, resend_part)
+        for update in r.updates:
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return await types.Message._parse(
+                    self.client, update.message,
+                    {u.id: u for u in r.users},
+                    {c.id: c for c in r.chats},
+                )
+
+    async def send_album(self, chat_id, items, resend_part=None) -> list["types.Message"]:
+        """
+        Sends up to 10 uploaded files as one grouped message (an album of documents, so originals are kept).
+        ``items`` are ``(input_file, file_name, caption)``; ``await resend_part(item_index, part_index)``
+        may re-upload a part Telegram reports missing. Returns the messages in album order.
+        """
+        peer = await self.client.resolve_peer(chat_id)
+        multi_media = []
+        for item_index, (input_file, file_name, caption) in enumerate(items):
+            # Each file has to become a stored document before it can be part of an album
+            r = await self._invoke_with_resend(
+                lambda: raw.functions.messages.UploadMedia(peer=peer, media=self._uploaded_document(input_file, file_name)),
+                file_name, resend_part and (lambda part_index, item_index=item_index: resend_part(item_index, part_index)))
+            multi_media.append(raw.types.InputSingleMedia(
+                media=raw.types.InputMediaDocument(id=raw.types.InputDocument(
+                    id=r.document.id, access_hash=r.document.access_hash, file_reference=r.document.file_reference)),
+                random_id=self.client.rnd_id(),
+                **await utils.parse_text_entities(self.client, caption, None, None)
+            ))
+        r = await self.client.invoke(raw.functions.messages.SendMultiMedia(peer=peer, multi_media=multi_media),
+                                     sleep_threshold=60)
+        messages = await utils.parse_messages(self.client, raw.types.messages.Messages(
+            messages=[update.message for update in r.updates
+                      if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage))],
+            users=r.users, chats=r.chats))
+        return sorted(messages, key=lambda message: message.id)
+
+    async def send_document(self, chat_id, fp, file_name: str, caption: str = "") -> "types.Message":
+        """Uploads ``fp`` in parallel and sends it as a document."""
+        input_file = await self.upload(fp, file_name)
+        return await self.send_input_file(chat_id, input_file, file_name, caption,
+                                          resend_part=lambda part_index: self.resend_part(fp, part_index, file_name))
+
+    async def resend_part(self, fp, part_index: int, file_name: str):
+        """Re-uploads a single part of ``fp`` (the file last passed to upload()) that Telegram reported missing."""
+        input_file = self._input_file
+        fp.seek(part_index * UPLOAD_PART_SIZE)
+        chunk = await asyncio.to_thread(fp.read, UPLOAD_PART_SIZE)
+        sessions = self.sessions or await open_upload_sessions(self.client, 1)
+        try:
+            await self._send_part(sessions[0], input_file.id, input_file.parts,
+                                  isinstance(input_file, raw.types.InputFileBig), part_index, chunk, file_name)
+        finally:
+            if sessions is not self.sessions:
+                await sessions[0].stop()
+
+    # --- Internals ---
+    def _report_progress(self, total: int):
+        if not self.progress:
+            return None
+        uploaded = 0
+        def on_sent(part_index, size):
+            nonlocal uploaded
+            uploaded += size
+            self.progress(uploaded, total, *self.progress_args)
+        return on_sent
+
+    def _uploaded_document(self, input_file, file_name: str):
+        return raw.types.InputMediaUploadedDocument(
+            mime_type=self.client.guess_mime_type(file_name) or "application/zip",
+            file=input_file,
+            attributes=[raw.types.DocumentAttributeFilename(file_name=file_name)],
+        )
+
+    async def _invoke_with_resend(self, make_rpc, file_name: str, resend_part=None):
+        """Invokes ``make_rpc()``, re-uploading parts Telegram reports missing and trying again."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self.client.invoke(make_rpc())
+            except FilePartMissing as e:
+                if resend_part is None or attempt == self.max_retries:
+                    raise
+                logging.warning(f"Upload '{file_name}': Telegram reported part {e.value} missing; resending it.")
+                await resend_part(e.value)
+
+    async def _send_part(self, session, file_id, total_parts, is_big, part_index, chunk, file_name) -> int:
+        """
+        Sends one part, retrying it on its own. Returns how many retries it took. A FloodWait the request
+        scheduler didn't wait out (longer than the lane allows) propagates, so the route can answer 429.
+        """
+        if is_big:
+            rpc = raw.functions.upload.SaveBigFilePart(
+                file_id=file_id, file_part=part_index, file_total_parts=total_parts, bytes=chunk)
+        else:
+            rpc = raw.functions.upload.SaveFilePart(file_id=file_id, file_part=part_index, bytes=chunk)
+        for attempt in range(self.max_retries + 1):
+            try:
+                if not await session.invoke(rpc, sleep_threshold=0):
+                    raise UploadPartError(f"Telegram rejected part {part_index}.")
+                return attempt
+            except FloodWait:
+                raise
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise UploadPartError(f"Part {part_index} of '{file_name}' failed after "
+                                          f"{attempt + 1} attempts: {e}") from e
+                logging.warning(f"Upload '{file_name}': part {part_index} failed ({e}); retrying.")
+                await asyncio.sleep(min(2 ** attempt, 10))
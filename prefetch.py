@@ -0,0 +1,137 @@
+import asyncio
+import collections
+import logging
+import time
+
+from scheduler import telegram_lane, BACKGROUND
+
+
+class PrefetchJob:
+    def __init__(self, key: str, size: int, run):
+        self.key = key # Identifies the work (e.g. a cache key) so the same thing is never queued twice
+        self.size = size # Bytes it will fetch, charged against the owner's budget
+        self.run = run # async () -> bytes actually fetched (0 if it found the cache already warm)
+
+
+class Prefetcher:
+    """
+    Warms caches in the background with a few low-priority workers. Each owner (user) has one queue,
+    which a new schedule() replaces, since the newest listing is what the user is looking at; owners
+    are served round-robin. Jobs run in the background Telegram lane and are charged against a
+    per-owner budget of ``budget_bytes`` per ``budget_window`` seconds; jobs over budget are dropped.
+    Runs entirely on the Telegram loop.
+    """
+
+    def __init__(self, workers: int = 2, budget_bytes: int = 512 * 1024 * 1024, budget_window: float = 3600):
+        self.workers = max(1, workers)
+        self.budget_bytes = budget_bytes
+        self.budget_window = budget_window
+        self._queues = collections.OrderedDict() # owner -> deque of PrefetchJob, in round-robin order
+        self._queued_keys = set()
+        self._running = {} # task -> (owner, key)
+        self._spent = {} # owner -> [window start, bytes charged]
+        self._wakeup = None
+        self._worker_tasks = []
+        self._counts = collections.Counter() # 'done', 'failed', 'cancelled', 'over_budget'
+        self._bytes = 0
+
+    def schedule(self, owner: str, jobs) -> int:
+        """Replaces ``owner``'s queued jobs with ``jobs`` (running ones carry on); returns how many were queued."""
+        self._drop_queue(owner)
+        running_keys = {key for _, key in self._running.values()}
+        queue = collections.deque()
+        for job in jobs:
+            if job.key in self._queued_keys or job.key in running_keys:
+                continue
+            queue.append(job)
+            self._queued_keys.add(job.key)
+        if queue:
+            self._queues[owner] = queue
+            self._start_workers()
+            self._wakeup.set()
+        return len(queue)
+
+    def cancel(self, owner: str):
+        """Drops ``owner``'s queued jobs and cancels the running ones (e.g. on logout)."""
+        self._drop_queue(owner)
+        for task, (task_owner, _) in list(self._running.items()):
+            if task_owner == owner:
+                task.cancel()
+        self._spent.pop(owner, None)
+
+    def stats(self) -> dict:
+        return {
+            'queued': sum(len(queue) for queue in self._queues.values()),
+            'running': len(self._running),
+            'owners': len(self._queues),
+            'bytes': self._bytes,
+            **{state: self._counts[state] for state in ('done', 'failed', 'cancelled', 'over_budget')},
+        }
+
+    # --- Internals ---
+    def _drop_queue(self, owner: str):
+        for job in self._queues.pop(owner, ()):
+            self._queued_keys.discard(job.key)
+
+    def _start_workers(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._worker_tasks = [task for task in self._worker_tasks if not task.done()]
+        while len(self._worker_tasks) < self.workers:
+            self._worker_tasks.append(asyncio.get_running_loop().create_task(self._work()))
+
+    def _next_job(self):
+        """Takes one job from the owner at the front of the round-robin, then moves that owner to the back."""
+        while self._queues:
+            owner, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            self._queued_keys.discard(job.key)
+            if queue:
+                self._queues.move_to_end(owner)
+            else:
+                del self._queues[owner]
+            if self._charge(owner, job.size):
+                return owner, job
+            self._counts['over_budget'] += 1
+        return None, None
+
+    def _charge(self, owner: str, size: int) -> bool:
+        now = time.monotonic()
+        spent = self._spent.get(owner)
+        if spent is None or now - spent[0] >= self.budget_window:
+            spent = self._spent[owner] = [now, 0]
+        if spent[1] + size > self.budget_bytes:
+            return False
+        spent[1] += size
+        return True
+
+    def _refund(self, owner: str, size: int):
+        spent = self._spent.get(owner)
+        if spent is not None and size > 0:
+            spent[1] = max(0, spent[1] - size)
+
+    async def _work(self):
+        while True:
+            owner, job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            with telegram_lane(BACKGROUND):
+                task = asyncio.get_running_loop().create_task(job.run())
+            self._running[task] = (owner, job.key)
+            try:
+                fetched = await asyncio.shield(task) # Cancelling the job (cancel()) must not take the worker with it
+                self._counts['done'] += 1
+                self._bytes += fetched
+                self._refund(owner, job.size - fetched)
+            except asyncio.CancelledError:
+                if not task.cancelled(): # The worker itself is being cancelled
+                    task.cancel()
+                    raise
+                self._counts['cancelled'] += 1
+            except Exception as e:
+                self._counts['failed'] += 1
+                logging.info(f"Prefetch of {job.key} failed: {e}")
+            finally:
+                self._running.pop(task, None)
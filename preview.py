@@ -0,0 +1,228 @@
+import asyncio
+import collections
+import importlib.util
+import io
+import json
+import logging
+import math
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_WIDTHS = (640, 1280, 1920) # Requested widths are rounded up to one of these to keep cache variety small
+SOURCE_PROTOCOLS = 'pipe,http,tcp' # All ffmpeg may open: its stdin and the loopback source URL
+
+
+def video_bitrate(height: int) -> int:
+    """Target bits per second for a rendition: about 0.1 bits per pixel at 30 fps for 16:9."""
+    return int(height * height * 16 / 9 * 30 * 0.1)
+
+
+def image_width(requested: int) -> int:
+    return next((width for width in IMAGE_WIDTHS if width >= requested), IMAGE_WIDTHS[-1])
+
+
+# --- Render jobs; run in the worker threads ---
+def render_image(source, width: int, quality: int) -> bytes:
+    """Shrinks an image (a path or its bytes) to at most ``width`` pixels wide and encodes it as WebP."""
+    from PIL import Image, ImageOps
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as image:
+        image = ImageOps.exif_transpose(image) # Phone photos are often stored sideways with an orientation tag
+        image.thumbnail((width, width * 4)) # Keeps the aspect ratio and never enlarges
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        output = io.BytesIO()
+        image.save(output, 'WEBP', quality=quality, method=4)
+        return output.getvalue()
+
+
+def render_segment(ffmpeg: str, source, start: float, duration: float, source_duration: float, height: int,
+                   timeout: float) -> bytes:
+    """
+    Transcodes [start, start + duration) of a video to an MPEG-TS segment ``height`` pixels high (never
+    upscaled). ``source()`` returns the video's URL and the request header that admits ffmpeg to it. Both
+    reach ffmpeg on stdin as a concat script, keeping the credential out of its command line (visible in
+    ps). ffmpeg seeks with HTTP Range requests, so only that stretch is read.
+    """
+    bitrate = video_bitrate(height)
+    command = [
+        ffmpeg, '-loglevel', 'error', '-protocol_whitelist', SOURCE_PROTOCOLS, '-f', 'concat', '-safe', '0',
+        '-ss', f"{start:.3f}", '-i', 'pipe:0', '-t', f"{duration:.3f}",
+        '-map', '0:v:0', '-map', '0:a:0?', '-sn', '-dn',
+        '-vf', f"scale=-2:'min({height},ih)'", '-pix_fmt', 'yuv420p',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-maxrate', str(bitrate), '-bufsize', str(bitrate * 2),
+        '-c:a', 'aac', '-b:a', '96k', '-ac', '2',
+        '-output_ts_offset', f"{start:.3f}", '-muxdelay', '0', '-f', 'mpegts', 'pipe:1',
+    ]
+    result = subprocess.run(command, input=source_script(*source(), source_duration), capture_output=True,
+                            timeout=timeout)
+    if result.returncode != 0 or not result.stdout:
+        raise RuntimeError(f"ffmpeg exited with {result.returncode}: {result.stderr.decode(errors='replace')[-500:]}")
+    return result.stdout
+
+
+def probe_video(ffprobe: str, source, timeout: float) -> tuple:
+    """
+    Returns (duration in seconds, width, height) of the first video stream of a video. ``with source() as url``
+    gives a URL ffprobe may open itself (so it can seek with HTTP Range requests and reads only the headers
+    and the index, wherever that is) and revokes its credential afterwards.
+    """
+    with source() as source_url:
+        command = [ffprobe, '-v', 'error', '-protocol_whitelist', 'http,tcp', '-select_streams', 'v:0',
+                   '-show_entries', 'format=duration:stream=width,height', '-of', 'json', source_url]
+        result = subprocess.run(command, capture_output=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe exited with {result.returncode}: {result.stderr.decode(errors='replace')[-500:]}")
+    info = json.loads(result.stdout)
+    stream = (info.get('streams') or [{}])[0]
+    return float(info.get('format', {}).get('duration') or 0), stream.get('width'), stream.get('height')
+
+
+def source_script(source_url: str, header: str, duration: float) -> bytes:
+    """An ffconcat script with the single file at ``source_url``, fetched with ``header``."""
+    quote = lambda value: "'" + value.replace("'", "'\\''") + "'"
+    lines = ['ffconcat version 1.0', f"file {quote(source_url)}", f"option headers {quote(header)}",
+             f"duration {duration:.3f}"] # Without the duration the concat demuxer can't seek
+    return ('\n'.join(lines) + '\n').encode()
+
+
+class PreviewGenerator:
+    """
+    Lower-resolution renditions for previews: resized WebP images and HLS video, cached in a MediaCache
+    keyed by file_unique_id. Video is cut into fixed-length segments that are transcoded on first request,
+    so a preview only ever costs the stretch of the original that was actually watched. At most ``workers``
+    renders run at once: each is an ffmpeg child process, or Pillow in a worker thread (it releases the GIL
+    while decoding, resizing and encoding). Concurrent requests for the same rendition share one render.
+    Pillow (images) and ffmpeg (video) are optional; each kind is available only if its tool is.
+    """
+
+    def __init__(self, cache, workers: int = 2, ffmpeg: str = 'ffmpeg', ffprobe: str = 'ffprobe',
+                 video_heights=(360, 720), segment_seconds: float = 6, image_quality: int = 80, timeout: float = 120):
+        self.cache = cache # A MediaCache of its own, so renditions never evict originals or thumbnails
+        self.workers = max(1, workers)
+        self.ffmpeg = shutil.which(ffmpeg)
+        self.ffprobe = shutil.which(ffprobe)
+        self.video_heights = tuple(sorted(video_heights))
+        self.segment_seconds = segment_seconds
+        self.image_quality = image_quality
+        self.timeout = timeout
+        self.images_available = importlib.util.find_spec('PIL') is not None
+        self.video_available = self.ffmpeg is not None and self.ffprobe is not None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._counts = collections.Counter() # 'image', 'segment', 'failed' -> renditions produced
+        logging.info(f"Previews: images {'on' if self.images_available else 'off (Pillow not installed)'}, "
+                     f"video {'on' if self.video_available else 'off (ffmpeg/ffprobe not found)'}.")
+
+    async def image(self, key: str, width: int, load_source) -> bytes:
+        """WebP bytes of an image at ``width``; ``await load_source()`` returns its path or bytes on a miss."""
+        async def produce():
+            return await self._run(render_image, await load_source(), width, self.image_quality)
+        return await self._get_or_create(f"{key}-w{width}", produce, 'image')
+
+    async def segment(self, key: str, height: int, index: int, source, duration: float) -> bytes:
+        """MPEG-TS bytes of one segment; ``source()`` is called as its render starts (see render_segment)."""
+        start = index * self.segment_seconds
+        length = min(self.segment_seconds, duration - start)
+        async def produce():
+            return await self._run(render_segment, self.ffmpeg, source, start, length, duration, height, self.timeout)
+        return await self._get_or_create(f"{key}-v{height}-{index}", produce, 'segment')
+
+    async def probe(self, source) -> tuple:
+        """(duration, width, height) of a video, for files whose message doesn't carry them (see probe_video)."""
+        return await self._run(probe_video, self.ffprobe, source, self.timeout)
+
+    def renditions(self, source_height: int = None) -> list:
+        """Heights to offer for a source; never more than one at or above its own height."""
+        heights = [height for height in self.video_heights if not source_height or height < source_height]
+        larger = [height for height in self.video_heights if source_height and height >= source_height]
+        return heights + larger[:1]
+
+    def segment_count(self, duration: float) -> int:
+        return max(1, math.ceil(duration / self.segment_seconds))
+
+    def master_playlist(self, source_width: int = None, source_height: int = None) -> str:
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+        for height in self.renditions(source_height):
+            attributes = f"BANDWIDTH={video_bitrate(height) + 96_000}"
+            if source_width and source_height:
+                shown = min(height, source_height)
+                attributes += f",RESOLUTION={round(source_width * shown / source_height / 2) * 2}x{shown}"
+            lines += [f"#EXT-X-STREAM-INF:{attributes}", f"video/{height}.m3u8"]
+        return '\n'.join(lines) + '\n'
+
+    def media_playlist(self, height: int, duration: float) -> str:
+        """A VOD playlist of every segment; they are only transcoded once a player asks for them."""
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', f"#EXT-X-TARGETDURATION:{math.ceil(self.segment_seconds)}",
+                 '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD']
+        for index in range(self.segment_count(duration)):
+            length = min(self.segment_seconds, duration - index * self.segment_seconds)
+            lines += [f"#EXTINF:{length:.3f},", f"{height}/{index}.ts"]
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+        return {'images': self.images_available, 'video': self.video_available, 'workers': self.workers,
+                'generated': counts, 'cache': self.cache.stats()}
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    # --- Internals ---
+    async def _run(self, fn, *args):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='preview')
+            executor = self._executor
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+    async def _get_or_create(self, key: str, produce, kind: str) -> bytes:
+        path = self.cache.lookup(key)
+        if path:
+            try:
+                return await asyncio.to_thread(_read_file, path)
+            except FileNotFoundError: # Evicted in the meantime
+                pass
+        if not self.cache.enabled:
+            return await self._produce(produce, kind)
+
+        fill, created = self.cache.get_or_create_fill(key, 0)
+        if not created:
+            await asyncio.to_thread(fill.wait, self.timeout)
+            path = self.cache.lookup(key)
+            if path:
+                try:
+                    return await asyncio.to_thread(_read_file, path)
+                except FileNotFoundError:
+                    pass
+            return await self._produce(produce, kind) # Evicted in the meantime; render without caching
+        try:
+            data = await self._produce(produce, kind)
+        except BaseException as e:
+            fill.abort(e if isinstance(e, Exception) else None)
+            raise
+        fill.write(data)
+        fill.finish()
+        return data
+
+    async def _produce(self, produce, kind: str) -> bytes:
+        try:
+            data = await produce()
+        except Exception:
+            with self._lock:
+                self._counts['failed'] += 1
+            raise
+        with self._lock:
+            self._counts[kind] += 1
+        return data
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import math
+import os
+import threading
+import time
+import uuid
+
+from pyrogram import raw
+
+from parallel_upload import UPLOAD_PART_SIZE, BIG_FILE_THRESHOLD
+
+
+class UploadSession:
+    """
+    Server-side state of one resumable upload. Every complete 512 KiB part is sent to Telegram as soon
+    as it arrives; only the unfinished tail of the current part (less than one part) is held in memory,
+    so a dropped connection loses at most that tail and the client resumes from ``offset``.
+    """
+
+    def __init__(self, owner_id: int, file_name: str, size: int, tags: str = ""):
+        self.id = uuid.uuid4().hex
+        self.owner_id = owner_id
+        self.file_name = file_name
+        self.tags = tags # Raw tag input, turned into the caption at finalize time
+        self.size = size
+        self.total_parts = math.ceil(size / UPLOAD_PART_SIZE)
+        self.is_big = size > BIG_FILE_THRESHOLD
+        self.file_id = int.from_bytes(os.urandom(8), 'little', signed=True) # Telegram's client-chosen file id
+        self.next_part = 0 # Parts [0, next_part) have been acknowledged by Telegram
+        self.tail = bytearray() # Bytes of part ``next_part`` received but not yet sent
+        self.sha256 = hashlib.sha256() # Of bytes [0, hashed_bytes), for upload deduplication
+        self.hashed_bytes = 0
+        self.created_at = self.updated_at = time.time()
+        self.lock = threading.Lock() # One chunk request (or finalize) at a time
+
+    @property
+    def offset(self) -> int:
+        return min(self.size, self.next_part * UPLOAD_PART_SIZE + len(self.tail))
+
+    @property
+    def complete(self) -> bool:
+        return self.next_part == self.total_parts
+
+    @property
+    def content_hash(self):
+        """SHA-256 of the whole file, once complete."""
+        return self.sha256.hexdigest() if self.complete and self.hashed_bytes == self.size else None
+
+    def input_file(self):
+        if self.is_big:
+            return raw.types.InputFileBig(id=self.file_id, parts=self.total_parts, name=self.file_name)
+        return raw.types.InputFile(id=self.file_id, parts=self.total_parts, name=self.file_name, md5_checksum="")
+
+    def rewind(self, part_index: int):
+        """Forgets everything from ``part_index`` on, e.g. when Telegram reports that part missing."""
+        self.next_part = min(self.next_part, part_index)
+        self.tail.clear()
+
+    def _hash(self, position: int, data: bytes):
+        """Adds ``data`` (at byte ``position``) to the running hash, skipping bytes re-sent after a rewind."""
+        skip = self.hashed_bytes - position
+        if skip < len(data):
+            self.sha256.update(data[skip:] if skip > 0 else data)
+            self.hashed_bytes += len(data) - max(skip, 0)
+
+    def describe(self) -> dict:
+        return {
+            'upload_id': self.id,
+            'file_name': self.file_name,
+            'size': self.size,
+            'offset': self.offset,
+            'part_size': UPLOAD_PART_SIZE,
+            'complete': self.complete,
+        }
+
+    async def receive(self, uploader, read_body) -> int:
+        """
+        Reads the request body with the blocking ``read_body(n)`` (returning b'' at its end or when the
+        client went away) and sends each completed part through ``uploader``, a ParallelUploader.
+        Returns the new offset. If a part cannot be delivered the session is rewound to it and the
+        UploadPartError propagates, so the client resumes from the last acknowledged byte.
+        """
+        dispatched = []
+        acknowledged = set()
+
+        async def parts():
+            part_index = self.next_part
+            while part_index < self.total_parts:
+                part_length = min(UPLOAD_PART_SIZE, self.size - part_index * UPLOAD_PART_SIZE)
+                while len(self.tail) < part_length:
+                    data = await asyncio.to_thread(read_body, part_length - len(self.tail))
+                    if not data:
+                        return # Body ended mid-part; keep the tail for the next request
+                    self._hash(part_index * UPLOAD_PART_SIZE + len(self.tail), data)
+                    self.tail += data
+                chunk = bytes(self.tail)
+                self.tail.clear()
+                dispatched.append(part_index)
+                yield part_index, chunk
+                part_index += 1
+
+        try:
+            await uploader.send_parts(parts(), self.file_id, self.total_parts, self.is_big, self.file_name,
+                                      on_sent=lambda part_index, size: acknowledged.add(part_index))
+        except BaseException:
+            unacknowledged = [part_index for part_index in dispatched if part_index not in acknowledged]
+            if unacknowledged:
+                # Keep the parts acknowledged before the first missing one; next_part hasn't moved yet
+                acknowledged_to = self.next_part
+                while acknowledged_to in acknowledged:
+                    acknowledged_to += 1
+                self.next_part = acknowledged_to
+                self.rewind(acknowledged_to)
+            elif dispatched:
+                self.next_part = dispatched[-1] + 1
+            raise
+        finally:
+            self.updated_at = time.time()
+        if dispatched:
+            self.next_part = dispatched[-1] + 1
+        return self.offset
+
+
+class UploadSessionStore:
+    """In-memory registry of resumable uploads; sessions idle for longer than ``ttl`` seconds expire."""
+
+    def __init__(self, ttl: float = 86400):
+        self.ttl = ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def create(self, owner_id: int, file_name: str, size: int, tags: str = "") -> UploadSession:
+        upload = UploadSession(owner_id, file_name, size, tags)
+        with self._lock:
+            self._expire()
+            self._sessions[upload.id] = upload
+        return upload
+
+    def get(self, upload_id: str, owner_id: int):
+        """Returns the session if it exists and belongs to ``owner_id``, else None."""
+        with self._lock:
+            self._expire()
+            upload = self._sessions.get(upload_id)
+        if upload is None or upload.owner_id != owner_id:
+            return None
+        return upload
+
+    def remove(self, upload_id: str):
+        with self._lock:
+            self._sessions.pop(upload_id, None)
+
+    def _expire(self):
+        """Drops idle sessions. Caller holds the lock."""
+        cutoff = time.time() - self.ttl
+        for upload_id in [upload_id for upload_id, upload in self._sessions.items()
+                          if upload.updated_at < cutoff and not upload.lock.locked()]:
+            del self._sessions[upload_id]
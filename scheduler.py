@@ -0,0 +1,289 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import heapq
+import itertools
+import logging
+import time
+import weakref
+
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+
+from metrics import Histogram
+
+# Priority lanes; when requests queue up on a rate limit, lower lanes are served first
+INTERACTIVE, NORMAL, BACKGROUND = 0, 1, 2
+LANE_NAMES = {INTERACTIVE: 'interactive', NORMAL: 'normal', BACKGROUND: 'background'}
+
+# Requests per second and burst size per account for each method class; a rate of 0 means unlimited
+DEFAULT_LIMITS = {
+    'download': (40, 80), # upload.GetFile and friends, 1 MiB per request
+    'upload': (40, 80), # upload.SaveFilePart / SaveBigFilePart
+    'send': (5, 10), # Sending, forwarding, editing and deleting messages
+    'history': (10, 20), # Listing, searching and fetching messages
+    'auth': (1, 3),
+    'other': (20, 40),
+}
+
+_DOWNLOAD_METHODS = {'upload.GetFile', 'upload.GetCdnFile', 'upload.GetFileHashes', 'upload.GetCdnFileHashes',
+                     'upload.ReuploadCdnFile'}
+_UPLOAD_METHODS = {'upload.SaveFilePart', 'upload.SaveBigFilePart'}
+_SEND_METHODS = {'messages.SendMedia', 'messages.SendMultiMedia', 'messages.UploadMedia', 'messages.SendMessage',
+                 'messages.ForwardMessages', 'messages.EditMessage', 'messages.DeleteMessages'}
+
+_current_lane = contextvars.ContextVar('telegram_lane', default=NORMAL)
+_sequence = itertools.count()
+
+# The scheduler that install() last hooked in, for clients that bypass pyrogram sessions (benchmarks/fake_telegram.py)
+installed = None
+
+
+def method_name(query) -> str:
+    """``"upload.GetFile"`` for a raw function, looking through InvokeWithoutUpdates/InvokeWithTakeout."""
+    if isinstance(query, (raw.functions.InvokeWithoutUpdates, raw.functions.InvokeWithTakeout)):
+        query = query.query
+    return query.QUALNAME.split('.', 1)[-1]
+
+
+def method_class(name: str) -> str:
+    if name in _DOWNLOAD_METHODS:
+        return 'download'
+    if name in _UPLOAD_METHODS:
+        return 'upload'
+    if name in _SEND_METHODS:
+        return 'send'
+    if name.startswith(('messages.Get', 'messages.Search', 'channels.GetMessages')):
+        return 'history'
+    if name.startswith('auth.'):
+        return 'auth'
+    return 'other'
+
+
+def parse_rate_limits(spec: str) -> dict:
+    """Parses ``"download=40/80,history=5"`` (rate per second, optional burst) into {class: (rate, burst)}."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        kind, _, value = item.partition('=')
+        kind = kind.strip()
+        if kind not in DEFAULT_LIMITS:
+            raise ValueError(f"Unknown Telegram method class '{kind}' in rate limits.")
+        rate, _, burst = value.partition('/')
+        rate = float(rate)
+        limits[kind] = (rate, float(burst) if burst else max(1.0, rate * 2))
+    return limits
+
+
+@contextlib.contextmanager
+def telegram_lane(lane: int):
+    """Runs the Telegram requests made inside the block (and in tasks started from it) in ``lane``."""
+    token = _current_lane.set(lane)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+def in_lane(lane: int):
+    """Decorator form of telegram_lane for async functions, e.g. Flask views."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with telegram_lane(lane):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TokenBucket:
+    """
+    A token bucket whose waiters are served in lane order, then in arrival order. A FloodWait blocks
+    the bucket until it has passed, so every queued request waits it out instead of hitting it again.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._waiters = [] # Heap of (lane, sequence, future)
+        self._timer = None
+
+    @property
+    def idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return not self._waiters and self.tokens >= self.burst and now >= self.blocked_until
+
+    async def acquire(self, lane: int) -> bool:
+        """Waits for a token; returns whether the request had to queue for it."""
+        if not self._waiters and self._take(time.monotonic()):
+            return False
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(_sequence), future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled(): # Granted just as we were cancelled; hand it back
+                self.tokens = min(self.burst, self.tokens + 1)
+            self._dispatch()
+            raise
+        return True
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self._dispatch()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _take(self, now: float) -> bool:
+        self._refill(now)
+        if now < self.blocked_until or self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done(): # Cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+            if not self._take(now):
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+        if self._waiters:
+            delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.001)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+
+class TelegramScheduler:
+    """
+    Every request Pyrogram sends (main and media sessions alike) passes through here once install()
+    has run. Requests are rate limited per account and method class with token buckets, queued by
+    priority lane, and a FloodWait blocks that account's method class for its duration, after which
+    the request is retried, unless the wait is longer than its lane is willing to sleep.
+    Runs entirely on the Telegram loop.
+    """
+
+    def __init__(self, limits: dict = None, max_flood_sleep: float = 60, interactive_flood_sleep: float = 10,
+                 max_buckets: int = 4096):
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.max_flood_sleep = {INTERACTIVE: min(interactive_flood_sleep, max_flood_sleep),
+                                NORMAL: max_flood_sleep, BACKGROUND: max_flood_sleep}
+        self.max_buckets = max_buckets
+        self._buckets = {} # (account, method class) -> TokenBucket
+        self._accounts = weakref.WeakKeyDictionary() # Client -> account label
+        self._lanes = {lane: {'waiting': 0, 'requests': 0, 'wait_seconds': 0.0} for lane in LANE_NAMES}
+        self._methods = {kind: {'requests': 0, 'queued': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+                                'flood_waits': 0, 'flood_wait_seconds': 0.0} for kind in self.limits}
+        self.latency = Histogram('teledrive_telegram_request_seconds',
+                                 'Telegram API request latency (excluding time queued here), per method.', ['method'])
+
+    def register(self, client, account: str):
+        """Names the account a client belongs to, so its limits survive reconnects. Others use client.name."""
+        self._accounts[client] = account
+
+    def install(self):
+        """Routes pyrogram's Session.invoke, which every API request goes through, via this scheduler."""
+        global installed
+        installed = self
+        original = getattr(Session.invoke, '__wrapped__', Session.invoke)
+        scheduler = self
+
+        @functools.wraps(original)
+        async def invoke(session, query, retries=Session.MAX_RETRIES, timeout=Session.WAIT_TIMEOUT,
+                         sleep_threshold=Session.SLEEP_THRESHOLD):
+            # sleep_threshold=0 makes Pyrogram raise every FloodWait so the scheduler decides what to do
+            return await scheduler.call(session.client, query, lambda: original(session, query, retries, timeout, 0),
+                                        sleep_threshold)
+        Session.invoke = invoke
+
+    async def call(self, client, query, send, sleep_threshold: float = 0):
+        """
+        Awaits ``send()`` for ``query`` once the account's rate limit allows it. Flood waits up to the
+        lane's limit (or ``sleep_threshold``, if the caller asked for more) are waited out and retried.
+        """
+        account = self._accounts.get(client) or client.name
+        name = method_name(query)
+        kind = method_class(name)
+        lane = _current_lane.get()
+        bucket = self._bucket(account, kind)
+        max_sleep = max(self.max_flood_sleep[lane], sleep_threshold or 0)
+        while True:
+            if bucket is not None:
+                await self._acquire(bucket, kind, lane)
+            else:
+                self._methods[kind]['requests'] += 1
+                self._lanes[lane]['requests'] += 1
+            started = time.monotonic()
+            try:
+                return await send()
+            except FloodWait as e:
+                flood_wait = e
+            finally:
+                self.latency.observe(time.monotonic() - started, method=name)
+            self._methods[kind]['flood_waits'] += 1
+            self._methods[kind]['flood_wait_seconds'] += flood_wait.value
+            if bucket is not None:
+                bucket.block(flood_wait.value) # Queued requests (and our retry) wait it out together
+            if flood_wait.value > max_sleep:
+                logging.warning(f"Scheduler: {name} for {account} hit a {flood_wait.value}s flood wait; "
+                                f"longer than the {LANE_NAMES[lane]} lane waits, so raising it.")
+                raise flood_wait
+            logging.warning(f"Scheduler: {name} for {account} hit a {flood_wait.value}s flood wait; "
+                            f"holding {kind} requests and retrying.")
+            if bucket is None:
+                await asyncio.sleep(flood_wait.value)
+
+    def stats(self) -> dict:
+        return {
+            'lanes': {LANE_NAMES[lane]: {**values, 'wait_seconds': round(values['wait_seconds'], 3)}
+                      for lane, values in self._lanes.items()},
+            'methods': {kind: {**values, 'wait_seconds': round(values['wait_seconds'], 3),
+                               'max_wait_seconds': round(values['max_wait_seconds'], 3)}
+                        for kind, values in self._methods.items()},
+            'buckets': len(self._buckets),
+            'blocked': sum(1 for bucket in self._buckets.values() if bucket.blocked_until > time.monotonic()),
+        }
+
+    # --- Internals ---
+    def _bucket(self, account: str, kind: str):
+        rate, burst = self.limits[kind]
+        if rate <= 0:
+            return None
+        key = (account, kind)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets: # Forget buckets that are back to their resting state
+                self._buckets = {key: bucket for key, bucket in self._buckets.items() if not bucket.idle}
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    async def _acquire(self, bucket: TokenBucket, kind: str, lane: int):
+        lane_stats, method_stats = self._lanes[lane], self._methods[kind]
+        started = time.monotonic()
+        lane_stats['waiting'] += 1
+        try:
+            queued = await bucket.acquire(lane)
+        finally:
+            lane_stats['waiting'] -= 1
+        waited = time.monotonic() - started
+        lane_stats['requests'] += 1
+        lane_stats['wait_seconds'] += waited
+        method_stats['requests'] += 1
+        method_stats['wait_seconds'] += waited
+        method_stats['max_wait_seconds'] = max(method_stats['max_wait_seconds'], waited)
+        if queued:
+            method_stats['queued'] += 1
@@ -0,0 +1,308 @@
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface
+from itsdangerous import BadSignature, URLSafeSerializer
+from werkzeug.datastructures import CallbackDict
+
+SID_BYTES = 32 # Session ids are random, so the cookie carries nothing but a 256-bit lookup key
+SCOPED_TOKEN_HEADER = 'X-Session-Token' # Carries a scoped_token() instead of the session cookie
+TICKET_PARAM = 'ticket' # Query parameter carrying an issue_ticket() instead of the session cookie
+TICKET_PREFIX = 'ticket:' # Tickets live in the session backend under this prefix; sids never contain ':'
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """A Flask session whose data lives in a session backend; ``sid`` is None until it is first saved."""
+
+    def __init__(self, initial=None, sid: str = None, expires_at: float = 0, read_only: bool = False):
+        def on_update(session):
+            session.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.read_only = read_only # Opened with a scoped token or ticket; never saved
+        self.modified = False
+
+
+# --- Backends: load(sid) -> (payload, expires_at) or None, save(sid, payload, expires_at), delete(sid) ---
+class MemorySessionBackend:
+    """Sessions in this process only; they are lost on restart and not shared with other workers."""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {} # sid -> (payload, expires_at)
+        self._purged_at = time.time()
+
+    def load(self, sid: str):
+        with self._lock:
+            item = self._items.get(sid)
+        return item if item and item[1] > time.time() else None
+
+    def save(self, sid: str, payload: str, expires_at: float):
+        now = time.time()
+        with self._lock:
+            self._items[sid] = (payload, expires_at)
+            if now - self._purged_at > 600:
+                self._items = {sid: item for sid, item in self._items.items() if item[1] > now}
+                self._purged_at = now
+
+    def delete(self, sid: str):
+        with self._lock:
+            self._items.pop(sid, None)
+
+
+class SQLiteSessionBackend:
+    """Sessions in a SQLite file, shared by every worker process on the host and kept across restarts."""
+
+    name = 'sqlite'
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local() # One connection per thread; WAL lets readers and a writer overlap
+        self._purged_at = 0
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                sid TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at);
+        """)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None) # Autocommit
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def load(self, sid: str):
+        row = self._connection().execute("SELECT data, expires_at FROM sessions WHERE sid = ? AND expires_at > ?",
+                                         (sid, time.time())).fetchone()
+        return tuple(row) if row else None
+
+    def save(self, sid: str, payload: str, expires_at: float):
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO sessions (sid, data, expires_at) VALUES (?, ?, ?)",
+                           (sid, payload, expires_at))
+        now = time.time()
+        if now - self._purged_at > 600:
+            self._purged_at = now
+            connection.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+
+    def delete(self, sid: str):
+        self._connection().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+
+class RedisSessionBackend:
+    """Sessions in Redis or a compatible server (Valkey, KeyDB, ...), which expires them itself. Needs redis-py."""
+
+    name = 'redis'
+
+    def __init__(self, url: str, prefix: str = 'teledrive:session:'):
+        import redis # Optional dependency; only needed for this backend
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def load(self, sid: str):
+        with self._redis.pipeline() as pipeline:
+            payload, ttl = pipeline.get(self.prefix + sid).pttl(self.prefix + sid).execute()
+        if payload is None:
+            return None
+        return payload.decode(), time.time() + max(ttl, 0) / 1000
+
+    def save(self, sid: str, payload: str, expires_at: float):
+        self._redis.set(self.prefix + sid, payload, px=max(1, int((expires_at - time.time()) * 1000)))
+
+    def delete(self, sid: str):
+        self._redis.delete(self.prefix + sid)
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Keeps session data in ``backend`` and only an opaque random id in the cookie. Sessions expire
+    ``lifetime`` seconds after they were last saved and are saved again once half of that has passed,
+    so active users stay signed in. Loaded sessions are cached in-process for ``cache_ttl`` seconds;
+    with several worker processes that is how long a change made by one may take to reach the others.
+    Cookies from before server-side sessions (signed cookie sessions) are moved into the backend.
+    """
+
+    serializer = TaggedJSONSerializer() # Same encoding Flask uses for cookie sessions
+
+    def __init__(self, backend, lifetime: float = 30 * 24 * 3600, cache_items: int = 10000, cache_ttl: float = 5):
+        self.backend = backend
+        self.lifetime = lifetime
+        self.cache_items = cache_items
+        self.cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        self._cache = OrderedDict() # sid -> (cached_at, data, expires_at), least recently used first
+        self._legacy = SecureCookieSessionInterface()
+        self.hits = 0
+        self.misses = 0
+
+    def open_session(self, app, request):
+        token = request.headers.get(SCOPED_TOKEN_HEADER)
+        if token:
+            return self._open_scoped(app, request, token)
+        ticket = request.args.get(TICKET_PARAM)
+        if ticket:
+            return self._open_ticket(request, ticket)
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return ServerSideSession()
+        loaded = self._load(sid)
+        if loaded is not None:
+            data, expires_at = loaded
+            return ServerSideSession(data, sid, expires_at)
+        legacy = self._legacy.open_session(app, request) # A cookie that still holds the data itself
+        session = ServerSideSession()
+        if legacy:
+            session.update(legacy)
+        return session
+
+    def save_session(self, app, session, response):
+        if getattr(session, 'read_only', False):
+            return
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        if not session:
+            if session.modified: # Cleared, e.g. on logout
+                if session.sid:
+                    self.discard(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        response.vary.add('Cookie')
+
+        new_sid = session.sid is None
+        if new_sid:
+            session.sid = secrets.token_urlsafe(SID_BYTES)
+        now = time.time()
+        if new_sid or session.modified or session.expires_at - now < self.lifetime / 2:
+            session.expires_at = now + self.lifetime
+            self._store(session.sid, dict(session), session.expires_at)
+        if new_sid or self.should_set_cookie(app, session):
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+    def create(self, data: dict) -> str:
+        """Stores a new session holding ``data`` and returns its cookie value (e.g. for load tests)."""
+        sid = secrets.token_urlsafe(SID_BYTES)
+        self._store(sid, data, time.time() + self.lifetime)
+        return sid
+
+    def scoped_token(self, app, sid: str, path: str, max_age: float) -> str:
+        """
+        A signed token, sent in the X-Session-Token header, that opens session ``sid`` read-only for requests
+        to ``path`` alone over the next ``max_age`` seconds. Lets a helper process (ffmpeg) fetch one file as
+        the user without holding the session id itself.
+        """
+        return self._token_serializer(app).dumps([sid, path, time.time() + max_age])
+
+    def issue_ticket(self, sid: str, path: str, max_age: float) -> str:
+        """
+        A random ticket, sent as ?ticket=, that opens session ``sid`` read-only for requests to ``path`` alone
+        until revoke_ticket() or ``max_age`` seconds, whichever comes first. Kept in the backend, so any worker
+        honours it and a revoked ticket is dead everywhere; for helpers that only take a URL (ffprobe), where
+        it shows up in the command line.
+        """
+        ticket = secrets.token_urlsafe(SID_BYTES)
+        self.backend.save(TICKET_PREFIX + ticket, self.serializer.dumps({'sid': sid, 'path': path}),
+                          time.time() + max_age)
+        return ticket
+
+    def revoke_ticket(self, ticket: str):
+        self.backend.delete(TICKET_PREFIX + ticket)
+
+    def regenerate(self, session: ServerSideSession):
+        """Gives ``session`` a new id when it is next saved and drops the old one, e.g. after signing in."""
+        if session.sid:
+            self.discard(session.sid)
+        session.sid = None
+        session.modified = True
+
+    def discard(self, sid: str):
+        with self._lock:
+            self._cache.pop(sid, None)
+        self.backend.delete(sid)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': self.backend.name,
+                'cached': len(self._cache),
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+    # --- Internals ---
+    def _open_scoped(self, app, request, token: str) -> ServerSideSession:
+        try:
+            sid, path, expires_at = self._token_serializer(app).loads(token)
+        except (BadSignature, TypeError, ValueError):
+            return ServerSideSession()
+        loaded = self._load(sid) if path == request.path and expires_at > time.time() else None
+        if loaded is None:
+            return ServerSideSession(read_only=True)
+        return ServerSideSession(loaded[0], sid, loaded[1], read_only=True)
+
+    def _open_ticket(self, request, ticket: str) -> ServerSideSession:
+        item = self.backend.load(TICKET_PREFIX + ticket)
+        grant = self.serializer.loads(item[0]) if item else None
+        loaded = self._load(grant['sid']) if grant and grant['path'] == request.path else None
+        if loaded is None:
+            return ServerSideSession(read_only=True)
+        return ServerSideSession(loaded[0], grant['sid'], loaded[1], read_only=True)
+
+    @staticmethod
+    def _token_serializer(app) -> URLSafeSerializer:
+        return URLSafeSerializer(app.secret_key, salt='scoped-session')
+
+    def _load(self, sid: str):
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(sid)
+            if entry is not None and now - entry[0] < self.cache_ttl and entry[2] > now:
+                self._cache.move_to_end(sid)
+                self.hits += 1
+                return dict(entry[1]), entry[2]
+            self.misses += 1
+        item = self.backend.load(sid)
+        if item is None:
+            with self._lock:
+                self._cache.pop(sid, None)
+            return None
+        data, expires_at = self.serializer.loads(item[0]), item[1]
+        self._remember(sid, data, expires_at)
+        return dict(data), expires_at
+
+    def _store(self, sid: str, data: dict, expires_at: float):
+        self.backend.save(sid, self.serializer.dumps(data), expires_at)
+        self._remember(sid, data, expires_at)
+
+    def _remember(self, sid: str, data: dict, expires_at: float):
+        if self.cache_items <= 0:
+            return
+        with self._lock:
+            self._cache[sid] = (time.time(), dict(data), expires_at)
+            self._cache.move_to_end(sid)
+            while len(self._cache) > self.cache_items:
+                self._cache.popitem(last=False)
+
+
+def create_backend(kind: str, sqlite_path: str, redis_url: str):
+    """The session backend named by ``kind``: memory, sqlite or redis."""
+    if kind == 'memory':
+        return MemorySessionBackend()
+    if kind == 'sqlite':
+        return SQLiteSessionBackend(sqlite_path)
+    if kind == 'redis':
+        return RedisSessionBackend(redis_url)
+    raise ValueError(f"Unknown session store '{kind}'; use memory, sqlite or redis.")
@@ -1,5 +1,6 @@
 "use client";
 
+import { useEffect, useState } from "react";
 import { Button } from "@/components/ui/button";
 import {
   Dialog,
@@ -24,6 +25,12 @@ interface PreviewDialogProps {
 }
 
 export function PreviewDialog({ open, onOpenChange, mediaItem }: PreviewDialogProps) {
+  const [imageSrc, setImageSrc] = useState(mediaItem?.previewUrl || mediaItem?.url || "");
+
+  useEffect(() => {
+    setImageSrc(mediaItem?.previewUrl || mediaItem?.url || "");
+  }, [mediaItem]);
+
   if (!mediaItem) return null;
 
   const handleDownload = () => {
@@ -37,21 +44,31 @@ export function PreviewDialog({ open, onOpenChange, mediaItem }: PreviewDialogPr
       case "image":
         return (
           <Image
-            src={mediaItem.url}
+            src={imageSrc}
             alt={mediaItem.name}
             width={800}
             height={600}
             className="rounded-md object-contain max-h-[60vh]"
             data-ai-hint="image preview"
+            unoptimized={imageSrc !== mediaItem.url} // Already resized to fit by the backend
+            onError={() => setImageSrc(mediaItem.url)} // The backend couldn't render a preview; show the original
           />
         );
       case "video":
         return (
-          <div className="bg-black rounded-md flex items-center justify-center max-h-[60vh] aspect-video">
-            {/* Replace with actual video player if possible */}
-            <VideoIcon className="h-24 w-24 text-muted-foreground" />
-            <p className="absolute bottom-4 text-sm text-white bg-black/50 px-2 py-1 rounded">Video preview placeholder</p>
-          </div>
+          <video
+            key={mediaItem.id}
+            controls
+            playsInline
+            preload="metadata"
+            crossOrigin="use-credentials"
+            poster={mediaItem.thumbnailUrl || undefined}
+            className="bg-black rounded-md max-h-[60vh] w-full aspect-video"
+          >
+            {/* Browsers without native HLS skip the adaptive preview and play the original */}
+            {mediaItem.previewUrl && <source src={mediaItem.previewUrl} type="application/vnd.apple.mpegurl" />}
+            <source src={mediaItem.url} />
+          </video>
         );
       default:
         return (
@@ -7,6 +7,7 @@ export interface MediaItem {
   type: FileType;
   url: string; // Initially from backend (e.g., placehold.co), or direct stream URL
   thumbnailUrl: string; // Initially from backend, or direct stream URL
+  previewUrl?: string; // Lower-resolution rendition (WebP image or HLS playlist), if the backend can make one
   timestamp: number; // Unix timestamp in milliseconds
   tags: string[];
   size?: string; // e.g., "1.2 MB"
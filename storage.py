@@ -0,0 +1,144 @@
+import asyncio
+import datetime
+import logging
+import threading
+import weakref
+import zlib
+
+from pyrogram import enums
+
+SAVED_MESSAGES = "me"
+PLACEMENTS = ('hash', 'type', 'date')
+SHARD_BITS = 32 # Message ids are per chat and stay below 2**31, so a shard fits above them
+
+
+def media_id(shard: int, message_id: int) -> int:
+    """
+    The id a file is known by outside Telegram: its message id with the shard in the high bits, so
+    files in Saved Messages (shard 0) keep their plain message id.
+    """
+    return (shard << SHARD_BITS) | message_id
+
+
+def split_media_id(value: int) -> tuple:
+    """Inverse of media_id(): ``(shard, message_id)``."""
+    return value >> SHARD_BITS, value & ((1 << SHARD_BITS) - 1)
+
+
+def chat_of(message):
+    """The chat id to fetch ``message`` again from; Saved Messages if it doesn't say."""
+    return getattr(getattr(message, 'chat', None), 'id', None) or SAVED_MESSAGES
+
+
+def parse_type_map(spec: str) -> dict:
+    """Parses ``"video=1,image=2,*=3"`` into {file type: shard}; ``*`` is every other type."""
+    placement = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        file_type, _, shard = item.partition('=')
+        placement[file_type.strip()] = int(shard)
+    return placement
+
+
+class Storage:
+    """
+    Where each user's files live. Shard 0 is Saved Messages, which keeps everything uploaded before
+    shards were configured; shards 1..``channels`` are private channels that new uploads are spread
+    across by ``placement``: a 'hash' of the file name, the file 'type' (looked up in ``type_map``,
+    0 for types it doesn't name) or the upload 'date' (one shard per calendar month, in rotation).
+    Channels are created on a user's first upload, or found again by title, and are remembered with
+    their access hashes in the media index so every pooled client can address them.
+    """
+
+    def __init__(self, index, channels: int = 0, placement: str = 'hash', type_map: dict = None,
+                 title: str = 'TeleDrive Storage'):
+        if placement not in PLACEMENTS:
+            raise ValueError(f"Unknown storage placement '{placement}'; use one of {', '.join(PLACEMENTS)}.")
+        self.index = index
+        self.channels = max(0, channels)
+        self.placement = placement
+        self.type_map = type_map or {}
+        self.title = title
+        self._lock = threading.Lock()
+        self._known = {} # owner_id -> {shard: (chat_id, access_hash)}
+        self._attached = weakref.WeakKeyDictionary() # Client -> chat ids registered with its peer storage
+        self._creating = {} # owner_id -> asyncio.Lock, so concurrent first uploads create each channel once
+
+    def chats(self, owner_id: int) -> dict:
+        """The user's storage chats as {shard: chat id}, Saved Messages included."""
+        return {0: SAVED_MESSAGES, **{shard: chat_id for shard, (chat_id, _) in self._channels(owner_id).items()}}
+
+    def shard_of(self, owner_id: int, message) -> int:
+        """The shard a message was sent to or fetched from; 0 unless it is in one of the user's channels."""
+        chat_id = getattr(getattr(message, 'chat', None), 'id', None)
+        return next((shard for shard, (known_id, _) in self._channels(owner_id).items() if known_id == chat_id), 0)
+
+    def place(self, file_name: str, file_type: str, when: datetime.datetime = None) -> int:
+        """The shard a new upload goes to."""
+        if not self.channels:
+            return 0
+        if self.placement == 'type':
+            shard = self.type_map.get(file_type, self.type_map.get('*', 0))
+            return shard if 0 <= shard <= self.channels else 0
+        if self.placement == 'date':
+            when = when or datetime.datetime.now(datetime.timezone.utc)
+            return (when.year * 12 + when.month - 1) % self.channels + 1
+        return zlib.crc32(file_name.encode()) % self.channels + 1
+
+    async def attach(self, client, owner_id: int, create: bool = False) -> dict:
+        """
+        Returns the user's {shard: chat id} after teaching ``client`` the channels' access hashes. With
+        ``create``, first makes sure every configured channel exists. Runs on the Telegram loop.
+        """
+        channels = await asyncio.to_thread(self._channels, owner_id)
+        if create and len([shard for shard in channels if shard <= self.channels]) < self.channels:
+            channels = await self._create_channels(client, owner_id)
+        attached = self._attached.setdefault(client, set())
+        peers = [(chat_id, access_hash, 'channel', None, None) for chat_id, access_hash in channels.values()
+                 if chat_id not in attached]
+        if peers:
+            await client.storage.update_peers(peers)
+            attached.update(chat_id for chat_id, *_ in peers)
+        return self.chats(owner_id)
+
+    async def load(self, owner_id: int) -> dict:
+        """Reads the user's channels from the index in a worker thread, so chats() and shard_of() never hit SQLite on the loop."""
+        return await asyncio.to_thread(self._channels, owner_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            owners = len(self._known)
+        return {'channels': self.channels, 'placement': self.placement, 'owners': owners}
+
+    # --- Internals ---
+    def _channels(self, owner_id: int) -> dict:
+        with self._lock:
+            channels = self._known.get(owner_id)
+        if channels is None:
+            channels = self.index.get_storage_chats(owner_id)
+            with self._lock:
+                self._known[owner_id] = channels
+        return channels
+
+    async def _create_channels(self, client, owner_id: int) -> dict:
+        lock = self._creating.setdefault(owner_id, asyncio.Lock())
+        async with lock:
+            channels = dict(await asyncio.to_thread(self._channels, owner_id))
+            missing = {f"{self.title} {shard}": shard for shard in range(1, self.channels + 1) if shard not in channels}
+            if not missing:
+                return channels
+            found = {}
+            async for dialog in client.get_dialogs(): # Channels from an earlier run whose index was lost
+                chat = dialog.chat
+                if chat.type == enums.ChatType.CHANNEL and chat.title in missing and getattr(chat, 'is_creator', False):
+                    found[missing.pop(chat.title)] = chat.id
+            for title, shard in missing.items():
+                chat = await client.create_channel(title, "Files stored by TeleDrive.")
+                found[shard] = chat.id
+                logging.info(f"Storage: created channel '{title}' for owner {owner_id}.")
+            for shard, chat_id in found.items():
+                peer = await client.resolve_peer(chat_id)
+                await asyncio.to_thread(self.index.save_storage_chat, owner_id, shard, chat_id, peer.access_hash)
+                channels[shard] = (chat_id, peer.access_hash)
+            with self._lock:
+                self._known[owner_id] = channels
+            return channels
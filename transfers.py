@@ -0,0 +1,143 @@
+import collections
+import logging
+import threading
+import time
+import uuid
+
+THROUGHPUT_WINDOW = 5.0 # Seconds of progress the live throughput is averaged over
+
+
+class Transfer:
+    """One upload or download. Progress calls may come from any thread."""
+
+    def __init__(self, registry, kind: str, name: str, total: int = 0, owner: str = None):
+        self.registry = registry
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind # 'upload' or 'download'
+        self.name = name
+        self.total = total or 0
+        self.owner = owner # ClientPool.describe_key of the user's session
+        self.transferred = 0
+        self.state = 'active'
+        self.error = None
+        self.started_at = self.updated_at = time.time()
+        self._window_started, self._window_bytes = time.monotonic(), 0
+        self._throughput = 0.0 # Bytes per second over the last full window
+        self._last_logged = -10.0
+
+    def advance(self, amount: int):
+        self.update(self.transferred + amount)
+
+    def update(self, transferred: int, total: int = None):
+        """Records that ``transferred`` bytes are done so far (and, optionally, the total)."""
+        self.registry._update(self, transferred, total)
+
+    def progress(self, current: int, total: int, *args):
+        """Pyrogram-style progress callback."""
+        self.update(current, total)
+
+    def finish(self, error=None):
+        """Marks the transfer done (or failed, with ``error``); safe to call more than once."""
+        self.registry._finish(self, 'failed' if error else 'done', str(error) if error else None)
+
+    def describe(self, now: float = None) -> dict:
+        now = now or time.monotonic()
+        elapsed = (time.time() if self.state == 'active' else self.updated_at) - self.started_at
+        window = now - self._window_started
+        if window > 0.5:
+            live = (self.transferred - self._window_bytes) / window
+        else: # Window just restarted; fall back to the last one, or the average so far
+            live = self._throughput or (self.transferred / elapsed if elapsed > 0 else 0)
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'name': self.name,
+            'state': self.state,
+            'bytes': self.transferred,
+            'total': self.total or None,
+            'percent': round(self.transferred * 100 / self.total, 1) if self.total else None,
+            'started_at': int(self.started_at * 1000),
+            'seconds': round(elapsed, 3),
+            'throughput_mbps': round(live * 8 / 1_000_000, 2) if self.state == 'active' else
+                               (round(self.transferred * 8 / elapsed / 1_000_000, 2) if elapsed > 0 else None),
+            **({'error': self.error} if self.error else {}),
+        }
+
+
+class TransferRegistry:
+    """
+    Live uploads and downloads, plus the last ``max_finished`` that ended. Active transfers with no
+    progress for ``stale_after`` seconds (e.g. the client vanished without the transfer being finished)
+    are retired as 'stalled', so the registry stays bounded whatever happens to a transfer.
+    """
+
+    def __init__(self, max_finished: int = 100, stale_after: float = 300):
+        self.stale_after = stale_after
+        self._active = {}
+        self._finished = collections.deque(maxlen=max_finished)
+        self._bytes = collections.Counter() # kind -> bytes moved, including finished transfers
+        self._counts = collections.Counter() # (kind, state) -> transfers that ended that way
+        self._lock = threading.Lock()
+
+    def start(self, kind: str, name: str, total: int = 0, owner: str = None) -> Transfer:
+        transfer = Transfer(self, kind, name, total, owner)
+        with self._lock:
+            self._retire_stale()
+            self._active[transfer.id] = transfer
+        return transfer
+
+    def snapshot(self, owner: str = None) -> dict:
+        """Active and recently finished transfers, newest first; only ``owner``'s if given."""
+        now = time.monotonic()
+        with self._lock:
+            self._retire_stale()
+            active = [transfer.describe(now) for transfer in self._active.values()
+                      if owner is None or transfer.owner == owner]
+            finished = [transfer.describe(now) for transfer in reversed(self._finished)
+                        if owner is None or transfer.owner == owner]
+        active.sort(key=lambda item: item['started_at'], reverse=True)
+        return {'active': active, 'finished': finished}
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._retire_stale()
+            active = collections.Counter(transfer.kind for transfer in self._active.values())
+            return {'active': dict(active), 'bytes': dict(self._bytes), 'finished': dict(self._counts)}
+
+    # --- Internals ---
+    def _update(self, transfer: Transfer, transferred: int, total: int = None):
+        now = time.monotonic()
+        with self._lock:
+            if transfer.state != 'active':
+                return
+            if total:
+                transfer.total = total
+            self._bytes[transfer.kind] += max(0, transferred - transfer.transferred)
+            transfer.transferred = transferred
+            transfer.updated_at = time.time()
+            if now - transfer._window_started >= THROUGHPUT_WINDOW:
+                transfer._throughput = (transferred - transfer._window_bytes) / (now - transfer._window_started)
+                transfer._window_started, transfer._window_bytes = now, transferred
+            percentage = transferred * 100 / transfer.total if transfer.total else 0
+            log_now = percentage >= transfer._last_logged + 10 or transferred == transfer.total
+            if log_now:
+                transfer._last_logged = percentage
+        if log_now: # Start, end and every 10%, as the old progress logging did
+            logging.info(f"Transfer '{transfer.name}': {transferred}/{transfer.total} bytes ({percentage:.2f}%)")
+
+    def _finish(self, transfer: Transfer, state: str, error: str = None):
+        with self._lock:
+            if self._active.pop(transfer.id, None) is None:
+                return
+            transfer.state, transfer.error = state, error
+            transfer.updated_at = time.time()
+            self._finished.append(transfer)
+            self._counts[(transfer.kind, state)] += 1
+
+    def _retire_stale(self):
+        cutoff = time.time() - self.stale_after
+        for transfer in [transfer for transfer in self._active.values() if transfer.updated_at < cutoff]:
+            del self._active[transfer.id]
+            transfer.state = 'stalled'
+            self._finished.append(transfer)
+            self._counts[(transfer.kind, 'stalled')] += 1
@@ -0,0 +1,88 @@
+import asyncio
+import hashlib
+import logging
+import tempfile
+
+from pyrogram.errors import MessageIdInvalid
+
+SPOOL_MAX_MEMORY = 500 * 1024 # Like werkzeug's default stream factory: bigger files spill to a temp file
+
+
+class HashingSpooledFile(tempfile.SpooledTemporaryFile):
+    """
+    Where the form parser writes an uploaded file: SHA-256 hashes and counts the bytes as they arrive,
+    so the upload doesn't need a second pass over the file before it can be deduplicated.
+    """
+
+    def __init__(self):
+        super().__init__(max_size=SPOOL_MAX_MEMORY, mode='rb+')
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data) -> int:
+        self.digest.update(data)
+        self.size += len(data)
+        return super().write(data)
+
+    def sha256(self) -> str:
+        return self.digest.hexdigest()
+
+
+class UploadDeduplicator:
+    """
+    Skips uploading bytes a user already has in their storage chats. Uploaded files are remembered by
+    SHA-256 and size in the media index; when the same content comes in again the existing document
+    is re-sent by reference (send_cached_media) with the new caption instead of being uploaded again.
+    Telegram can't rename a stored document, so bytes coming in under a different file name are
+    uploaded again, and that copy is what later uploads match.
+    """
+
+    def __init__(self, index, storage):
+        self.index = index
+        self.storage = storage # storage.Storage, which knows the chat each shard is in
+        self.hits = 0
+        self.bytes_saved = 0
+
+    def remember(self, owner_id: int, sha256: str, size: int, message):
+        if sha256 and message:
+            self.index.save_content_hash(owner_id, sha256, size, message.id, self.storage.shard_of(owner_id, message))
+
+    async def send_existing(self, client, owner_id: int, sha256: str, size: int, caption: str = "", chat_id="me",
+                            file_name: str = None):
+        """
+        Re-sends the stored copy of these bytes to ``chat_id`` with ``caption`` and returns the new message,
+        or None on a miss or when the stored copy is named other than ``file_name``. ``client`` must be
+        attached to the user's storage (Storage.attach).
+        """
+        if not sha256:
+            return None
+        found = await asyncio.to_thread(self.index.find_content_hash, owner_id, sha256, size)
+        if found is None:
+            return None
+        shard, message_id = found
+        source_chat_id = self.storage.chats(owner_id).get(shard)
+        if source_chat_id is None: # A channel the index no longer knows about
+            return None
+        try:
+            message = await client.get_messages(source_chat_id, message_ids=message_id)
+        except MessageIdInvalid:
+            message = None
+        payload = message and (message.document or message.video or message.audio or message.photo or
+                               message.voice or message.video_note or message.animation or message.sticker)
+        if not payload or (payload.file_size or 0) != size: # Deleted or edited since; upload normally
+            logging.info(f"Upload dedup: message {message_id} no longer holds {sha256[:12]}; forgetting it.")
+            await asyncio.to_thread(self.index.forget_content_hash, owner_id, sha256, size)
+            return None
+        stored_name = getattr(payload, 'file_name', None)
+        if file_name and stored_name and stored_name != file_name:
+            logging.info(f"Upload dedup: message {message_id} holds these bytes as '{stored_name}'; uploading "
+                         f"'{file_name}' so it keeps its name.")
+            return None
+        new_message = await client.send_cached_media(chat_id, payload.file_id, caption=caption)
+        self.hits += 1
+        self.bytes_saved += size
+        logging.info(f"Upload dedup: re-sent message {message_id} ({size} bytes) instead of uploading it again.")
+        return new_message
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'bytes_saved': self.bytes_saved}
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import os
+import zipfile
+from datetime import datetime
+
+_END = object()
+
+
+class ZipStreamEntry:
+    """One archive member: ``open()`` returns an async iterator over the file's bytes."""
+
+    def __init__(self, name: str, size: int, modified: datetime, open):
+        self.name = name
+        self.size = size # Expected size; 0 when unknown
+        self.modified = modified
+        self.open = open
+
+
+class _ArchiveSink:
+    """
+    A write-only, non-seekable file object for zipfile. Without seek() zipfile writes each member's
+    CRC and sizes in a data descriptor after its data, so nothing already written is ever revisited
+    and the bytes can be handed to the client as soon as they are produced.
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._parts)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _archive_name(name: str, used: set) -> str:
+    """Flattens ``name`` into a single path component and makes it unique within the archive."""
+    name = name.replace('/', '_').replace('\\', '_').lstrip('.') or 'file'
+    stem, extension = os.path.splitext(name)
+    candidate, counter = name, 1
+    while candidate.lower() in used:
+        counter += 1
+        candidate = f"{stem} ({counter}){extension}"
+    used.add(candidate.lower())
+    return candidate
+
+
+def _zip_date_time(modified: datetime):
+    if modified is None or modified.year < 1980: # The earliest date a ZIP header can hold
+        return (1980, 1, 1, 0, 0, 0)
+    return modified.timetuple()[:6]
+
+
+async def stream_zip(entries, concurrency: int = 4, buffer_chunks: int = 4, errors_name: str = 'export_errors.txt'):
+    """
+    Yields a store-mode (uncompressed) ZIP64 archive of ``entries``, an async iterable of ZipStreamEntry.
+
+    Up to ``concurrency`` files are downloaded at once, each buffering at most ``buffer_chunks`` chunks
+    ahead of the writer, while members are written in order; memory stays bounded however many files
+    there are. A file that fails is left out (or, if it failed part-way, kept truncated) and listed in
+    ``errors_name`` at the end of the archive instead of aborting the whole export.
+    """
+    sink = _ArchiveSink()
+    archive = zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+    entries = aiter(entries)
+    pending = [] # (entry, queue, task) in archive order; the first one is being written
+    used_names, failures = set(), []
+    more_entries = True
+
+    async def fill(entry: ZipStreamEntry, queue: asyncio.Queue):
+        try:
+            async for chunk in entry.open():
+                await queue.put(chunk)
+            await queue.put(_END)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put(e)
+
+    async def start_more():
+        nonlocal more_entries
+        while more_entries and len(pending) < concurrency:
+            try:
+                entry = await anext(entries)
+            except StopAsyncIteration:
+                more_entries = False
+                return
+            queue = asyncio.Queue(maxsize=max(1, buffer_chunks))
+            pending.append((entry, queue, asyncio.create_task(fill(entry, queue))))
+
+    try:
+        await start_more()
+        while pending:
+            entry, queue, _ = pending[0]
+            member, written = None, 0
+            try:
+                while True:
+                    item = await queue.get()
+                    if isinstance(item, Exception):
+                        raise item
+                    if member is None: # Opened lazily, so a file that fails up front leaves no trace
+                        info = zipfile.ZipInfo(_archive_name(entry.name, used_names), _zip_date_time(entry.modified))
+                        info.compress_type = zipfile.ZIP_STORED
+                        info.external_attr = 0o644 << 16 # rw-r--r-- when extracted
+                        info.file_size = entry.size # Size hint; zipfile picks ZIP64 headers from it
+                        member = archive.open(info, 'w', force_zip64=not entry.size)
+                    if item is _END:
+                        break
+                    member.write(item)
+                    written += len(item)
+                    yield sink.drain()
+            except Exception as e:
+                logging.warning(f"Export: '{entry.name}' failed after {written} bytes: {e}")
+                name = member._zinfo.filename if member is not None else entry.name
+                failures.append(f"{name}: {f'truncated after {written} bytes' if written else 'skipped'} ({e})")
+            finally:
+                if member is not None:
+                    member.close()
+            pending.pop(0)
+            await start_more()
+            if sink.pending:
+                yield sink.drain() # Member trailers and headers written since the last chunk
+
+        if failures:
+            archive.writestr(_archive_name(errors_name, used_names), '\n'.join(failures) + '\n')
+        archive.close()
+        yield sink.drain()
+    finally:
+        for _, _, task in pending:
+            task.cancel()
+        await asyncio.gather(*(task for _, _, task in pending), return_exceptions=True)